@@ -19,6 +19,7 @@ SSE_FLAGS = "-mfpmath=sse -msse2"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'steppersync.c',
     'itersolve.c', 'trapq.c', 'pollreactor.c', 'msgblock.c', 'trdispatch.c',
+    'msgdecode.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_corexz.c', 'kin_delta.c',
     'kin_deltesian.c', 'kin_polar.c', 'kin_rotary_delta.c', 'kin_winch.c',
     'kin_extruder.c', 'kin_shaper.c', 'kin_idex.c', 'kin_generic.c'
@@ -26,7 +27,8 @@ SOURCE_FILES = [
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
     'list.h', 'serialqueue.h', 'stepcompress.h', 'steppersync.h',
-    'itersolve.h', 'pyhelper.h', 'trapq.h', 'pollreactor.h', 'msgblock.h'
+    'itersolve.h', 'pyhelper.h', 'trapq.h', 'pollreactor.h', 'msgblock.h',
+    'msgdecode.h'
 ]
 
 defs_stepcompress = """
@@ -195,6 +197,8 @@ defs_serialqueue = """
         , uint64_t notify_id);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
+    int serialqueue_pull_batch(struct serialqueue *sq
+        , struct pull_queue_message *q, int max);
     void serialqueue_set_wire_frequency(struct serialqueue *sq
         , double frequency);
     void serialqueue_set_receive_window(struct serialqueue *sq
@@ -206,6 +210,22 @@ defs_serialqueue = """
         , struct pull_queue_message *q, int max);
 """
 
+defs_msgdecode = """
+    #define MSGDECODE_MAX_PARAMS 16
+    struct pull_decoded_message {
+        int format, buf_len;
+        int64_t params[MSGDECODE_MAX_PARAMS];
+        uint8_t buf[MESSAGE_MAX];
+    };
+
+    struct msgdecode *msgdecode_alloc(void);
+    void msgdecode_free(struct msgdecode *md);
+    int msgdecode_add_format(struct msgdecode *md, uint32_t msgid
+        , char *param_types);
+    int msgdecode_decode(struct msgdecode *md, struct pull_queue_message *q
+        , int count, struct pull_decoded_message *out);
+"""
+
 defs_trdispatch = """
     void trdispatch_start(struct trdispatch *td, uint32_t dispatch_reason);
     void trdispatch_stop(struct trdispatch *td);
@@ -230,8 +250,9 @@ defs_std = """
 """
 
 defs_all = [
-    defs_pyhelper, defs_serialqueue, defs_std, defs_stepcompress,
-    defs_steppersync, defs_itersolve, defs_trapq, defs_trdispatch,
+    defs_pyhelper, defs_serialqueue, defs_msgdecode, defs_std,
+    defs_stepcompress, defs_steppersync, defs_itersolve, defs_trapq,
+    defs_trdispatch,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_corexz, defs_kin_delta,
     defs_kin_deltesian, defs_kin_polar, defs_kin_rotary_delta, defs_kin_winch,
     defs_kin_extruder, defs_kin_shaper, defs_kin_idex,
@@ -86,8 +86,8 @@ f4: *p++ = v & 0x7f;
 }
 
 // Parse an integer that was encoded as a "variable length quantity"
-static uint32_t
-parse_int(uint8_t **pp)
+uint32_t
+msgblock_parse_int(uint8_t **pp)
 {
     uint8_t *p = *pp, c = *p++;
     uint32_t v = c & 0x7f;
@@ -110,7 +110,7 @@ msgblock_decode(uint32_t *data, int data_len, uint8_t *msg, int msg_len)
     while (data_len--) {
         if (p >= end)
             return -1;
-        *data++ = parse_int(&p);
+        *data++ = msgblock_parse_int(&p);
     }
     if (p != end)
         // Invalid message
@@ -0,0 +1,142 @@
+// Compiled decoding of selected mcu response messages
+//
+// Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "msgblock.h" // msgblock_parse_int
+#include "msgdecode.h" // struct pull_decoded_message
+#include "serialqueue.h" // struct pull_queue_message
+
+// Parameter types understood by the decoder
+#define PT_UNSIGNED 'u'
+#define PT_SIGNED   'i'
+#define PT_BUFFER   's'
+
+#define MSGDECODE_MAX_FORMATS 16
+
+struct msgdecode_format {
+    uint32_t msgid;
+    int param_count;
+    char param_types[MSGDECODE_MAX_PARAMS];
+};
+
+struct msgdecode {
+    int format_count;
+    struct msgdecode_format formats[MSGDECODE_MAX_FORMATS];
+};
+
+// Allocate a new 'msgdecode' object
+struct msgdecode * __visible
+msgdecode_alloc(void)
+{
+    struct msgdecode *md = malloc(sizeof(*md));
+    memset(md, 0, sizeof(*md));
+    return md;
+}
+
+// Free memory associated with a 'msgdecode' object
+void __visible
+msgdecode_free(struct msgdecode *md)
+{
+    free(md);
+}
+
+// Register a message format - param_types is a string with one
+// character ('u', 'i', or 's') per message parameter
+int __visible
+msgdecode_add_format(struct msgdecode *md, uint32_t msgid, char *param_types)
+{
+    int param_count = strlen(param_types), buffers = 0, i;
+    if (md->format_count >= MSGDECODE_MAX_FORMATS
+        || param_count > MSGDECODE_MAX_PARAMS)
+        return -1;
+    for (i = 0; i < param_count; i++) {
+        char t = param_types[i];
+        if (t == PT_BUFFER)
+            buffers++;
+        else if (t != PT_UNSIGNED && t != PT_SIGNED)
+            return -1;
+    }
+    if (buffers > 1)
+        return -1;
+    struct msgdecode_format *mf = &md->formats[md->format_count];
+    mf->msgid = msgid;
+    mf->param_count = param_count;
+    memcpy(mf->param_types, param_types, param_count);
+    return md->format_count++;
+}
+
+// Decode the parameters of a single message block
+static int
+decode_message(struct msgdecode *md, uint8_t *msg, int msg_len
+               , struct pull_decoded_message *out)
+{
+    if (msg_len < MESSAGE_MIN)
+        return -1;
+    uint8_t *p = &msg[MESSAGE_HEADER_SIZE];
+    uint8_t *end = &msg[msg_len - MESSAGE_TRAILER_SIZE];
+    if (p >= end)
+        return -1;
+    uint32_t msgid = msgblock_parse_int(&p);
+    int fidx;
+    struct msgdecode_format *mf = NULL;
+    for (fidx = 0; fidx < md->format_count; fidx++) {
+        if (md->formats[fidx].msgid == msgid) {
+            mf = &md->formats[fidx];
+            break;
+        }
+    }
+    if (!mf)
+        return -1;
+    int i;
+    for (i = 0; i < mf->param_count; i++) {
+        if (p >= end)
+            return -1;
+        switch (mf->param_types[i]) {
+        case PT_UNSIGNED:
+            out->params[i] = msgblock_parse_int(&p);
+            break;
+        case PT_SIGNED:
+            out->params[i] = (int32_t)msgblock_parse_int(&p);
+            break;
+        default: {
+            int len = *p++;
+            if (p + len > end)
+                return -1;
+            memcpy(out->buf, p, len);
+            out->buf_len = len;
+            out->params[i] = 0;
+            p += len;
+            break;
+        }
+        }
+    }
+    if (p != end)
+        // Extra data at end of message - let the reference parser report it
+        return -1;
+    return fidx;
+}
+
+// Decode a batch of messages obtained from serialqueue_pull_batch().
+// Messages that do not match a registered format (or that are
+// notifications) have their 'format' field set to -1.
+int __visible
+msgdecode_decode(struct msgdecode *md, struct pull_queue_message *q
+                 , int count, struct pull_decoded_message *out)
+{
+    int i, decoded = 0;
+    for (i = 0; i < count; i++, q++, out++) {
+        if (q->notify_id) {
+            out->format = -1;
+            continue;
+        }
+        out->format = decode_message(md, q->msg, q->len, out);
+        if (out->format >= 0)
+            decoded++;
+    }
+    return decoded;
+}
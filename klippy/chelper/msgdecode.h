@@ -0,0 +1,23 @@
+#ifndef MSGDECODE_H
+#define MSGDECODE_H
+
+#include <stdint.h> // int64_t
+#include "msgblock.h" // MESSAGE_MAX
+
+#define MSGDECODE_MAX_PARAMS 16
+
+struct pull_decoded_message {
+    int format, buf_len;
+    int64_t params[MSGDECODE_MAX_PARAMS];
+    uint8_t buf[MESSAGE_MAX];
+};
+
+struct pull_queue_message;
+struct msgdecode *msgdecode_alloc(void);
+void msgdecode_free(struct msgdecode *md);
+int msgdecode_add_format(struct msgdecode *md, uint32_t msgid
+                         , char *param_types);
+int msgdecode_decode(struct msgdecode *md, struct pull_queue_message *q
+                     , int count, struct pull_decoded_message *out);
+
+#endif // msgdecode.h
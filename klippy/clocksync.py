@@ -47,6 +47,16 @@ class ClockSync:
         self.cmd_queue = serial.alloc_command_queue()
         serial.register_response(self._handle_clock, 'clock')
         self.reactor.update_timer(self.get_clock_timer, self.reactor.NOW)
+    def resume(self, serial, prev_sync):
+        # Continue the clock estimate of a session kept over a restart
+        self.serial = serial
+        for name in ['mcu_freq', 'last_clock', 'clock_est', 'min_half_rtt',
+                     'min_rtt_time', 'time_avg', 'time_variance',
+                     'clock_avg', 'clock_covariance', 'prediction_variance',
+                     'last_prediction_time', 'get_clock_cmd', 'cmd_queue']:
+            setattr(self, name, getattr(prev_sync, name))
+        serial.register_response(self._handle_clock, 'clock')
+        self.reactor.update_timer(self.get_clock_timer, self.reactor.NOW)
     def connect_file(self, serial, pace=False):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
@@ -174,6 +184,10 @@ class SecondarySync(ClockSync):
         local_print_time = self.estimated_print_time(curtime)
         self.clock_adj = (main_print_time - local_print_time, self.mcu_freq)
         self.calibrate_clock(0., curtime)
+    def resume(self, serial, prev_sync):
+        ClockSync.resume(self, serial, prev_sync)
+        self.clock_adj = prev_sync.clock_adj
+        self.last_sync_time = prev_sync.last_sync_time
     def connect_file(self, serial, pace=False):
         ClockSync.connect_file(self, serial, pace)
         self.clock_adj = (0., self.mcu_freq)
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, os, glob, re, time, logging, configparser, io
+import sys, os, glob, re, time, logging, configparser, io, collections
 
 error = configparser.Error
 
@@ -145,6 +145,8 @@ class ConfigWrapper:
 ######################################################################
 
 class ConfigFileReader:
+    def __init__(self):
+        self.include_stats = []
     def read_config_file(self, filename):
         try:
             f = open(filename, 'r')
@@ -194,6 +196,8 @@ class ConfigFileReader:
             # Empty set is OK if wildcard but not for direct file reference
             raise error("Include file '%s' does not exist" % (include_glob,))
         include_filenames.sort()
+        self.include_stats.append((include_glob,
+                                   self._stat_files(include_filenames)))
         for include_filename in include_filenames:
             include_data = self.read_config_file(include_filename)
             self._parse_config(include_data, include_filename, fileconfig,
@@ -230,6 +234,63 @@ class ConfigFileReader:
         fileconfig = self._create_fileconfig()
         self._parse_config(data, filename, fileconfig, set())
         return fileconfig
+    # Parse cache support
+    def _stat_files(self, filenames):
+        out = []
+        for fname in filenames:
+            try:
+                st = os.stat(fname)
+            except OSError:
+                return None
+            out.append((fname, st.st_mtime, st.st_size))
+        return out
+    def _check_include_stats(self, include_stats):
+        for include_glob, stats in include_stats:
+            if stats is None:
+                return False
+            include_filenames = glob.glob(include_glob)
+            include_filenames.sort()
+            if self._stat_files(include_filenames) != stats:
+                return False
+        return True
+    def _restore_fileconfig(self, sections):
+        fileconfig = self._create_fileconfig()
+        fileconfig.read_dict(sections)
+        return fileconfig
+    def build_fileconfig_cached(self, data, filename, parse_cache,
+                                includes=True):
+        # Return (fileconfig, is_cached) - the cache entry is only used if
+        # the data is unchanged and every include glob resolves to the
+        # same files with the same modification time and size
+        if includes:
+            build_fileconfig = self.build_fileconfig_with_includes
+        else:
+            build_fileconfig = self.build_fileconfig
+        if sys.version_info.major < 3:
+            return build_fileconfig(data, filename), False
+        key = (os.path.abspath(filename), includes)
+        entry = parse_cache.get(key)
+        if (entry is not None and entry[0] == data
+            and self._check_include_stats(entry[1])):
+            self.include_stats = entry[1]
+            return self._restore_fileconfig(entry[2]), True
+        self.include_stats = []
+        fileconfig = build_fileconfig(data, filename)
+        # Store only the options set in each section (not those that are
+        # inherited from the DEFAULT section)
+        sections = collections.OrderedDict(
+            [(fileconfig.default_section,
+              collections.OrderedDict(fileconfig.defaults()))])
+        for section in fileconfig.sections():
+            sections[section] = collections.OrderedDict(
+                fileconfig._sections[section])
+        parse_cache[key] = (data, self.include_stats, sections)
+        return fileconfig, False
+
+# Parsed config files are kept in the start args so that they are
+# retained over a RESTART
+def get_parse_cache(printer):
+    return printer.get_start_args().setdefault('config_parse_cache', {})
 
 
 ######################################################################
@@ -248,6 +309,7 @@ class ConfigAutoSave:
         self.fileconfig = None
         self.status_save_pending = {}
         self.save_config_pending = False
+        self.status_version = 0
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
@@ -301,15 +363,20 @@ class ConfigAutoSave:
     def load_main_config(self):
         filename = self.printer.get_start_args()['config_file']
         cfgrdr = ConfigFileReader()
+        start_time = time.time()
         data = cfgrdr.read_config_file(filename)
         regular_data, autosave_data = self._find_autosave_data(data)
-        regular_fileconfig = cfgrdr.build_fileconfig_with_includes(
-            regular_data, filename)
+        regular_fileconfig, is_cached = cfgrdr.build_fileconfig_cached(
+            regular_data, filename, get_parse_cache(self.printer))
         autosave_data = self._strip_duplicates(autosave_data,
                                                regular_fileconfig)
         self.fileconfig = cfgrdr.build_fileconfig(autosave_data, filename)
         cfgrdr.append_fileconfig(regular_fileconfig,
                                  autosave_data, '*AUTOSAVE*')
+        logging.info("Config file %s parsed in %.3fs (%d includes%s)",
+                     filename, time.time() - start_time,
+                     sum([len(s or []) for g, s in cfgrdr.include_stats]),
+                     ", cached" if is_cached else "")
         return regular_fileconfig, self.fileconfig
     def get_status(self, eventtime):
         return {'save_config_pending': self.save_config_pending,
@@ -327,6 +394,7 @@ class ConfigAutoSave:
         pending[section][option] = svalue
         self.status_save_pending = pending
         self.save_config_pending = True
+        self.status_version += 1
         logging.info("save_config: set [%s] %s = %s", section, option, svalue)
     def remove_section(self, section):
         if self.fileconfig.has_section(section):
@@ -335,12 +403,14 @@ class ConfigAutoSave:
             pending[section] = None
             self.status_save_pending = pending
             self.save_config_pending = True
+            self.status_version += 1
         elif (section in self.status_save_pending and
               self.status_save_pending[section] is not None):
             pending = dict(self.status_save_pending)
             del pending[section]
             self.status_save_pending = pending
             self.save_config_pending = True
+            self.status_version += 1
     def _disallow_include_conflicts(self, regular_fileconfig):
         for section in self.fileconfig.sections():
             for option in self.fileconfig.options(section):
@@ -417,6 +487,7 @@ class ConfigValidate:
     def __init__(self, printer):
         self.printer = printer
         self.status_settings = {}
+        self.status_version = 0
         self.access_tracking = {}
         self.autosave_options = {}
     def start_access_tracking(self, autosave_fileconfig):
@@ -454,6 +525,7 @@ class ConfigValidate:
         self.status_settings = {}
         for (section, option), value in self.access_tracking.items():
             self.status_settings.setdefault(section, {})[option] = value
+        self.status_version += 1
     def get_status(self, eventtime):
         return {'settings': self.status_settings}
 
@@ -472,12 +544,14 @@ class PrinterConfig:
         self.deprecate_warnings = []
         self.status_raw_config = {}
         self.status_warnings = []
+        self.status_version = 0
     def get_printer(self):
         return self.printer
     def read_config(self, filename):
         cfgrdr = ConfigFileReader()
         data = cfgrdr.read_config_file(filename)
-        fileconfig = cfgrdr.build_fileconfig(data, filename)
+        fileconfig, is_cached = cfgrdr.build_fileconfig_cached(
+            data, filename, get_parse_cache(self.printer), includes=False)
         return ConfigWrapper(self.printer, fileconfig, {}, 'printer')
     def read_main_config(self):
         fileconfig, autosave_fileconfig = self.autosave.load_main_config()
@@ -501,6 +575,7 @@ class PrinterConfig:
         res = {'type': 'runtime_warning', 'message': msg}
         self.runtime_warnings.append(res)
         self.status_warnings = self.runtime_warnings + self.deprecate_warnings
+        self.status_version += 1
     def deprecate(self, section, option, value=None, msg=None):
         key = (section, option, value)
         if key in self.deprecated and self.deprecated[key] == msg:
@@ -517,6 +592,7 @@ class PrinterConfig:
             res['option'] = option
             self.deprecate_warnings.append(res)
         self.status_warnings = self.runtime_warnings + self.deprecate_warnings
+        self.status_version += 1
     # Status reporting
     def _build_status_config(self, config):
         self.status_raw_config = {}
@@ -524,12 +600,16 @@ class PrinterConfig:
             self.status_raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
+        self.status_version += 1
     def get_status(self, eventtime):
         status = {'config': self.status_raw_config,
                   'warnings': self.status_warnings}
         status.update(self.autosave.get_status(eventtime))
         status.update(self.validate.get_status(eventtime))
         return status
+    def get_status_version(self):
+        return (self.status_version + self.autosave.status_version
+                + self.validate.status_version)
     # Autosave functions
     def set(self, section, option, value):
         self.autosave.set(section, option, value)
@@ -109,7 +109,7 @@ class BatchWebhooksClient:
             return False
         tmp = dict(self.template)
         tmp['params'] = msg
-        self.cconn.send(tmp)
+        self.cconn.send_update(tmp)
         return True
 
 # Helper class to store incoming messages in a queue
@@ -295,3 +295,59 @@ class FixedFreqReader:
         self.clock_sync.set_last_chip_clock(seq * samples_per_block + i)
         del samples[count:]
         return samples
+
+# Read sensor_bulk_data for devices that report the mcu clock of each
+# sample (the unpack_fmt must start with the 32bit sample clock).
+class ClockedReader:
+    def __init__(self, mcu, unpack_fmt):
+        self.mcu = mcu
+        unpack = struct.Struct(unpack_fmt)
+        self.unpack_from = unpack.unpack_from
+        self.bytes_per_sample = unpack.size
+        self.last_sequence = self.last_overflows = self.lost_messages = 0
+        self.bulk_queue = self.oid = self.query_status_cmd = None
+    def setup_query_command(self, msgformat, oid, cq):
+        # Lookup sensor query command (that responds with sensor_bulk_status)
+        self.oid = oid
+        self.query_status_cmd = self.mcu.lookup_query_command(
+            msgformat, "sensor_bulk_status oid=%c clock=%u query_ticks=%u"
+            " next_sequence=%hu buffered=%u possible_overflows=%hu",
+            oid=oid, cq=cq)
+        # Read sensor_bulk_data messages and store in a queue
+        self.bulk_queue = BulkDataQueue(self.mcu, oid=oid)
+    def get_last_overflows(self):
+        return self.last_overflows + self.lost_messages
+    def note_start(self):
+        self.last_sequence = self.last_overflows = self.lost_messages = 0
+        self.bulk_queue.clear_queue()
+    def note_end(self):
+        self.bulk_queue.clear_queue()
+    # Convert sensor_bulk_data responses into list of samples
+    def pull_samples(self):
+        params = self.query_status_cmd.send([self.oid])
+        po_diff = (params['possible_overflows'] - self.last_overflows) & 0xffff
+        self.last_overflows += po_diff
+        raw_samples = self.bulk_queue.pull_queue()
+        # Load variables to optimize inner loop below
+        last_sequence = self.last_sequence
+        clock32_to_clock64 = self.mcu.clock32_to_clock64
+        clock_to_print_time = self.mcu.clock_to_print_time
+        unpack_from = self.unpack_from
+        bytes_per_sample = self.bytes_per_sample
+        samples = []
+        for params in raw_samples:
+            seq_diff = (params['sequence'] - last_sequence) & 0xffff
+            seq_diff -= (seq_diff & 0x8000) << 1
+            if seq_diff < 0:
+                # Skip stale message (eg, from before the last note_start)
+                continue
+            # Count messages that were never received
+            self.lost_messages += seq_diff
+            last_sequence += seq_diff + 1
+            data = params['data']
+            for i in range(len(data) // bytes_per_sample):
+                udata = unpack_from(data, i * bytes_per_sample)
+                ptime = clock_to_print_time(clock32_to_clock64(udata[0]))
+                samples.append((ptime,) + udata[1:])
+        self.last_sequence = last_sequence
+        return samples
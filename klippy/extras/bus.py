@@ -185,8 +185,10 @@ class MCU_I2C:
         # backward support i2c_write inside the init section
         self._to_write = []
     def _handle_connect(self):
-        for data in self._to_write:
+        for data, completion in self._to_write:
             self.i2c_write(data)
+            if completion is not None:
+                completion.complete({})
     def get_oid(self):
         return self.oid
     def get_mcu(self):
@@ -214,10 +216,26 @@ class MCU_I2C:
             cq=self.cmd_queue)
     def i2c_write(self, data, minclock=0, reqclock=0):
         if self.i2c_write_cmd is None:
-            self._to_write.append(data)
+            self._to_write.append((data, None))
             return
         self.i2c_write_cmd.send_wait_ack([self.oid, data],
                                          minclock=minclock, reqclock=reqclock)
+    def i2c_write_async(self, data, minclock=0, reqclock=0, notify=False):
+        # Queue a write on the bus command queue without waiting for
+        # the mcu. If notify is set, return a completion that is
+        # signaled once the mcu acknowledges the write.
+        if self.i2c_write_cmd is None:
+            completion = None
+            if notify:
+                completion = self.mcu.get_printer().get_reactor().completion()
+            self._to_write.append((data, completion))
+            return completion
+        if notify:
+            return self.i2c_write_cmd.send_async_ack(
+                [self.oid, data], minclock=minclock, reqclock=reqclock)
+        self.i2c_write_cmd.send([self.oid, data],
+                                minclock=minclock, reqclock=reqclock)
+        return None
     def i2c_read(self, write, read_len, retry=True):
         return self.i2c_read_cmd.send([self.oid, write, read_len], retry)
 
@@ -9,13 +9,21 @@ import logging
 class GarbageCollection:
     def __init__(self, config):
         self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        # Collection thresholds (used by the reactor's idle collections)
+        self.thresholds = [
+            config.getint('threshold%d' % (i,), default, minval=1)
+            for i, default in enumerate((700, 10, 10))]
+        self.reactor.set_gc_thresholds(*self.thresholds)
         # feature check ... freeze/unfreeze is only available in python 3.7+
         can_freeze = hasattr(gc, 'freeze') and hasattr(gc, 'unfreeze')
-        if can_freeze:
+        if can_freeze and config.getboolean('freeze', True):
             self.printer.register_event_handler("klippy:ready",
                                                 self._handle_ready)
             self.printer.register_event_handler("klippy:disconnect",
                                                 self._handle_disconnect)
+        self.printer.register_event_handler("klippy:shutdown",
+                                            self._handle_shutdown)
 
     def _handle_ready(self):
         logging.debug("Running full garbage collection and freezing")
@@ -27,5 +35,23 @@ class GarbageCollection:
         logging.debug("Unfreezing garbage collection")
         gc.unfreeze()
 
+    def _handle_shutdown(self):
+        logging.info("Reactor garbage collection pauses: %s",
+                     self.reactor.get_gc_pause_stats())
+
+    def stats(self, eventtime):
+        history = self.reactor.pop_gc_history()
+        if not history:
+            return False, ""
+        max_pauses = [0., 0., 0.]
+        for gc_time, gc_level, pause in history:
+            max_pauses[gc_level] = max(max_pauses[gc_level], pause)
+        return False, "gc: collections=%d max_pause=%.6f,%.6f,%.6f" % (
+            len(history), max_pauses[0], max_pauses[1], max_pauses[2])
+
+    def get_status(self, eventtime):
+        return {'last_pauses': self.reactor.get_gc_pause_stats(),
+                'last_times': self.reactor.get_gc_stats()}
+
 def load_config(config):
     return GarbageCollection(config)
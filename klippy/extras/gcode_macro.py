@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import traceback, logging, ast, copy, json
-import jinja2
+jinja2 = None # Imported when the first template with jinja2 syntax is loaded
 
 
 ######################################################################
@@ -44,23 +44,40 @@ class TemplateWrapper:
     def __init__(self, printer, env, name, script):
         self.printer = printer
         self.name = name
+        self.script = script
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
+        self.template = self.constant = None
+        if env is not None:
+            self._compile(env)
+        elif '{' not in script and '\r' not in script:
+            # Render a constant script as jinja2 would (without compiling it)
+            if script.endswith('\n'):
+                script = script[:-1]
+            self.constant = script
+    def _compile(self, env):
+        script = self.script
         try:
             self.template = env.from_string(script)
         except jinja2.exceptions.TemplateSyntaxError as e:
             lines = script.splitlines()
             msg = "Error loading template '%s'\nline %s: %s # %s" % (
-                name, e.lineno, lines[e.lineno-1], e.message)
+                self.name, e.lineno, lines[e.lineno-1], e.message)
             logging.exception(msg)
             raise self.gcode.error(msg)
         except Exception as e:
             msg = "Error loading template '%s': %s" % (
-                 name, traceback.format_exception_only(type(e), e)[-1])
+                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
-            raise printer.config_error(msg)
+            raise self.printer.config_error(msg)
     def render(self, context=None):
+        if self.constant is not None:
+            return self.constant
+        if self.template is None:
+            # Built-in default template - compile it on first use
+            gcode_macro = self.printer.lookup_object('gcode_macro')
+            self._compile(gcode_macro.get_env())
         if context is None:
             context = self.create_template_context()
         try:
@@ -77,14 +94,25 @@ class TemplateWrapper:
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
-        self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.env = None
+    def get_env(self):
+        global jinja2
+        if self.env is None:
+            import jinja2
+            self.env = jinja2.Environment('{%', '%}', '{', '}')
+        return self.env
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
             script = config.get(option)
         else:
             script = config.get(option, default)
-        return TemplateWrapper(self.printer, self.env, name, script)
+        # Scripts from the config file are compiled (and thus checked)
+        # now - constant scripts and built-in defaults are not
+        env = None
+        if script is not default and ('{' in script or '\r' in script):
+            env = self.get_env()
+        return TemplateWrapper(self.printer, env, name, script)
     def _action_emergency_stop(self, msg="action_emergency_stop"):
         self.printer.invoke_shutdown("Shutdown due to %s" % (msg,))
         return ""
@@ -147,6 +175,7 @@ class GCodeMacro:
                                         desc=self.cmd_SET_GCODE_VARIABLE_help)
         self.in_script = False
         self.variables = {}
+        self.status_version = 0
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
             try:
@@ -168,6 +197,8 @@ class GCodeMacro:
         self.gcode.register_command(self.alias, self.cmd, desc=self.cmd_desc)
     def get_status(self, eventtime):
         return self.variables
+    def get_status_version(self):
+        return self.status_version
     cmd_SET_GCODE_VARIABLE_help = "Set the value of a G-Code macro variable"
     def cmd_SET_GCODE_VARIABLE(self, gcmd):
         variable = gcmd.get('VARIABLE')
@@ -183,6 +214,7 @@ class GCodeMacro:
         v = dict(self.variables)
         v[variable] = literal
         self.variables = v
+        self.status_version += 1
     def cmd(self, gcmd):
         if self.in_script:
             raise gcmd.error("Macro %s called recursively" % (self.alias,))
@@ -210,6 +210,7 @@ class PrinterOutputPin:
         self.shutdown_value = config.getfloat(
             'shutdown_value', 0., minval=0., maxval=self.scale) / self.scale
         self.mcu_pin.setup_start_value(self.last_value, self.shutdown_value)
+        self.status_version = 0
         # Create gcode request queue
         self.gcrq = GCodeRequestQueue(config, self.mcu_pin.get_mcu(),
                                       self._set_pin)
@@ -223,10 +224,13 @@ class PrinterOutputPin:
                                    desc=self.cmd_SET_PIN_help)
     def get_status(self, eventtime):
         return {'value': self.last_value}
+    def get_status_version(self):
+        return self.status_version
     def _set_pin(self, print_time, value):
         if value == self.last_value:
             return "discard", 0.
         self.last_value = value
+        self.status_version += 1
         if self.is_pwm:
             self.mcu_pin.set_pwm(print_time, value)
         else:
@@ -11,6 +11,20 @@ import logging
 
 MIN_SCHEDULE_TIME = 0.100
 MAX_NOMINAL_DURATION = 3.0
+# Scheduled writes are released this long before their print_time to
+# cover the host to mcu transmit time (i2c_write has no mcu clock)
+WRITE_LEAD_TIME = 0.001
+
+REG_MODE1 = 0x00
+REG_MODE2 = 0x01
+REG_LED0 = 0x06
+REG_PRESCALE = 0xFE
+MODE1_RESTART = 0x80
+MODE1_AI = 0x20 # register auto-increment
+MODE1_SLEEP = 0x10
+MODE1_ALLCALL = 0x01
+# Channels per auto-increment write (1 + 4*13 bytes fits in an i2c_write)
+MAX_WRITE_CHANNELS = 13
 
 class PCA9685Controller:
     def __init__(self, config):
@@ -33,23 +47,48 @@ class PCA9685Controller:
         _ppins.register_chip(self.name, self)
         self._pins = {}
         self._flush_callbacks = []
+        # Channel updates waiting for flush: [(print_time, channel, regs)]
+        self._pending = []
+        self._lead_ticks = 0
+        self._shutdown_write_cmd = None
+        self._mcu.register_config_callback(self._build_config)
         self._printer.register_event_handler(
             "klippy:connect", self._handle_connect)
         self._printer.register_event_handler(
             "klippy:shutdown", self._handle_shutdown)
 
+    def _build_config(self):
+        self._lead_ticks = self._mcu.seconds_to_clock(WRITE_LEAD_TIME)
+        # Shutdown values use their own queue so they are not held
+        # behind scheduled writes
+        self._shutdown_write_cmd = self._mcu.lookup_command(
+            "i2c_write oid=%c data=%*s", cq=self._mcu.alloc_command_queue())
+
     def _handle_connect(self):
         self._init_pca9685()
         # Set initial values for registered pins
         for pin in self._pins.values():
-            pin._set_pwm_value(pin._start_value)
+            pin._set_pwm_value(pin._start_value, 0.)
+        self._send_pending(0.)
         #inject yourself into tooolheads mcu list
         self.toolhead = self._printer.lookup_object('toolhead')
         self.toolhead.all_mcus.append(self)
+        # Registered after the pins' request queues so that updates
+        # they generate during a flush are sent in the same flush
+        motion_queuing = self._printer.lookup_object('motion_queuing')
+        motion_queuing.register_flush_callback(self._flush_notification)
 
     def _handle_shutdown(self):
+        del self._pending[:]
         for pin in self._pins.values():
-            pin._set_pwm_value(pin._shutdown_value)
+            pin._set_pwm_value(pin._shutdown_value, 0.)
+        channel_regs = {channel: regs for pt, channel, regs in self._pending}
+        del self._pending[:]
+        if self._shutdown_write_cmd is None:
+            return
+        oid = self._i2c.get_oid()
+        for data in self._build_writes(channel_regs):
+            self._shutdown_write_cmd.send([oid, data])
 
     def min_schedule_time(self):
         return MIN_SCHEDULE_TIME
@@ -62,47 +101,88 @@ class PCA9685Controller:
 
     def _init_pca9685(self):
         # Full reset: MODE1 = 0x01 (ALLCALL, no SLEEP, restart enabled)
-        self._i2c.i2c_write([0x00, 0x01])
+        self._i2c.i2c_write([REG_MODE1, MODE1_ALLCALL])
         self._reactor.pause(self._reactor.monotonic() + .01)
         # Set frequency
         prescale = round(25000000.0 / (4096.0 * self._frequency)) - 1
         if prescale < 3 or prescale > 255:
             raise self._printer.config_error(
                 "PCA9685 %s: Frequency out of range"%(self.name,))
-        self._i2c.i2c_write([0x00, 0x10])
-        self._i2c.i2c_write([0xFE, prescale])
-        self._i2c.i2c_write([0x00, 0xA1])
+        self._i2c.i2c_write([REG_MODE1, MODE1_SLEEP])
+        self._i2c.i2c_write([REG_PRESCALE, prescale])
+        # Wake up with register auto-increment enabled (needed for
+        # multi-channel writes)
+        self._i2c.i2c_write([REG_MODE1,
+                             MODE1_RESTART | MODE1_AI | MODE1_ALLCALL])
         # Set MODE2: INVRT and OUTDRV from config
         mode2_value = 0
         if self._invert_output:
             mode2_value |= 0x10  # INVRT=1
         if self._totem_pole:
             mode2_value |= 0x04  # OUTDRV=1
-        self._i2c.i2c_write([0x01, mode2_value])
+        self._i2c.i2c_write([REG_MODE2, mode2_value])
         self._reactor.pause(self._reactor.monotonic() + .01)
         logging.info("PCA9685 %s: Initialized with frequency %s Hz"%(
             self.name,self._frequency))
 
-    def _set_pwm(self, channel, value):
-        base_reg = 0x06 + (4 * channel)
+    def _set_pwm(self, channel, value, print_time=None):
         # no need for fancy phase-shifting PWM
         on_time = 0  # Standard for servos
         off_time = int(min(max(value, 0), self._pwm_max))
-        on_time = 0
-        data = [ base_reg,
+        regs = [
             on_time & 0xFF,         # LEDn_ON_L
             (on_time >> 8) & 0x0F,  # LEDn_ON_H
             off_time & 0xFF,        # LEDn_OFF_L
             (off_time >> 8) & 0x0F  # LEDn_OFF_H
         ]
-        self._i2c.i2c_write(data)
+        self._queue_channel(channel, regs, print_time)
 
-    def _set_digital(self, channel, value):
-        base_reg = 0x06 + (4 * channel)
+    def _set_digital(self, channel, value, print_time=None):
         if value: # Fully on: LEDn_ON_H bit 4 (0x10)
-            self._i2c.i2c_write([base_reg, 0x00, 0x10, 0x00, 0x00])
+            regs = [0x00, 0x10, 0x00, 0x00]
         else:     # Fully off: LEDn_OFF_H bit 4 (0x10)
-            self._i2c.i2c_write([base_reg, 0x00, 0x00, 0x00, 0x10])
+            regs = [0x00, 0x00, 0x00, 0x10]
+        self._queue_channel(channel, regs, print_time)
+
+    def _queue_channel(self, channel, regs, print_time):
+        if print_time is None:
+            # Not synchronized with motion - send now
+            self._write_channels({channel: regs}, 0)
+            return
+        self._pending.append((print_time, channel, regs))
+        if self.toolhead is not None and print_time > 0.:
+            # Ensure a flush is scheduled for this update
+            self.toolhead.note_mcu_movequeue_activity(print_time,
+                                                      is_step_gen=False)
+
+    def _build_writes(self, channel_regs):
+        # Merge adjacent channels into auto-increment writes
+        writes = []
+        channels = sorted(channel_regs)
+        i = 0
+        while i < len(channels):
+            first = j = channels[i]
+            data = [REG_LED0 + 4 * first] + channel_regs[first]
+            i += 1
+            while (i < len(channels) and channels[i] == j + 1
+                   and j + 1 - first < MAX_WRITE_CHANNELS):
+                j = channels[i]
+                data += channel_regs[j]
+                i += 1
+            writes.append(data)
+        return writes
+
+    def _write_channels(self, channel_regs, clock):
+        # The mcu performs an i2c_write as soon as it is received, so
+        # hold scheduled writes in the host until just before their clock
+        minclock = 0
+        if clock:
+            minclock = max(0, clock - self._lead_ticks)
+        for data in self._build_writes(channel_regs):
+            self._i2c.i2c_write_async(data, minclock=minclock, reqclock=clock)
+
+    def _flush_notification(self, must_flush_time, max_step_gen_time):
+        self.flush_moves(must_flush_time, 0.)
 
     def print_time_to_clock(self, print_time):
         return self._mcu.print_time_to_clock(print_time)
@@ -116,6 +196,27 @@ class PCA9685Controller:
             return
         for cb in self._flush_callbacks:
             cb(flush_time, clock)
+        self._send_pending(flush_time)
+
+    def _send_pending(self, flush_time):
+        pending = self._pending
+        if not pending:
+            return
+        pending.sort(key=(lambda p: p[0]))
+        # Send updates in print_time order, one i2c transaction per
+        # group of adjacent channels updated at the same print_time
+        pos = 0
+        while pos < len(pending) and pending[pos][0] <= flush_time:
+            print_time = pending[pos][0]
+            channel_regs = {}
+            while pos < len(pending) and pending[pos][0] == print_time:
+                channel_regs[pending[pos][1]] = pending[pos][2]
+                pos += 1
+            clock = 0
+            if print_time > 0.:
+                clock = self.print_time_to_clock(print_time)
+            self._write_channels(channel_regs, clock)
+        del pending[:pos]
 
     def setup_pin(self, pin_type, pin_params):
         if pin_type != 'pwm':
@@ -183,20 +284,20 @@ class PCA9685PWMPin:
                 self._mcu.name,self.name,cycle_time,self._cycle_time))
         # Apply inversion
         effective_value = 1. - value if self._invert else value
-        self._set_pwm_value(effective_value)
+        self._set_pwm_value(effective_value, print_time)
         self._last_value = value
 
     def set_digital(self, print_time, value):
         # Invert digital value if needed
         effective_value = not value if self._invert else bool(value)
-        self._mcu._set_digital(self._channel, effective_value)
+        self._mcu._set_digital(self._channel, effective_value, print_time)
         self._last_value = 1.0 if value else 0.0
 
-    def _set_pwm_value(self, value):
+    def _set_pwm_value(self, value, print_time=None):
         # Convert Klipper's 0-1 value to PCA9685 counts
         pulse_width = value * self._cycle_time
         pwm_counts = int(pulse_width * self._mcu._frequency * self._pwm_max)
-        self._mcu._set_pwm(self._channel, pwm_counts)
+        self._mcu._set_pwm(self._channel, pwm_counts, print_time)
 
     def get_status(self, eventtime):
         return {
@@ -0,0 +1,9 @@
+# Support for valves and pumps switched in sync with the toolhead moves
+#
+# Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+from . import pneumatics
+
+def load_config_prefix(config):
+    return pneumatics.PneumaticValve(config)
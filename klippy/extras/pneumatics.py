@@ -1,17 +1,30 @@
 import os
 import logging
+from . import pwm_tool
 
 class Pneumatics:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.sensor_factories = {}
         self.gcode_id_to_sensor = {}
+        self.sensors = {}
         self.available_sensors = []
+        self.status_version = 0
         self.has_started = self.have_load_sensors = False
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
         # Register commands
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("VAC", self.cmd_VAC, when_not_ready=True)
+        gcode.register_command("WAIT_VACUUM", self.cmd_WAIT_VACUUM,
+                               desc=self.cmd_WAIT_VACUUM_help)
+        gcode.register_command("PNEUMATICS_CYCLE_BEGIN",
+                               self.cmd_PNEUMATICS_CYCLE_BEGIN,
+                               desc=self.cmd_PNEUMATICS_CYCLE_BEGIN_help)
+        gcode.register_command("PNEUMATICS_CYCLE_END",
+                               self.cmd_PNEUMATICS_CYCLE_END,
+                               desc=self.cmd_PNEUMATICS_CYCLE_END_help)
+        wh = self.printer.lookup_object('webhooks')
+        wh.register_endpoint("pneumatics/cycles", self._handle_cycles)
     def load_config(self, config):
         logging.info("pneumatics.load_config")
         self.have_load_sensors = True
@@ -43,7 +56,9 @@ class Pneumatics:
     def register_sensor(self, config, psensor, gcode_id=None):
         logging.info("register_sensor %s %s %s %s" % (
             self,config,psensor,gcode_id))
-        self.available_sensors.append(config.get_name())
+        self.available_sensors = self.available_sensors + [config.get_name()]
+        self.sensors[config.get_name().split()[-1]] = psensor
+        self.status_version += 1
         if gcode_id is None:
             gcode_id = config.get('gcode_id', None)
             if gcode_id is None:
@@ -54,6 +69,8 @@ class Pneumatics:
         self.gcode_id_to_sensor[gcode_id] = psensor
     def get_status(self, eventtime):
         return {'available_sensors': self.available_sensors}
+    def get_status_version(self):
+        return self.status_version
     def _handle_ready(self):
         self.has_started = True
     def _get_pressure(self, eventtime):
@@ -72,6 +89,127 @@ class Pneumatics:
         # did_ack = gcmd.ack(msg)
         # if not did_ack:
         gcmd.respond_raw(msg)
+    cmd_WAIT_VACUUM_help = "Wait for a pressure sensor to reach a vacuum level"
+    def cmd_WAIT_VACUUM(self, gcmd):
+        name = gcmd.get('SENSOR')
+        psensor = self.sensors.get(name)
+        if psensor is None:
+            raise gcmd.error("Unknown pressure sensor '%s'" % (name,))
+        trigger = psensor.get_pressure_trigger()
+        if trigger is None:
+            raise gcmd.error("Pressure sensor '%s' does not support"
+                             " WAIT_VACUUM" % (name,))
+        below = gcmd.get_float('BELOW')
+        timeout = gcmd.get_float('TIMEOUT', 1., above=0.)
+        trigger.setup_trigger(below - psensor.offset)
+        # Check the pressure in the mcu from the end of the queued moves
+        toolhead = self.printer.lookup_object('toolhead')
+        print_time = toolhead.get_last_move_time()
+        trigger.home_start(print_time, 0., 0, 0.)
+        trigger_time = trigger.home_wait(print_time + timeout)
+        if not trigger_time:
+            raise gcmd.error("Timeout waiting for vacuum on sensor '%s'"
+                             % (name,))
+        gcmd.respond_info("Sensor '%s' pressure %.3f after %.3fs" % (
+            name, trigger.get_trigger_pressure() + psensor.offset,
+            max(0., trigger_time - print_time)))
+    def _lookup_cycle_sensors(self, gcmd):
+        name = gcmd.get('SENSOR', None)
+        if name is None:
+            return sorted(self.sensors.items())
+        psensor = self.sensors.get(name)
+        if psensor is None:
+            raise gcmd.error("Unknown pressure sensor '%s'" % (name,))
+        return [(name, psensor)]
+    cmd_PNEUMATICS_CYCLE_BEGIN_help = "Start collecting pick cycle statistics"
+    def cmd_PNEUMATICS_CYCLE_BEGIN(self, gcmd):
+        sensors = self._lookup_cycle_sensors(gcmd)
+        threshold = gcmd.get_float('THRESHOLD', None)
+        toolhead = self.printer.lookup_object('toolhead')
+        print_time = toolhead.get_last_move_time()
+        for name, psensor in sensors:
+            if psensor.is_cycle_started():
+                raise gcmd.error("Sensor '%s' cycle already started" % (name,))
+        for name, psensor in sensors:
+            psensor.begin_cycle(print_time, threshold)
+    cmd_PNEUMATICS_CYCLE_END_help = "Finish collecting pick cycle statistics"
+    def cmd_PNEUMATICS_CYCLE_END(self, gcmd):
+        sensors = self._lookup_cycle_sensors(gcmd)
+        toolhead = self.printer.lookup_object('toolhead')
+        print_time = toolhead.get_last_move_time()
+        for name, psensor in sensors:
+            if not psensor.is_cycle_started():
+                raise gcmd.error("Sensor '%s' cycle not started" % (name,))
+        for name, psensor in sensors:
+            psensor.end_cycle(print_time)
+    def _handle_cycles(self, web_request):
+        name = web_request.get_str('sensor', None)
+        if name is None:
+            sensors = sorted(self.sensors.items())
+        elif name in self.sensors:
+            sensors = [(name, self.sensors[name])]
+        else:
+            raise web_request.error("Unknown pressure sensor '%s'" % (name,))
+        want_samples = web_request.get('samples', False, types=(bool,))
+        res = {}
+        for name, psensor in sensors:
+            cycles = psensor.get_cycles()
+            sres = {'cycles': cycles}
+            if want_samples and cycles:
+                sres['samples'] = psensor.get_cycle_samples(cycles[-1])
+            res[name] = sres
+        web_request.send(res)
+
+# Valve (or pump) output switched relative to the toolhead move queue
+class PneumaticValve:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.printer.load_object(config, 'pneumatics')
+        self.name = config.get_name().split()[-1]
+        # Updates are queued with the step data so that transitions may
+        # be closer together than the mcu minimum schedule time
+        ppins = self.printer.lookup_object('pins')
+        pin_params = ppins.lookup_pin(config.get('pin'), can_invert=True)
+        self.mcu_pin = pwm_tool.MCU_queued_pwm(config, pin_params)
+        self.mcu_pin.setup_max_duration(0.)
+        self.last_value = config.getboolean('value', False)
+        shutdown_value = config.getboolean('shutdown_value', False)
+        self.mcu_pin.setup_start_value(float(self.last_value),
+                                       float(shutdown_value))
+        self.last_print_time = 0.
+        # Register commands
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command("SET_PNEUMATIC_VALVE", "VALVE", self.name,
+                                   self.cmd_SET_PNEUMATIC_VALVE,
+                                   desc=self.cmd_SET_PNEUMATIC_VALVE_help)
+        gcode.register_mux_command("PULSE_PNEUMATIC_VALVE", "VALVE",
+                                   self.name, self.cmd_PULSE_PNEUMATIC_VALVE,
+                                   desc=self.cmd_PULSE_PNEUMATIC_VALVE_help)
+    def get_status(self, eventtime):
+        return {'value': int(self.last_value)}
+    def _set_valve(self, print_time, value):
+        print_time = max(print_time, self.last_print_time)
+        self.mcu_pin.set_pwm(print_time, float(value))
+        self.last_value = value
+        self.last_print_time = print_time
+    def _pulse_valve(self, print_time, duration):
+        value = self.last_value
+        self._set_valve(print_time, not value)
+        self._set_valve(self.last_print_time + duration, value)
+    cmd_SET_PNEUMATIC_VALVE_help = "Open or close a valve after queued moves"
+    def cmd_SET_PNEUMATIC_VALVE(self, gcmd):
+        value = gcmd.get_int('VALUE', minval=0, maxval=1) == 1
+        delay = gcmd.get_float('DELAY', 0., minval=0.)
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            lambda print_time: self._set_valve(print_time + delay, value))
+    cmd_PULSE_PNEUMATIC_VALVE_help = "Toggle a valve for a period of time"
+    def cmd_PULSE_PNEUMATIC_VALVE(self, gcmd):
+        duration = gcmd.get_float('DURATION', above=0.)
+        delay = gcmd.get_float('DELAY', 0., minval=0.)
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            lambda print_time: self._pulse_valve(print_time + delay, duration))
 
 def load_config(config):
     logging.info("pneumatics loadconfig %s" % (config.get_name()))
@@ -4,12 +4,15 @@
 # Copyright (C) 2025 Maja Stanislawska <maja@makershop.ie>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, bisect
+import logging, bisect, array
+import mcu
+from . import bulk_sensor
 
 SAMPLE_TIME = 0.001
 SAMPLE_COUNT = 8
 REPORT_TIME = 1
 RANGE_CHECK_COUNT = 4
+TRIGGER_REST_TIME = 0.001
 
 class ADCtoPressure:
     def __init__(self, config, adc_convert):
@@ -22,12 +25,52 @@ class ADCtoPressure:
         self.mcu_adc.setup_adc_callback(REPORT_TIME, self.adc_callback)
         self.diag_helper = HelperPressureDiagnostics(
             config, self.mcu_adc, adc_convert.calc_pressure)
+        self.trigger = PressureTrigger(config, self.mcu_adc, adc_convert)
+        # Bulk sample streaming
+        self.printer = config.get_printer()
+        self.mcu = self.mcu_adc.get_mcu()
+        self.bulk_oid = self.query_bulk_cmd = None
+        self.bulk_reader = bulk_sensor.ClockedReader(self.mcu, "<IH")
+        self.table = None
+        self.mcu.register_config_callback(self._build_config)
+    def _build_config(self):
+        adc_max = self.mcu.get_constant_float("ADC_MAX")
+        self.table = PressureTable(self.adc_convert.calc_pressure, adc_max)
+        cmd = "query_analog_in_bulk oid=%c rest_ticks=%u"
+        if self.mcu.try_lookup_command(cmd) is None:
+            return
+        self.bulk_oid = self.mcu.create_oid()
+        self.mcu.add_config_cmd(
+            "config_analog_in_bulk oid=%d analog_in_oid=%d"
+            % (self.bulk_oid, self.mcu_adc.get_oid()))
+        self.mcu.add_config_cmd("query_analog_in_bulk oid=%d rest_ticks=0"
+                                % (self.bulk_oid,), on_restart=True)
+        self.query_bulk_cmd = self.mcu.lookup_command(cmd)
+        self.bulk_reader.setup_query_command(
+            "query_analog_in_bulk_status oid=%c", oid=self.bulk_oid, cq=None)
+    def get_pressure_trigger(self):
+        return self.trigger
+    # Bulk sample streaming
+    def start_streaming(self, rate):
+        if self.query_bulk_cmd is None:
+            raise self.printer.command_error(
+                "Sensor '%s' mcu does not support streaming" % (self.name,))
+        self.bulk_reader.note_start()
+        rest_ticks = self.mcu.seconds_to_clock(1. / rate)
+        self.query_bulk_cmd.send([self.bulk_oid, rest_ticks])
+    def stop_streaming(self):
+        self.query_bulk_cmd.send_wait_ack([self.bulk_oid, 0])
+        self.bulk_reader.note_end()
+    def get_stream_overflows(self):
+        return self.bulk_reader.get_last_overflows()
+    def pull_pressure_samples(self):
+        return self.table.lookup_raw_samples(self.bulk_reader.pull_samples())
     def setup_pressure_callback(self, pressure_callback):
         self.pressure_callback = pressure_callback
     def get_report_time_delta(self):
         return REPORT_TIME
     def adc_callback(self, read_time, read_value):
-        val = self.adc_convert.calc_pressure(read_value)
+        val = self.table.lookup(read_value)
         # logging.info("adc_pressureadc_callback %s %s %s" % (self.name, read_value,val))
         self.pressure_callback(read_time + SAMPLE_COUNT * SAMPLE_TIME, val)
     def setup_pressure_minmax(self, min_pressure, max_pressure):
@@ -38,6 +81,110 @@ class ADCtoPressure:
                                       range_check_count=RANGE_CHECK_COUNT)
         self.diag_helper.setup_diag_minmax(min_pressure, max_pressure, min_adc, max_adc)
 
+# Dense table of the pressure at every raw ADC value.  Raw (single
+# sample) values match LinearInterpolate to float rounding.  Oversampled
+# report values fall between table entries and are interpolated, which
+# is exact except within one ADC step of an interior calibration point,
+# where the error is at most |change in gain| / (4 * ADC_MAX).
+class PressureTable:
+    def __init__(self, calc_pressure, adc_max):
+        self.adc_max = adc_max
+        self.max_index = int(adc_max)
+        inv_adc_max = 1. / adc_max
+        self.table = array.array('d', [calc_pressure(i * inv_adc_max)
+                                       for i in range(self.max_index + 1)])
+    def lookup(self, read_value):
+        pos = read_value * self.adc_max
+        index = max(0, min(self.max_index - 1, int(pos)))
+        low = self.table[index]
+        return low + (self.table[index + 1] - low) * (pos - index)
+    def lookup_raw_samples(self, samples):
+        table = self.table
+        return [(ptime, table[value]) for ptime, value in samples]
+
+# Check pressure against a threshold in the mcu and signal a trsync on a hit
+class PressureTrigger:
+    def __init__(self, config, mcu_adc, adc_convert):
+        self._printer = config.get_printer()
+        self._name = config.get_name().split()[-1]
+        self._mcu_adc = mcu_adc
+        self._mcu = mcu_adc.get_mcu()
+        self._adc_convert = adc_convert
+        self._dispatch = mcu.TriggerDispatch(self._mcu)
+        self._setup_home_cmd = self._query_home_state_cmd = None
+        self._adc_max = 1.
+        self._trigger_value = self._trigger_below = 0
+        self._trigger_pressure = 0.
+        self._mcu.register_config_callback(self._build_config)
+    def _build_config(self):
+        self._adc_max = self._mcu.get_constant_float("ADC_MAX")
+        cmd = ("analog_in_setup_home oid=%c clock=%u rest_ticks=%u"
+               " trigger_value=%hu trigger_below=%c trsync_oid=%c"
+               " trigger_reason=%c")
+        if self._mcu.try_lookup_command(cmd) is None:
+            return
+        cmd_queue = self._dispatch.get_command_queue()
+        self._setup_home_cmd = self._mcu.lookup_command(cmd, cq=cmd_queue)
+        self._query_home_state_cmd = self._mcu.lookup_query_command(
+            "query_analog_in_home_state oid=%c",
+            "analog_in_home_state oid=%c homing=%c trigger_clock=%u value=%hu",
+            oid=self._mcu_adc.get_oid(), cq=cmd_queue)
+    def setup_trigger(self, pressure, below=True):
+        if self._setup_home_cmd is None:
+            raise self._printer.command_error(
+                "Sensor '%s' mcu does not support pressure triggers"
+                % (self._name,))
+        calc_pressure = self._adc_convert.calc_pressure
+        adc = self._adc_convert.calc_adc(pressure)
+        if adc < 0. or adc > 1.:
+            raise self._printer.command_error(
+                "Pressure %.3f is outside the sensor range" % (pressure,))
+        self._trigger_value = int(adc * self._adc_max + .5)
+        rising = calc_pressure(1.) > calc_pressure(0.)
+        self._trigger_below = int(rising == below)
+    def get_trigger_pressure(self):
+        return self._trigger_pressure
+    # Interface for homing.probing_move()
+    def get_mcu(self):
+        return self._mcu
+    def add_stepper(self, stepper):
+        self._dispatch.add_stepper(stepper)
+    def get_steppers(self):
+        return self._dispatch.get_steppers()
+    def home_start(self, print_time, sample_time, sample_count, rest_time,
+                   triggered=True):
+        clock = self._mcu.print_time_to_clock(print_time)
+        rest_ticks = self._mcu.seconds_to_clock(TRIGGER_REST_TIME)
+        trigger_completion = self._dispatch.start(print_time)
+        self._setup_home_cmd.send(
+            [self._mcu_adc.get_oid(), clock, rest_ticks, self._trigger_value,
+             self._trigger_below, self._dispatch.get_oid(),
+             mcu.MCU_trsync.REASON_ENDSTOP_HIT], reqclock=clock)
+        return trigger_completion
+    def home_wait(self, home_end_time):
+        self._dispatch.wait_end(home_end_time)
+        oid = self._mcu_adc.get_oid()
+        self._setup_home_cmd.send([oid, 0, 0, 0, 0, 0, 0])
+        res = self._dispatch.stop()
+        if res >= mcu.MCU_trsync.REASON_COMMS_TIMEOUT:
+            raise self._printer.command_error(
+                "Communication timeout during homing")
+        if res != mcu.MCU_trsync.REASON_ENDSTOP_HIT:
+            return 0.
+        if self._mcu.is_fileoutput():
+            return home_end_time
+        params = self._query_home_state_cmd.send([oid])
+        self._trigger_pressure = self._adc_convert.calc_pressure(
+            params['value'] / self._adc_max)
+        tclock = self._mcu.clock32_to_clock64(params['trigger_clock'])
+        return self._mcu.clock_to_print_time(tclock)
+    def query_endstop(self, print_time):
+        last_value, last_read_time = self._mcu_adc.get_last_value()
+        value = last_value * self._adc_max
+        if self._trigger_below:
+            return value < self._trigger_value
+        return value > self._trigger_value
+
 # Tool to register with query_adc and report extra info on ADC range errors
 class HelperPressureDiagnostics:
     def __init__(self, config, mcu_adc, calc_pressure_cb):
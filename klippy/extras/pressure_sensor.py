@@ -1,4 +1,74 @@
-import logging
+import logging, array, collections
+from . import bulk_sensor
+
+# Fixed size ring buffer of timestamped pressure samples
+class PressureHistory:
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', [0.]) * size
+        self.pressures = array.array('d', [0.]) * size
+        self.count = 0
+    def add_samples(self, samples):
+        times, pressures, size = self.times, self.pressures, self.size
+        pos = self.count % size
+        for ptime, pressure in samples:
+            times[pos] = ptime
+            pressures[pos] = pressure
+            pos += 1
+            if pos >= size:
+                pos = 0
+        self.count += len(samples)
+    def get_samples(self, start_time, end_time):
+        count = min(self.count, self.size)
+        first = self.count - count
+        times, pressures, size = self.times, self.pressures, self.size
+        return [(times[i % size], pressures[i % size])
+                for i in range(first, self.count)
+                if start_time <= times[i % size] <= end_time]
+
+# Aggregate statistics of a single pick cycle (updated per sample)
+class PneumaticCycle:
+    def __init__(self, index, start_time, threshold):
+        self.index = index
+        self.start_time = start_time
+        self.end_time = None
+        self.threshold = threshold
+        self.sample_count = 0
+        self.min_pressure = self.min_time = self.threshold_time = None
+        # Linear regression of the pressure after the threshold is reached
+        self.decay_sums = [0] * 5
+    def add_sample(self, ptime, pressure):
+        self.sample_count += 1
+        if self.min_pressure is None or pressure < self.min_pressure:
+            self.min_pressure = pressure
+            self.min_time = ptime
+        if self.threshold_time is None:
+            if self.threshold is None or pressure > self.threshold:
+                return
+            self.threshold_time = ptime
+        rtime = ptime - self.threshold_time
+        sums = self.decay_sums
+        sums[0] += 1
+        sums[1] += rtime
+        sums[2] += pressure
+        sums[3] += rtime * rtime
+        sums[4] += rtime * pressure
+    def get_stats(self):
+        time_to_threshold = decay_rate = None
+        if self.threshold_time is not None:
+            time_to_threshold = self.threshold_time - self.start_time
+            n, st, sp, stt, stp = self.decay_sums
+            denom = n * stt - st * st
+            if n >= 2 and denom > 0.:
+                decay_rate = (n * stp - st * sp) / denom
+        return {'index': self.index, 'start_time': self.start_time,
+                'end_time': self.end_time, 'samples': self.sample_count,
+                'threshold': self.threshold,
+                'min_pressure': self.min_pressure,
+                'time_to_min': (None if self.min_time is None
+                                else self.min_time - self.start_time),
+                'time_to_threshold': time_to_threshold,
+                'decay_rate': decay_rate}
 
 class PressureSensorGeneric:
     def __init__(self, config):
@@ -12,9 +82,35 @@ class PressureSensorGeneric:
                                             above=self.min_pressure)
         self.report_interval = config.getfloat('report_interval', 1.0,
                                                     minval=0.1)
-        self.sensor.setup_minmax(self.min_pressure, self.max_pressure)
+        self.sensor.setup_pressure_minmax(self.min_pressure, self.max_pressure)
         self.sensor.setup_pressure_callback(self.pressure_callback)
         pneu.register_sensor(config, self)#, self.gcode_id)
+        # Bulk pressure streaming
+        self.batch_bulk = None
+        if hasattr(self.sensor, 'start_streaming'):
+            max_rate = 1000.
+            if hasattr(self.sensor, 'get_max_stream_rate'):
+                max_rate = self.sensor.get_max_stream_rate() or max_rate
+            self.stream_rate = config.getfloat('stream_rate', max_rate,
+                                               above=0., maxval=max_rate)
+            self.batch_bulk = bulk_sensor.BatchBulkHelper(
+                self.printer, self._process_batch, self._start_streaming,
+                self.sensor.stop_streaming)
+            hdr = ('time', 'pressure')
+            self.batch_bulk.add_mux_endpoint("pneumatics/dump_pressure",
+                                             "sensor", self.name,
+                                             {'header': hdr})
+        # Sample history and pick cycle statistics
+        self.history = PressureHistory(
+            config.getint('history_size', 4096, minval=16))
+        self.cycle_threshold = config.getfloat('cycle_threshold', None)
+        self.cycles = collections.deque(
+            maxlen=config.getint('cycle_history', 50, minval=1))
+        self.open_cycles = collections.deque()
+        self.cycle_count = 0
+        self.last_cycle = {}
+        self.cycle_streaming = False
+        self.cycle_stream_ok = True
         self.last_pressure = 0.
         self.measured_min = 99999999.
         self.measured_max = -99999999.
@@ -38,8 +134,86 @@ class PressureSensorGeneric:
             self.last_pressure = pressure +self.offset
             self.measured_min = min(self.measured_min, self.last_pressure)
             self.measured_max = max(self.measured_max, self.last_pressure)
+            if not self.cycle_streaming:
+                self._note_samples([(read_time, self.last_pressure)])
+    def _note_samples(self, samples):
+        self.history.add_samples(samples)
+        open_cycles = self.open_cycles
+        if not open_cycles:
+            return
+        for ptime, pressure in samples:
+            while open_cycles:
+                cycle = open_cycles[0]
+                if cycle.end_time is None or ptime <= cycle.end_time:
+                    break
+                self._finish_cycle(open_cycles.popleft())
+            if not open_cycles:
+                break
+            if ptime >= open_cycles[0].start_time:
+                open_cycles[0].add_sample(ptime, pressure)
+    def _finish_cycle(self, cycle):
+        self.last_cycle = cycle.get_stats()
+        self.cycles.append(self.last_cycle)
+    def _handle_cycle_batch(self, msg):
+        if not self.open_cycles:
+            self.cycle_streaming = False
+            return False
+        self._note_samples(msg['data'])
+        return True
+    # Pick cycle tracking
+    def is_cycle_started(self):
+        return bool(self.open_cycles) and self.open_cycles[-1].end_time is None
+    def begin_cycle(self, print_time, threshold=None):
+        if self.is_cycle_started():
+            raise self.printer.command_error(
+                "Sensor '%s' cycle already started" % (self.name,))
+        if threshold is None:
+            threshold = self.cycle_threshold
+        if (self.batch_bulk is not None and self.cycle_stream_ok
+            and not self.cycle_streaming):
+            try:
+                self.batch_bulk.add_client(self._handle_cycle_batch)
+            except self.printer.command_error as e:
+                # Collect statistics from the periodic reports instead
+                logging.info("Sensor '%s' unable to stream pick cycles: %s",
+                             self.name, str(e))
+                self.cycle_stream_ok = False
+            else:
+                self.cycle_streaming = True
+        self.cycle_count += 1
+        self.open_cycles.append(
+            PneumaticCycle(self.cycle_count, print_time, threshold))
+    def end_cycle(self, print_time):
+        if not self.is_cycle_started():
+            raise self.printer.command_error(
+                "Sensor '%s' cycle not started" % (self.name,))
+        self.open_cycles[-1].end_time = print_time
+    def get_cycles(self):
+        return list(self.cycles)
+    def get_cycle_samples(self, cycle):
+        return self.history.get_samples(cycle['start_time'],
+                                        cycle['end_time'])
     def get_pressure(self, eventtime):
         return self.last_pressure, 0.
+    def _start_streaming(self):
+        self.sensor.start_streaming(self.stream_rate)
+    def _process_batch(self, eventtime):
+        samples = self.sensor.pull_pressure_samples()
+        if not samples:
+            return {}
+        offset = self.offset
+        return {'data': [(ptime, pressure + offset)
+                         for ptime, pressure in samples],
+                'errors': 0, 'overflows': self.sensor.get_stream_overflows()}
+    def add_pressure_client(self, cb):
+        if self.batch_bulk is None:
+            raise self.printer.config_error(
+                "Sensor '%s' does not support streaming" % (self.name,))
+        self.batch_bulk.add_client(cb)
+    def get_pressure_trigger(self):
+        if not hasattr(self.sensor, 'get_pressure_trigger'):
+            return None
+        return self.sensor.get_pressure_trigger()
     def temperature_callback(self, read_time, temp):
         self.last_temp = temp
         if temp:
@@ -55,7 +229,9 @@ class PressureSensorGeneric:
     def get_status(self, eventtime):
         ret={'pressure': round(self.last_pressure, 2),
              'measured_min_pressure': round(self.measured_min, 5),
-             'measured_max_pressure': round(self.measured_max, 5)}
+             'measured_max_pressure': round(self.measured_max, 5),
+             'cycle_count': self.cycle_count,
+             'last_cycle': self.last_cycle}
         if self.have_temp:
             ret.update({
             'temperature': round(self.last_temp, 2),
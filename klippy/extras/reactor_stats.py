@@ -0,0 +1,30 @@
+# Reporting of reactor callback timing statistics
+#
+# Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+class ReactorStatsReport:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.report_count = config.getint('report_count', 3, minval=0)
+        # Instrumentation is only enabled when this module is loaded
+        reactor = self.printer.get_reactor()
+        self.reactor_stats = reactor.enable_stats()
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint("reactor/stats", self._handle_stats)
+    def _handle_stats(self, web_request):
+        stats = self.reactor_stats.get_stats()
+        if web_request.get('reset', False):
+            self.reactor_stats.reset()
+        web_request.send(stats)
+    def stats(self, eventtime):
+        worst, max_late = self.reactor_stats.get_period_worst(
+            self.report_count)
+        if not worst:
+            return False, ""
+        out = ["%s=%.6f" % (name, elapsed) for name, elapsed in worst]
+        return False, "reactor: max_late=%.6f %s" % (max_late, " ".join(out))
+
+def load_config(config):
+    return ReactorStatsReport(config)
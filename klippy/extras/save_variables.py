@@ -11,6 +11,7 @@ class SaveVariables:
         self.printer = config.get_printer()
         self.filename = os.path.expanduser(config.get('filename'))
         self.allVariables = {}
+        self.status_version = 0
         try:
             if not os.path.exists(self.filename):
                 open(self.filename, "w").close()
@@ -33,6 +34,7 @@ class SaveVariables:
             logging.exception(msg)
             raise self.printer.command_error(msg)
         self.allVariables = allvars
+        self.status_version += 1
     cmd_SAVE_VARIABLE_help = "Save arbitrary variables to disk"
     def cmd_SAVE_VARIABLE(self, gcmd):
         varname = gcmd.get('VARIABLE')
@@ -61,6 +63,8 @@ class SaveVariables:
         self.loadVariables()
     def get_status(self, eventtime):
         return {'variables': self.allVariables}
+    def get_status_version(self):
+        return self.status_version
 
 def load_config(config):
     return SaveVariables(config)
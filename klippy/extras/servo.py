@@ -19,6 +19,7 @@ class PrinterServo:
         self.angle_to_width = (self.max_width - self.min_width) / self.max_angle
         self.width_to_value = 1. / SERVO_SIGNAL_PERIOD
         self.last_value = 0.
+        self.status_version = 0
         initial_pwm = 0.
         iangle = config.getfloat('initial_angle', None, minval=0., maxval=360.)
         if iangle is not None:
@@ -44,10 +45,13 @@ class PrinterServo:
                                    desc=self.cmd_SET_SERVO_help)
     def get_status(self, eventtime):
         return {'value': self.last_value}
+    def get_status_version(self):
+        return self.status_version
     def _set_pwm(self, print_time, value):
         if value == self.last_value:
             return "discard", 0.
         self.last_value = value
+        self.status_version += 1
         self.mcu_servo.set_pwm(print_time, value)
     def _get_pwm_from_angle(self, angle):
         angle = max(0., min(self.max_angle, angle))
@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import psutil, time, logging
+import time, logging
 
 class PrinterSysStats:
     def __init__(self, config):
@@ -13,6 +13,7 @@ class PrinterSysStats:
         self.last_mem_avail = 0
 
     def stats(self, eventtime):
+        import psutil # Imported here to reduce startup time
         # Get core usage stats
         ptime = time.process_time()
         pdiff = ptime - self.last_process_time
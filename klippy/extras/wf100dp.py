@@ -5,7 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-from . import bus
+from . import bus, bulk_sensor
 import logging
 
 class WF100DPSensor:
@@ -31,6 +31,10 @@ class WF100DPSensor:
         self._i2c = bus.MCU_I2C_from_config(config, self._i2c_addr)
         self._mcu = self._i2c.get_mcu()
         self.sample_timer = self._reactor.register_timer(self._sample)
+        # Bulk sample streaming
+        self._oid = self._query_bulk_cmd = None
+        self._bulk_reader = bulk_sensor.ClockedReader(self._mcu, "<I3B")
+        self._mcu.register_config_callback(self._build_config)
         self._printer.register_event_handler("klippy:connect", self._handle_connect)
         self._printer.register_event_handler("klippy:shutdown", self._handle_shutdown)
 
@@ -45,6 +49,20 @@ class WF100DPSensor:
                                       else 10 ) # Default 10s for 0s
         self._reactor.update_timer(self.sample_timer, self._reactor.NOW)
 
+    def _build_config(self):
+        cmd = "query_wf100dp oid=%c rest_ticks=%u"
+        if self._mcu.try_lookup_command(cmd) is None:
+            return
+        self._oid = self._mcu.create_oid()
+        self._mcu.add_config_cmd("config_wf100dp oid=%d i2c_oid=%d"
+                                 % (self._oid, self._i2c.get_oid()))
+        self._mcu.add_config_cmd("query_wf100dp oid=%d rest_ticks=0"
+                                 % (self._oid,), on_restart=True)
+        cmdqueue = self._i2c.get_command_queue()
+        self._query_bulk_cmd = self._mcu.lookup_command(cmd, cq=cmdqueue)
+        self._bulk_reader.setup_query_command(
+            "query_wf100dp_status oid=%c", oid=self._oid, cq=cmdqueue)
+
     def _handle_shutdown(self):
         self._reactor.update_timer(self.sample_timer, self._reactor.NEVER)
 
@@ -62,11 +80,40 @@ class WF100DPSensor:
         self._last_pressure=((press * self.pm)/float(1<<23)) + self.po
         temp=float(int.from_bytes(data[3:],'big',signed=True))
         self._last_temp=(temp + self.to) / self.td
+        print_time = self._mcu.estimated_print_time(eventtime)
         if self._pressure_callback:
-            self._pressure_callback(eventtime, self._last_pressure)
+            self._pressure_callback(print_time, self._last_pressure)
         if self._temp_callback:
-            self._temp_callback(eventtime, self._last_temp)
+            self._temp_callback(print_time, self._last_temp)
         return eventtime + self._sample_interval
+    # Bulk sample streaming
+    def get_max_stream_rate(self):
+        # The chip only converts a new sample once per sleep_time, so
+        # polling it faster would just report the same value again
+        if not self._sleep_time:
+            return None
+        return 1. / (self._sleep_time * 0.0625)
+    def start_streaming(self, rate):
+        if self._query_bulk_cmd is None:
+            raise self._printer.command_error(
+                "Sensor '%s' mcu does not support streaming" % (self.name,))
+        self._bulk_reader.note_start()
+        rest_ticks = self._mcu.seconds_to_clock(1. / rate)
+        self._query_bulk_cmd.send([self._oid, rest_ticks])
+    def stop_streaming(self):
+        self._query_bulk_cmd.send_wait_ack([self._oid, 0])
+        self._bulk_reader.note_end()
+    def get_stream_overflows(self):
+        return self._bulk_reader.get_last_overflows()
+    def pull_pressure_samples(self):
+        pm = self.pm / float(1<<23)
+        po = self.po
+        samples = []
+        for ptime, d0, d1, d2 in self._bulk_reader.pull_samples():
+            press = (d0 << 16) | (d1 << 8) | d2
+            press -= (press & 0x800000) << 1
+            samples.append((ptime, press * pm + po))
+        return samples
     def setup_callback(self, cb):
         self._temp_callback = cb
     def setup_pressure_callback(self, cb):
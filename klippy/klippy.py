@@ -22,6 +22,43 @@ command to reload the config and restart the host software.
 Printer is halted
 """
 
+# Record the time spent in each startup step (--profile-startup)
+class StartupProfile:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.start_time = reactor.monotonic()
+        self.depth = 0
+        self.timeline = []
+    def call(self, category, name, func, *args):
+        if name is None:
+            obj = getattr(func, '__self__', None)
+            name = getattr(func, '__name__', str(func))
+            if obj is not None:
+                name = "%s.%s" % (obj.__class__.__name__, name)
+        entry = [self.reactor.monotonic() - self.start_time, 0.,
+                 self.depth, category, name]
+        self.timeline.append(entry)
+        self.depth += 1
+        try:
+            return func(*args)
+        finally:
+            self.depth -= 1
+            entry[1] = (self.reactor.monotonic() - self.start_time
+                        - entry[0])
+    def log(self, state):
+        total = self.reactor.monotonic() - self.start_time
+        out = ["Startup profile (%s after %.3fs):" % (state, total),
+               "   start duration"]
+        hidden = 0
+        for start, duration, depth, category, name in self.timeline:
+            if duration < .001:
+                hidden += 1
+                continue
+            out.append("%8.3f %8.3f %s%s %s" % (start, duration, "  " * depth,
+                                               category, name))
+        out.append("(%d steps under 1ms not shown)" % (hidden,))
+        logging.info("\n".join(out))
+
 class Printer:
     config_error = configfile.error
     command_error = gcode.CommandError
@@ -35,6 +72,9 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        self.profile = None
+        if start_args.get('profile_startup'):
+            self.profile = StartupProfile(main_reactor)
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
@@ -67,6 +107,10 @@ class Printer:
             return
         self.state_message = newmsg
         logging.error(newmsg)
+    def _profile(self, category, name, func, *args):
+        if self.profile is None:
+            return func(*args)
+        return self.profile.call(category, name, func, *args)
     def add_object(self, name, obj):
         if name in self.objects:
             raise self.config_error(
@@ -100,7 +144,8 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
-        mod = importlib.import_module('extras.' + module_name)
+        mod = self._profile("import", module_name, importlib.import_module,
+                            'extras.' + module_name)
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
@@ -109,30 +154,37 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
-        self.objects[section] = init_func(config.getsection(section))
+        self.objects[section] = self._profile(
+            "load", section, init_func, config.getsection(section))
         return self.objects[section]
     def _read_config(self):
         self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
-        config = pconfig.read_main_config()
+        config = self._profile("config", "read_main_config",
+                               pconfig.read_main_config)
         if self.bglogger is not None:
             pconfig.log_config(config)
         # Create printer components
         for m in [pins, mcu]:
-            m.add_printer_objects(config)
+            self._profile("load", m.__name__, m.add_printer_objects, config)
         for section_config in config.get_prefix_sections(''):
             self.load_object(config, section_config.get_name(), None)
         for m in [toolhead]:
-            m.add_printer_objects(config)
+            self._profile("load", m.__name__, m.add_printer_objects, config)
         # Validate that there are no undefined parameters in the config file
         pconfig.check_unused_options(config)
     def _connect(self, eventtime):
+        self._connect_printer()
+        if self.profile is not None:
+            self.profile.log(self.get_state_message()[1])
+    def _connect_printer(self):
         try:
             self._read_config()
-            self.send_event("klippy:mcu_identify")
+            for cb in self.event_handlers.get("klippy:mcu_identify", []):
+                self._profile("identify", None, cb)
             for cb in self.event_handlers.get("klippy:connect", []):
                 if self.state_message is not message_startup:
                     return
-                cb()
+                self._profile("connect", None, cb)
         except (self.config_error, pins.error) as e:
             logging.exception("Config error")
             self._set_state("%s\n%s" % (str(e), message_restart))
@@ -161,7 +213,7 @@ class Printer:
             for cb in self.event_handlers.get("klippy:ready", []):
                 if self.state_message is not message_ready:
                     return
-                cb()
+                self._profile("ready", None, cb)
         except Exception as e:
             logging.exception("Unhandled exception during ready callback")
             self.invoke_shutdown("Internal error during ready callback: %s"
@@ -191,6 +243,8 @@ class Printer:
         try:
             if run_result == 'firmware_restart':
                 self.send_event("klippy:firmware_restart")
+            elif run_result == 'restart':
+                self.send_event("klippy:restart")
             self.send_event("klippy:disconnect")
         except:
             logging.exception("Unhandled exception during post run")
@@ -274,6 +328,11 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("--reactor", dest="reactor", type="choice",
+                    choices=sorted(reactor.REACTORS),
+                    help="reactor implementation (select, poll, or epoll)")
+    opts.add_option("--profile-startup", action="store_true",
+                    help="log the time spent in each startup step")
     opts.add_option("--import-test", action="store_true",
                     help="perform an import module test")
     options, args = opts.parse_args()
@@ -282,7 +341,8 @@ def main():
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     start_args = {'config_file': args[0], 'apiserver': options.apiserver,
-                  'start_reason': 'startup'}
+                  'start_reason': 'startup', 'reactor': options.reactor,
+                  'profile_startup': options.profile_startup}
 
     debuglevel = logging.INFO
     if options.verbose:
@@ -341,19 +401,27 @@ def main():
     gc.disable()
 
     # Start Printer() class
+    main_reactor = None
     while 1:
         if bglogger is not None:
             bglogger.clear_rollover_info()
             bglogger.set_rollover_info('versions', versions)
         gc.collect()
-        main_reactor = reactor.Reactor(gc_checking=True)
+        prev_reactor = main_reactor
+        reactor_class = reactor.lookup_reactor(start_args['reactor'])
+        main_reactor = reactor_class(gc_checking=True)
+        if prev_reactor is not None:
+            mcu.move_sessions(start_args, main_reactor)
+            prev_reactor.finalize()
+            prev_reactor = None
         printer = Printer(main_reactor, bglogger, start_args)
         res = printer.run()
         if res in ['exit', 'error_exit']:
+            mcu.move_sessions(start_args, None)
             break
-        time.sleep(1.)
-        main_reactor.finalize()
-        main_reactor = printer = None
+        if not start_args.get('mcu_sessions'):
+            time.sleep(1.)
+        printer = None
         logging.info("Restarting printer")
         start_args['start_reason'] = res
 
@@ -95,12 +95,22 @@ class CommandWrapper:
         if debugoutput:
             # Can't use send_wait_ack when in debugging mode
             self.send_wait_ack = self.send
+            self.send_async_ack = self._send_async_ack_debug
     def send(self, data=(), minclock=0, reqclock=0):
         cmd = self._cmd.encode(data)
         self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
     def send_wait_ack(self, data=(), minclock=0, reqclock=0):
         cmd = self._cmd.encode(data)
         self._serial.raw_send_wait_ack(cmd, minclock, reqclock, self._cmd_queue)
+    def send_async_ack(self, data=(), minclock=0, reqclock=0):
+        cmd = self._cmd.encode(data)
+        return self._serial.raw_send_async_ack(cmd, minclock, reqclock,
+                                               self._cmd_queue)
+    def _send_async_ack_debug(self, data=(), minclock=0, reqclock=0):
+        self.send(data, minclock, reqclock)
+        completion = self._serial.get_reactor().completion()
+        completion.complete({})
+        return completion
     def get_command_tag(self):
         return self._msgtag
 
@@ -503,6 +513,8 @@ class MCU_adc:
         self._inv_max_adc = 0.
     def get_mcu(self):
         return self._mcu
+    def get_oid(self):
+        return self._oid
     def setup_adc_sample(self, sample_time, sample_count,
                          minval=0., maxval=1., range_check_count=0):
         self._sample_time = sample_time
@@ -583,6 +595,14 @@ class MCU:
             if not (self._serialport.startswith("/dev/rpmsg_")
                     or self._serialport.startswith("/tmp/klipper_host_")):
                 self._baud = config.getint('baud', 250000, minval=2400)
+        # Data dictionary cache
+        cache_dir = config.get('dictionary_cache', None)
+        if cache_dir:
+            cache_name = "".join([c if c.isalnum() else '_' for c in name])
+            self._serial.set_identify_cache(os.path.join(
+                os.path.expanduser(cache_dir), "mcu_%s.dict" % (cache_name,)))
+        self._warm_restart = config.getboolean('warm_restart', False)
+        self._keep_session = False
         # Restarts
         restart_methods = [None, 'arduino', 'cheetah', 'command', 'rpi_usb']
         self._restart_method = 'command'
@@ -623,6 +643,7 @@ class MCU:
                                        self._mcu_identify)
         printer.register_event_handler("klippy:connect", self._connect)
         printer.register_event_handler("klippy:shutdown", self._shutdown)
+        printer.register_event_handler("klippy:restart", self._restart)
         printer.register_event_handler("klippy:disconnect", self._disconnect)
         printer.register_event_handler("klippy:ready", self._ready)
     # Serial callbacks
@@ -782,10 +803,25 @@ class MCU:
         logging.info(move_msg)
         log_info = self._log_info() + "\n" + move_msg
         self._printer.set_rollover_info(self._name, log_info, log=False)
+    def _resume_session(self):
+        # Reuse a connection kept open over a host restart
+        sessions = self._printer.get_start_args().get('mcu_sessions', {})
+        session = sessions.pop(self._name, None)
+        if session is None:
+            return False
+        serialport, serial, prev_sync = session
+        if not self._warm_restart or serialport != self._serialport:
+            serial.disconnect()
+            return False
+        serial.resume_session(self._serial)
+        self._serial = serial
+        self._clocksync.resume(serial, prev_sync)
+        logging.info("Resuming MCU '%s' connection", self._name)
+        return True
     def _mcu_identify(self):
         if self.is_fileoutput():
             self._connect_file()
-        else:
+        elif not self._resume_session():
             resmeth = self._restart_method
             if resmeth == 'rpi_usb' and not os.path.exists(self._serialport):
                 # Try toggling usb power
@@ -917,8 +953,21 @@ class MCU:
     def clock32_to_clock64(self, clock32):
         return self._clocksync.clock32_to_clock64(clock32)
     # Restarts
+    def _restart(self):
+        # Keep the connection open for the next host instance if possible
+        if (not self._warm_restart or self._steppersync is None
+            or self._is_shutdown or self._is_timeout
+            or self._printer.is_shutdown()
+            or not self._clocksync.is_active()):
+            return
+        sessions = self._printer.get_start_args().setdefault(
+            'mcu_sessions', {})
+        sessions[self._name] = (self._serialport, self._serial,
+                                self._clocksync)
+        self._keep_session = True
     def _disconnect(self):
-        self._serial.disconnect()
+        if not self._keep_session:
+            self._serial.disconnect()
         self._steppersync = None
     def _shutdown(self, force=False):
         if (self._emergency_stop_cmd is None
@@ -1014,6 +1063,19 @@ def add_printer_objects(config):
     for s in config.get_prefix_sections('mcu '):
         printer.add_object(s.section, MCU(
             s, clocksync.SecondarySync(reactor, mainsync)))
+    # Close any kept connection not claimed by an mcu in the new config
+    printer.register_event_handler(
+        "klippy:connect", lambda: move_sessions(printer.get_start_args(), None))
+
+# Move the mcu connections kept by a warm restart to a new reactor
+def move_sessions(start_args, reactor):
+    sessions = start_args.get('mcu_sessions', {})
+    for name, (serialport, serial, prev_sync) in list(sessions.items()):
+        if reactor is None or start_args.get('start_reason') != 'restart':
+            serial.disconnect()
+            del sessions[name]
+        else:
+            serial.set_reactor(reactor)
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
@@ -3,17 +3,27 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, heapq, bisect, collections
 import greenlet
 import chelper, util
 
 _NOW = 0.
 _NEVER = 9999999999999999.
 
+# Only run an idle collection if the next timer is further away than
+# this multiple of the last pause of the same generation
+GC_IDLE_MARGIN = 2.
+# Collect regardless of pending timers once this many thresholds are due
+GC_FORCE_FACTOR = 4
+
 class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        self.heap_entry = None
+        self.is_registered = True
+        self.last_pass = 0
+        self.stats_name = None
 
 class ReactorCompletion:
     class sentinel: pass
@@ -62,6 +72,86 @@ class ReactorGreenlet(greenlet.greenlet):
         greenlet.greenlet.__init__(self, run=run)
         self.timer = None
 
+# Upper bounds (in seconds) of the timer lateness histogram buckets
+LATE_BUCKETS = [.001, .002, .005, .010, .025, .050, .100, .250]
+
+def _callback_name(callback):
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, ReactorCallback):
+        callback = owner.callback
+    callback = getattr(callback, 'func', callback) # functools.partial
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+# Optional instrumentation of reactor callbacks
+class ReactorStats:
+    def __init__(self, reactor):
+        self.monotonic = reactor.monotonic
+        self.cur_name = None
+        self.cur_start = 0.
+        self.reset()
+    def reset(self):
+        self.callbacks = {}
+        self.late_counts = [0] * (len(LATE_BUCKETS) + 1)
+        self.max_late = self.period_max_late = 0.
+        self.period_max = {}
+    def _start(self, name):
+        self.cur_name = name
+        self.cur_start = self.monotonic()
+    def stop(self):
+        # Account the time of the currently running callback (called on
+        # return and when the callback pauses its greenlet)
+        name = self.cur_name
+        if name is None:
+            return None
+        self.cur_name = None
+        elapsed = self.monotonic() - self.cur_start
+        cs = self.callbacks.get(name)
+        if cs is None:
+            cs = self.callbacks[name] = [0, 0., 0.]
+        cs[0] += 1
+        cs[1] += elapsed
+        if elapsed > cs[2]:
+            cs[2] = elapsed
+        if elapsed > self.period_max.get(name, 0.):
+            self.period_max[name] = elapsed
+        return name
+    def run_timer(self, timer_handler, waketime, eventtime):
+        if waketime > _NOW:
+            late = eventtime - waketime
+            self.late_counts[bisect.bisect(LATE_BUCKETS, late)] += 1
+            if late > self.period_max_late:
+                self.period_max_late = late
+                if late > self.max_late:
+                    self.max_late = late
+        name = timer_handler.stats_name
+        if name is None:
+            name = _callback_name(timer_handler.callback)
+            timer_handler.stats_name = name
+        self._start(name)
+        res = timer_handler.callback(eventtime)
+        self.stop()
+        return res
+    def run_fd(self, callback, eventtime):
+        self._start(_callback_name(callback))
+        callback(eventtime)
+        self.stop()
+    def get_stats(self):
+        callbacks = {name: {'count': cs[0], 'total_time': round(cs[1], 6),
+                            'max_time': round(cs[2], 6)}
+                     for name, cs in self.callbacks.items()}
+        names = ["<%dms" % (b * 1000.,) for b in LATE_BUCKETS]
+        names.append(">=%dms" % (LATE_BUCKETS[-1] * 1000.,))
+        return {'callbacks': callbacks,
+                'timer_late_histogram': dict(zip(names, self.late_counts)),
+                'timer_max_late': round(self.max_late, 6)}
+    def get_period_worst(self, count):
+        # Return the slowest callbacks (and max lateness) since last call
+        worst = sorted(self.period_max.items(), key=(lambda i: -i[1]))
+        max_late = self.period_max_late
+        self.period_max = {}
+        self.period_max_late = 0.
+        return worst[:count], max_late
+
 class ReactorMutex:
     def __init__(self, reactor, is_locked):
         self.reactor = reactor
@@ -101,12 +191,20 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
-        self._timers = []
+        self._last_gc_pauses = [0., 0., 0.]
+        self._gc_thresholds = (700, 10, 10)
+        # Recent collections: (eventtime, generation, pause duration)
+        self._gc_history = collections.deque(maxlen=256)
+        # Timers (heap of [waketime, sequence, timer] entries)
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_stale = 0
+        self._timer_pass = 0
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
-        self._async_queue = queue.Queue()
+        self._async_queue = collections.deque()
+        self._async_pending = False
         # File descriptors
         self._read_fds = []
         self._write_fds = []
@@ -114,54 +212,136 @@ class SelectReactor:
         self._g_dispatch = None
         self._greenlets = []
         self._all_greenlets = []
+        # Instrumentation
+        self._stats = None
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def get_gc_pause_stats(self):
+        return tuple(self._last_gc_pauses)
+    def pop_gc_history(self):
+        history = list(self._gc_history)
+        self._gc_history.clear()
+        return history
+    def set_gc_thresholds(self, threshold0, threshold1, threshold2):
+        self._gc_thresholds = (threshold0, threshold1, threshold2)
+        gc.set_threshold(threshold0, threshold1, threshold2)
+    def enable_stats(self):
+        if self._stats is None:
+            self._stats = ReactorStats(self)
+        return self._stats
+    def get_stats(self):
+        return self._stats
     # Timers
+    def _schedule_timer(self, timer_handler, waketime):
+        entry = timer_handler.heap_entry
+        if entry is not None:
+            if entry[0] == waketime:
+                return
+            # Leave the old heap entry in place, but mark it as stale
+            entry[2] = None
+            timer_handler.heap_entry = None
+            self._timer_stale += 1
+        if waketime >= self.NEVER or not timer_handler.is_registered:
+            return
+        self._timer_seq += 1
+        entry = [waketime, self._timer_seq, timer_handler]
+        timer_handler.heap_entry = entry
+        heap = self._timer_heap
+        heapq.heappush(heap, entry)
+        if self._timer_stale > 64 and self._timer_stale * 2 > len(heap):
+            # Too many stale entries - rebuild heap (in place)
+            heap[:] = [e for e in heap if e[2] is not None]
+            heapq.heapify(heap)
+            self._timer_stale = 0
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        self._schedule_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
+        self._schedule_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.is_registered = False
+        self._schedule_timer(timer_handler, self.NEVER)
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
                 return 0.
+            idle_time = self._next_timer - eventtime
             if self._check_gc:
                 gi = gc.get_count()
-                if gi[0] >= 700:
+                gt = self._gc_thresholds
+                if gi[0] >= gt[0]:
                     # Reactor looks idle and gc is due - run it
                     gc_level = 0
-                    if gi[1] >= 10:
+                    if gi[1] >= gt[1]:
                         gc_level = 1
-                        if gi[2] >= 10:
+                        if gi[2] >= gt[2]:
                             gc_level = 2
-                    self._last_gc_times[gc_level] = eventtime
-                    gc.collect(gc_level)
-                    return 0.
-            return min(1., max(.001, self._next_timer - eventtime))
+                    if (idle_time > self._last_gc_pauses[gc_level]
+                        * GC_IDLE_MARGIN or gi[0] >= gt[0] * GC_FORCE_FACTOR):
+                        self._last_gc_times[gc_level] = eventtime
+                        start_time = self.monotonic()
+                        gc.collect(gc_level)
+                        pause = self.monotonic() - start_time
+                        self._last_gc_pauses[gc_level] = pause
+                        self._gc_history.append((eventtime, gc_level, pause))
+                        return 0.
+            return min(1., max(.001, idle_time))
         self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        heap = self._timer_heap
+        # Each timer is invoked at most once per pass - timers that
+        # reschedule themselves into the past are set aside so they
+        # don't block other due timers.  They are put back before any
+        # other callback runs, as that callback may pause and dispatch
+        # timers from another greenlet.
+        self._timer_pass += 1
+        cur_pass = self._timer_pass
+        deferred = []
+        while heap:
+            entry = heap[0]
+            t = entry[2]
+            if t is None:
+                heapq.heappop(heap)
+                self._timer_stale -= 1
+                continue
+            if eventtime < entry[0]:
+                break
+            if t.last_pass == cur_pass:
+                deferred.append(heapq.heappop(heap))
+                continue
+            heapq.heappop(heap)
+            if deferred:
+                self._restore_deferred(deferred)
+            t.heap_entry = None
+            t.last_pass = cur_pass
+            t.waketime = self.NEVER
+            if self._stats is None:
+                waketime = t.callback(eventtime)
+            else:
+                waketime = self._stats.run_timer(t, entry[0], eventtime)
+            t.waketime = waketime
+            self._schedule_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._note_next_timer()
+                self._end_greenlet(g_dispatch)
+                return 0.
+        self._restore_deferred(deferred)
+        self._note_next_timer()
         return 0.
+    def _restore_deferred(self, deferred):
+        heap = self._timer_heap
+        for entry in deferred:
+            heapq.heappush(heap, entry)
+        del deferred[:]
+    def _note_next_timer(self):
+        heap = self._timer_heap
+        if heap:
+            self._next_timer = min(self._next_timer, heap[0][0])
     # Callbacks and Completions
     def completion(self):
         return ReactorCompletion(self)
@@ -169,35 +349,43 @@ class SelectReactor:
         rcb = ReactorCallback(self, callback, waketime)
         return rcb.completion
     # Asynchronous (from another thread) callbacks and completions
-    def register_async_callback(self, callback, waketime=NOW):
-        self._async_queue.put_nowait(
-            (ReactorCallback, (self, callback, waketime)))
+    def _async_signal(self, item):
+        self._async_queue.append(item)
+        # Only wake the reactor if it hasn't already been signaled
+        if self._async_pending:
+            return
+        self._async_pending = True
+        pipe_fds = self._pipe_fds
+        if pipe_fds is None:
+            # Reactor not running - the pipe is signaled on startup
+            return
         try:
-            os.write(self._pipe_fds[1], b'.')
+            os.write(pipe_fds[1], b'.')
         except os.error:
             pass
+    def register_async_callback(self, callback, waketime=NOW):
+        self._async_signal((ReactorCallback, (self, callback, waketime)))
     def async_complete(self, completion, result):
-        self._async_queue.put_nowait((completion.complete, (result,)))
-        try:
-            os.write(self._pipe_fds[1], b'.')
-        except os.error:
-            pass
+        self._async_signal((completion.complete, (result,)))
     def _got_pipe_signal(self, eventtime):
         try:
             os.read(self._pipe_fds[0], 4096)
         except os.error:
             pass
-        while 1:
-            try:
-                func, args = self._async_queue.get_nowait()
-            except queue.Empty:
-                break
+        # Clear the flag before draining so that an item queued during
+        # the drain results in a new wakeup
+        self._async_pending = False
+        async_queue = self._async_queue
+        while async_queue:
+            func, args = async_queue.popleft()
             func(*args)
     def _setup_async_callbacks(self):
         self._pipe_fds = os.pipe()
         util.set_nonblock(self._pipe_fds[0])
         util.set_nonblock(self._pipe_fds[1])
         self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
+        if self._async_queue:
+            os.write(self._pipe_fds[1], b'.')
     # Greenlets
     def _sys_pause(self, waketime):
         # Pause using system sleep for when reactor not running
@@ -220,6 +408,8 @@ class SelectReactor:
             self._all_greenlets.append(g_next)
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
+        if self._stats is not None:
+            g.timer.stats_name = self._stats.stop()
         self._next_timer = self.NOW
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
@@ -266,18 +456,24 @@ class SelectReactor:
         while self._process:
             timeout = self._check_timers(eventtime, busy)
             busy = False
-            res = select.select(self._read_fds, self.write_fds, [], timeout)
+            res = select.select(self._read_fds, self._write_fds, [], timeout)
             eventtime = self.monotonic()
             for fd in res[0]:
                 busy = True
-                fd.read_callback(eventtime)
+                if self._stats is None:
+                    fd.read_callback(eventtime)
+                else:
+                    self._stats.run_fd(fd.read_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
             for fd in res[1]:
                 busy = True
-                fd.write_callback(eventtime)
+                if self._stats is None:
+                    fd.write_callback(eventtime)
+                else:
+                    self._stats.run_fd(fd.write_callback, eventtime)
                 if g_dispatch is not self._g_dispatch:
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
@@ -314,16 +510,12 @@ class PollReactor(SelectReactor):
     # File descriptors
     def register_fd(self, fd, read_callback, write_callback=None):
         file_handler = ReactorFileHandler(fd, read_callback, write_callback)
-        fds = self._fds.copy()
-        fds[fd] = file_handler
-        self._fds = fds
+        self._fds[fd] = file_handler
         self._poll.register(file_handler, select.POLLIN | select.POLLHUP)
         return file_handler
     def unregister_fd(self, file_handler):
         self._poll.unregister(file_handler)
-        fds = self._fds.copy()
-        del fds[file_handler.fd]
-        self._fds = fds
+        del self._fds[file_handler.fd]
     def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
         flags = select.POLLHUP
         if is_readable:
@@ -331,81 +523,107 @@ class PollReactor(SelectReactor):
         if is_writeable:
             flags |= select.POLLOUT
         self._poll.modify(file_handler, flags)
+    def _dispatch_fds(self, res, eventtime, read_flags, write_flags):
+        # Invoke the callbacks of ready file descriptors. Returns
+        # False if a callback paused (and dispatch moved to a new
+        # greenlet).
+        g_dispatch = self._g_dispatch
+        fds = self._fds
+        for fd, event in res:
+            if event & read_flags:
+                file_handler = fds.get(fd)
+                if file_handler is not None:
+                    if self._stats is None:
+                        file_handler.read_callback(eventtime)
+                    else:
+                        self._stats.run_fd(file_handler.read_callback,
+                                           eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        return False
+            if event & write_flags:
+                file_handler = fds.get(fd)
+                if file_handler is not None:
+                    if self._stats is None:
+                        file_handler.write_callback(eventtime)
+                    else:
+                        self._stats.run_fd(file_handler.write_callback,
+                                           eventtime)
+                    if g_dispatch is not self._g_dispatch:
+                        return False
+        return True
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
+        read_flags = select.POLLIN | select.POLLHUP
+        write_flags = select.POLLOUT
         busy = True
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime, busy)
-            busy = False
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
             eventtime = self.monotonic()
-            for fd, event in res:
-                busy = True
-                if event & (select.POLLIN | select.POLLHUP):
-                    self._fds[fd].read_callback(eventtime)
-                    if g_dispatch is not self._g_dispatch:
-                        self._end_greenlet(g_dispatch)
-                        eventtime = self.monotonic()
-                        break
-                if event & select.POLLOUT:
-                    self._fds[fd].write_callback(eventtime)
-                    if g_dispatch is not self._g_dispatch:
-                        self._end_greenlet(g_dispatch)
-                        eventtime = self.monotonic()
-                        break
+            busy = bool(res)
+            if not self._dispatch_fds(res, eventtime, read_flags, write_flags):
+                self._end_greenlet(g_dispatch)
+                eventtime = self.monotonic()
         self._g_dispatch = None
 
-class EPollReactor(SelectReactor):
+class EPollReactor(PollReactor):
     def __init__(self, gc_checking=False):
         SelectReactor.__init__(self, gc_checking)
         self._epoll = select.epoll()
         self._fds = {}
+        # Regular files can't be added to an epoll set (they are always
+        # ready) - track their wake flags separately
+        self._file_fds = {}
     # File descriptors
     def register_fd(self, fd, read_callback, write_callback=None):
         file_handler = ReactorFileHandler(fd, read_callback, write_callback)
-        fds = self._fds.copy()
-        fds[fd] = read_callback
-        self._fds = fds
-        self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        self._fds[fd] = file_handler
+        try:
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLHUP)
+        except PermissionError:
+            self._file_fds[fd] = select.EPOLLIN
         return file_handler
     def unregister_fd(self, file_handler):
-        self._epoll.unregister(file_handler.fd)
-        fds = self._fds.copy()
-        del fds[file_handler.fd]
-        self._fds = fds
+        fd = file_handler.fd
+        if self._file_fds.pop(fd, None) is None:
+            self._epoll.unregister(fd)
+        del self._fds[fd]
     def set_fd_wake(self, file_handler, is_readable=True, is_writeable=False):
-        flags = select.POLLHUP
+        flags = select.EPOLLHUP
         if is_readable:
             flags |= select.EPOLLIN
         if is_writeable:
             flags |= select.EPOLLOUT
-        self._epoll.modify(file_handler, flags)
+        fd = file_handler.fd
+        if fd in self._file_fds:
+            self._file_fds[fd] = flags
+        else:
+            self._epoll.modify(fd, flags)
     # Main loop
     def _dispatch_loop(self):
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
+        read_flags = select.EPOLLIN | select.EPOLLHUP
+        write_flags = select.EPOLLOUT
         busy = True
         eventtime = self.monotonic()
         while self._process:
             timeout = self._check_timers(eventtime, busy)
-            busy = False
+            ready = None
+            if self._file_fds:
+                ready = [(fd, flags) for fd, flags in self._file_fds.items()
+                         if flags & (select.EPOLLIN | select.EPOLLOUT)]
+                if ready:
+                    timeout = 0.
             res = self._epoll.poll(timeout)
+            if ready:
+                res.extend(ready)
             eventtime = self.monotonic()
-            for fd, event in res:
-                busy = True
-                if event & (select.EPOLLIN | select.EPOLLHUP):
-                    self._fds[fd].read_callback(eventtime)
-                    if g_dispatch is not self._g_dispatch:
-                        self._end_greenlet(g_dispatch)
-                        eventtime = self.monotonic()
-                        break
-                if event & select.EPOLLOUT:
-                    self._fds[fd].write_callback(eventtime)
-                    if g_dispatch is not self._g_dispatch:
-                        self._end_greenlet(g_dispatch)
-                        eventtime = self.monotonic()
-                        break
+            busy = bool(res)
+            if not self._dispatch_fds(res, eventtime, read_flags, write_flags):
+                self._end_greenlet(g_dispatch)
+                eventtime = self.monotonic()
         self._g_dispatch = None
 
 # Use the poll based reactor if it is available
@@ -414,3 +632,12 @@ try:
     Reactor = PollReactor
 except:
     Reactor = SelectReactor
+
+# Available reactor implementations (selectable via "--reactor")
+REACTORS = {'select': SelectReactor, 'poll': PollReactor,
+            'epoll': EPollReactor}
+
+def lookup_reactor(name=None):
+    if name is None:
+        return Reactor
+    return REACTORS[name]
@@ -11,6 +11,66 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Maximum number of messages obtained from the serialqueue per call
+PULL_BATCH_SIZE = 32
+
+# Number of data dictionary bytes requested per identify command
+IDENTIFY_CHUNK = 40
+
+# High rate responses that are decoded by the C helper code
+FAST_DECODE_MESSAGES = [
+    'sensor_bulk_data', 'i2c_read_response', 'trsync_state']
+FAST_DECODE_TYPES = {
+    msgproto.PT_uint32: 'u', msgproto.PT_uint16: 'u', msgproto.PT_byte: 'u',
+    msgproto.PT_int32: 'i', msgproto.PT_int16: 'i',
+    msgproto.PT_string: 's', msgproto.PT_progmem_buffer: 's',
+    msgproto.PT_buffer: 's',
+}
+
+# Decode selected response messages in C (msgproto.MessageParser
+# remains the reference implementation for all other messages)
+class FastDecoder:
+    def __init__(self, msgparser, msgnames=FAST_DECODE_MESSAGES):
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.decoder = self.ffi_main.gc(self.ffi_lib.msgdecode_alloc(),
+                                        self.ffi_lib.msgdecode_free)
+        self.outputs = self.ffi_main.new('struct pull_decoded_message[%d]'
+                                         % (PULL_BATCH_SIZE,))
+        self.formats = []
+        for msgname in msgnames:
+            mp = msgparser.messages_by_name.get(msgname)
+            if mp is None:
+                continue
+            ptypes = [FAST_DECODE_TYPES.get(type(t)) for t in mp.param_types]
+            if None in ptypes:
+                # Enumerations are left to the reference parser
+                continue
+            # Message ids may be negative - the C code compares the
+            # 32bit encoding produced by msgblock_parse_int()
+            msgid = msgparser.lookup_msgid(mp.msgformat) & 0xffffffff
+            fidx = self.ffi_lib.msgdecode_add_format(
+                self.decoder, msgid, ''.join(ptypes).encode())
+            if fidx != len(self.formats):
+                continue
+            names = [name for name, t in mp.param_names]
+            buf_pos = ptypes.index('s') if 's' in ptypes else -1
+            self.formats.append((mp.name, names, buf_pos))
+    def get_names(self):
+        return [name for name, names, buf_pos in self.formats]
+    def decode(self, responses, count):
+        self.ffi_lib.msgdecode_decode(self.decoder, responses, count,
+                                      self.outputs)
+        return self.outputs
+    def get_params(self, output):
+        name, names, buf_pos = self.formats[output.format]
+        values = self.ffi_main.unpack(output.params, len(names))
+        if buf_pos >= 0:
+            values[buf_pos] = self.ffi_main.buffer(output.buf,
+                                                   output.buf_len)[:]
+        params = dict(zip(names, values))
+        params['#name'] = name
+        return params
+
 class SerialReader:
     def __init__(self, reactor, mcu_name=""):
         self.reactor = reactor
@@ -23,6 +83,8 @@ class SerialReader:
         # Serial port
         self.serial_dev = None
         self.msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
+        self.fast_decoder = None
+        self.identify_cache = None
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.serialqueue = None
@@ -41,48 +103,142 @@ class SerialReader:
     def _bg_thread(self):
         name_short = ("serialhdl %s" % (self.mcu_name))[:15]
         self.ffi_lib.set_thread_name(name_short.encode('utf-8'))
-        response = self.ffi_main.new('struct pull_queue_message *')
+        responses = self.ffi_main.new('struct pull_queue_message[%d]'
+                                      % (PULL_BATCH_SIZE,))
         while 1:
-            self.ffi_lib.serialqueue_pull(self.serialqueue, response)
-            count = response.len
+            count = self.ffi_lib.serialqueue_pull_batch(
+                self.serialqueue, responses, PULL_BATCH_SIZE)
             if count < 0:
                 break
-            if response.notify_id:
-                params = {'#sent_time': response.sent_time,
-                          '#receive_time': response.receive_time}
-                completion = self.pending_notifications.pop(response.notify_id)
-                self.reactor.async_complete(completion, params)
-                continue
-            params = self.msgparser.parse(response.msg[0:count])
-            params['#sent_time'] = response.sent_time
-            params['#receive_time'] = response.receive_time
-            hdl = (params['#name'], params.get('oid'))
-            try:
-                with self.lock:
-                    hdl = self.handlers.get(hdl, self.handle_default)
+            fast_decoder = self.fast_decoder
+            decoded = None
+            if fast_decoder is not None:
+                decoded = fast_decoder.decode(responses, count)
+            batch = []
+            for i in range(count):
+                response = responses[i]
+                if response.notify_id:
+                    # Dispatch earlier responses before waking the sender
+                    self._dispatch_batch(batch)
+                    batch = []
+                    params = {'#sent_time': response.sent_time,
+                              '#receive_time': response.receive_time}
+                    completion = self.pending_notifications.pop(
+                        response.notify_id, None)
+                    if completion is not None:
+                        self.reactor.async_complete(completion, params)
+                    continue
+                if decoded is not None and decoded[i].format >= 0:
+                    params = fast_decoder.get_params(decoded[i])
+                else:
+                    params = self.msgparser.parse(
+                        response.msg[0:response.len])
+                params['#sent_time'] = response.sent_time
+                params['#receive_time'] = response.receive_time
+                batch.append(params)
+            self._dispatch_batch(batch)
+    def _dispatch_batch(self, batch):
+        if not batch:
+            return
+        with self.lock:
+            handlers = self.handlers
+            for params in batch:
+                hdl = (params['#name'], params.get('oid'))
+                try:
+                    hdl = handlers.get(hdl, self.handle_default)
                     hdl(params)
-            except:
-                logging.exception("%sException in serial callback",
-                                  self.warn_prefix)
+                except:
+                    logging.exception("%sException in serial callback",
+                                      self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
-    def _get_identify_data(self, eventtime):
-        # Query the "data dictionary" from the micro-controller
-        identify_data = b""
+    def _query_identify(self, offset):
+        msg = "identify offset=%d count=%d" % (offset, IDENTIFY_CHUNK)
         while 1:
-            msg = "identify offset=%d count=%d" % (len(identify_data), 40)
-            try:
-                params = self.send_with_response(msg, 'identify_response')
-            except error as e:
-                logging.exception("%sWait for identify_response",
-                                  self.warn_prefix)
-                return None
-            if params['offset'] == len(identify_data):
-                msgdata = params['data']
+            params = self.send_with_response(msg, 'identify_response')
+            if params['offset'] == offset:
+                return params['data']
+    def _check_identify_cache(self, first_chunk):
+        # Reuse the cached data dictionary if the mcu reports the same
+        # length, leading bytes, and trailing bytes.  The zlib trailer
+        # (a checksum of the uncompressed dictionary) is in the final
+        # chunk, so a changed dictionary is detected without a download.
+        try:
+            f = open(self.identify_cache, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            return None
+        dlen = len(data)
+        if dlen <= len(first_chunk) or not data.startswith(first_chunk):
+            return None
+        tail_pos = dlen - IDENTIFY_CHUNK
+        if self._query_identify(tail_pos) != data[tail_pos:]:
+            return None
+        if self._query_identify(dlen):
+            return None
+        return data
+    def _write_identify_cache(self, data):
+        tmpname = self.identify_cache + ".tmp"
+        try:
+            dirname = os.path.dirname(self.identify_cache)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            f = open(tmpname, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmpname, self.identify_cache)
+        except (IOError, OSError) as e:
+            logging.info("%sUnable to write identify cache %s: %s",
+                         self.warn_prefix, self.identify_cache, e)
+    def _get_identify_data(self, eventtime, use_cache):
+        # Query the "data dictionary" from the micro-controller
+        try:
+            identify_data = self._query_identify(0)
+            if use_cache:
+                cache_data = self._check_identify_cache(identify_data)
+                if cache_data is not None:
+                    return cache_data, True
+            while 1:
+                msgdata = self._query_identify(len(identify_data))
                 if not msgdata:
                     # Done
-                    return identify_data
+                    return identify_data, False
                 identify_data += msgdata
+        except error as e:
+            logging.exception("%sWait for identify_response",
+                              self.warn_prefix)
+            return None
+    def _load_identify(self):
+        use_cache = self.identify_cache is not None
+        while 1:
+            start_time = self.reactor.monotonic()
+            completion = self.reactor.register_callback(
+                (lambda e: self._get_identify_data(e, use_cache)))
+            result = completion.wait(start_time + 5.)
+            if result is None:
+                return None
+            identify_data, is_cached = result
+            msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
+            try:
+                msgparser.process_identify(identify_data)
+            except msgproto.error as e:
+                if not is_cached:
+                    raise
+                logging.info("%sDiscarding invalid identify cache",
+                             self.warn_prefix)
+                use_cache = False
+                continue
+            logging.info("%s%s data dictionary (%d bytes) in %.3fs",
+                         self.warn_prefix,
+                         "Loaded cached" if is_cached else "Downloaded",
+                         len(identify_data),
+                         self.reactor.monotonic() - start_time)
+            if use_cache and not is_cached:
+                self._write_identify_cache(identify_data)
+            return msgparser
+    def set_identify_cache(self, filename):
+        self.identify_cache = filename
     def _start_session(self, serial_dev, serial_fd_type=b'u', client_id=0):
         self.serial_dev = serial_dev
         self.serialqueue = self.ffi_main.gc(
@@ -93,15 +249,13 @@ class SerialReader:
         self.background_thread = threading.Thread(target=self._bg_thread)
         self.background_thread.start()
         # Obtain and load the data dictionary from the firmware
-        completion = self.reactor.register_callback(self._get_identify_data)
-        identify_data = completion.wait(self.reactor.monotonic() + 5.)
-        if identify_data is None:
+        msgparser = self._load_identify()
+        if msgparser is None:
             logging.info("%sTimeout on connect", self.warn_prefix)
             self.disconnect()
             return False
-        msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
-        msgparser.process_identify(identify_data)
         self.msgparser = msgparser
+        self.fast_decoder = FastDecoder(msgparser)
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         if serial_fd_type == b'c':
@@ -211,6 +365,22 @@ class SerialReader:
             self.ffi_lib.serialqueue_alloc(self.serial_dev.fileno(), b'f', 0,
                                            self.sq_name),
             self.ffi_lib.serialqueue_free)
+    def set_reactor(self, reactor):
+        # Move an open session to a new reactor (used on a warm restart)
+        with self.lock:
+            self.reactor = reactor
+            self.handlers = {}
+            # Completions of the old reactor can no longer be waited on
+            self.pending_notifications.clear()
+        self.register_response(self.handle_unknown, '#unknown')
+        self.register_response(self.handle_output, '#output')
+    def resume_session(self, serial):
+        # Take over the response handlers registered on an unused reader
+        with self.lock:
+            handlers = dict(serial.handlers)
+            handlers['#unknown', None] = self.handle_unknown
+            handlers['#output', None] = self.handle_output
+            self.handlers = handlers
     def set_clock_est(self, freq, conv_time, conv_clock, last_clock):
         self.ffi_lib.serialqueue_set_clock_est(
             self.serialqueue, freq, conv_time, conv_clock, last_clock)
@@ -251,13 +421,17 @@ class SerialReader:
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, 0)
-    def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
+    def raw_send_async_ack(self, cmd, minclock, reqclock, cmd_queue):
         self.last_notify_id += 1
         nid = self.last_notify_id
         completion = self.reactor.completion()
         self.pending_notifications[nid] = completion
         self.ffi_lib.serialqueue_send(self.serialqueue, cmd_queue,
                                       cmd, len(cmd), minclock, reqclock, nid)
+        return completion
+    def raw_send_wait_ack(self, cmd, minclock, reqclock, cmd_queue):
+        completion = self.raw_send_async_ack(cmd, minclock, reqclock,
+                                             cmd_queue)
         params = completion.wait()
         if params is None:
             self._error("Serial connection closed")
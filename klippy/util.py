@@ -5,7 +5,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, pty, fcntl, termios, signal, logging, json, time
 import subprocess, traceback, shlex
-import platform, psutil
+import platform
 
 
 ######################################################################
@@ -112,7 +112,7 @@ setup_python2_wrappers()
 ######################################################################
 
 def get_cpu_info():
-    core_count = psutil.cpu_count(logical=True)
+    core_count = os.sysconf('SC_NPROCESSORS_ONLN')
     model_name = platform.processor()
     return "%d core %s" % (core_count, model_name)
 
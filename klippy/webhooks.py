@@ -3,7 +3,7 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, collections
+import logging, socket, os, sys, errno, collections, struct
 import gcode
 from urllib.parse import urlparse
 
@@ -33,11 +33,34 @@ except ImportError:
         return json.dumps(obj, separators=(',', ':')).encode()
     def json_loads(data):
         return json.loads(data, object_hook=json_loads_byteify)
+    # The binary (msgpack) encoding is only available with msgspec
+    msgpack_dumps = msgpack_ext = None
 else:
     json_dumps = msgspec.json.encode
     json_loads = msgspec.json.decode
+    msgpack_dumps = msgspec.msgpack.encode
+    msgpack_ext = msgspec.msgpack.Ext
 
 REQUEST_LOG_SIZE = 20
+SEND_BUFFER_LIMIT = 1024 * 1024
+SENDMSG_MAX_CHUNKS = 64
+# msgpack extension type of a packed array of little-endian doubles
+MSGPACK_EXT_FLOAT_ARRAY = 1
+
+# Pack bulk data rows (eg, [[time, x, y, z], ...]) into a msgpack
+# extension: a uint16 column count followed by the row values
+def pack_float_rows(rows):
+    if not rows:
+        return None
+    cols = len(rows[0])
+    values = [v for row in rows for v in row]
+    if len(values) != cols * len(rows) or cols > 0xffff:
+        return None
+    try:
+        data = struct.pack('<H%dd' % (len(values),), cols, *values)
+    except struct.error:
+        return None
+    return msgpack_ext(MSGPACK_EXT_FLOAT_ARRAY, data)
 
 class WebRequestError(gcode.CommandError):
     def __init__(self, message,):
@@ -53,9 +76,8 @@ class Sentinel:
 
 class WebRequest:
     error = WebRequestError
-    def __init__(self, client_conn, request):
+    def __init__(self, client_conn, base_request):
         self.client_conn = client_conn
-        base_request = json_loads(request)
         if type(base_request) != dict:
             raise ValueError("Not a top-level dictionary")
         self.id = base_request.get('id', None)
@@ -121,6 +143,7 @@ class ServerSocket:
         self.reactor = printer.get_reactor()
         self.sock = self.fd_handle = None
         self.clients = {}
+        self.dropped_updates = self.coalesced_updates = 0
         start_args = printer.get_start_args()
         server_address = start_args.get('apiserver')
         is_fileinput = (start_args.get('debuginput') is not None)
@@ -162,6 +185,9 @@ class ServerSocket:
         except socket.error:
             return
         sock.setblocking(0)
+        if sock.family != socket.AF_UNIX:
+            # Don't delay small responses (such as gcode/stream acks)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         client = ClientConnection(self, sock)
         self.clients[client.uid] = client
 
@@ -200,7 +226,10 @@ class ServerSocket:
                 if client.blocking_count < 0:
                     logging.info("Closing unresponsive client %s", client.uid)
                     client.close()
-        return False, ""
+        if not self.dropped_updates and not self.coalesced_updates:
+            return False, ""
+        return False, "webhooks: dropped_updates=%d coalesced_updates=%d" % (
+            self.dropped_updates, self.coalesced_updates)
 
 class ClientConnection:
     def __init__(self, server, sock):
@@ -212,11 +241,23 @@ class ClientConnection:
         self.sock = sock
         self.fd_handle = self.reactor.register_fd(
             self.sock.fileno(), self.process_received, self._do_send)
-        self.partial_data = self.send_buffer = b""
+        self.partial_data = b""
+        self.send_queue = collections.deque()
+        self.send_queue_size = 0
+        self.send_limit = SEND_BUFFER_LIMIT
+        self.pending_status = None
+        self.encoding = self.next_encoding = "json"
         self.is_blocking = False
         self.blocking_count = 0
         self.set_client_info("?", "New connection")
         self.request_log = collections.deque([], REQUEST_LOG_SIZE)
+        self.close_callbacks = []
+
+    def register_close_callback(self, cb):
+        if self.is_closed():
+            cb(self)
+            return
+        self.close_callbacks.append(cb)
 
     def dump_request_log(self):
         out = []
@@ -248,6 +289,10 @@ class ClientConnection:
         except socket.error:
             pass
         self.server.pop_client(self.uid)
+        close_callbacks = self.close_callbacks
+        self.close_callbacks = []
+        for cb in close_callbacks:
+            cb(self)
 
     def is_closed(self):
         return self.fd_handle is None
@@ -272,7 +317,16 @@ class ClientConnection:
         for req in requests:
             self.request_log.append((eventtime, req))
             try:
-                web_request = WebRequest(self, req)
+                base_request = json_loads(req)
+                if type(base_request) == list and base_request:
+                    # Batch of requests - run them from a single callback
+                    web_requests = [WebRequest(self, br)
+                                    for br in base_request]
+                    self.reactor.register_callback(
+                        lambda e, s=self, wrs=web_requests:
+                        s._process_batch(wrs))
+                    continue
+                web_request = WebRequest(self, base_request)
             except Exception:
                 logging.exception("webhooks: Error decoding Server Request %s"
                                   % (req))
@@ -280,7 +334,20 @@ class ClientConnection:
             self.reactor.register_callback(
                 lambda e, s=self, wr=web_request: s._process_request(wr))
 
+    def _process_batch(self, web_requests):
+        results = [self._run_request(wr) for wr in web_requests]
+        results = [r for r in results if r is not None]
+        if results:
+            self.send(results)
+        self.encoding = self.next_encoding
+
     def _process_request(self, web_request):
+        result = self._run_request(web_request)
+        if result is not None:
+            self.send(result)
+        self.encoding = self.next_encoding
+
+    def _run_request(self, web_request):
         try:
             func = self.webhooks.get_callback(web_request.get_method())
             func(web_request)
@@ -292,35 +359,111 @@ class ClientConnection:
             logging.exception(msg)
             web_request.set_error(WebRequestError(str(e)))
             self.printer.invoke_shutdown(msg)
-        result = web_request.finish()
-        if result is None:
-            return
-        self.send(result)
+        return web_request.finish()
 
-    def send(self, data):
+    def set_send_limit(self, send_limit):
+        self.send_limit = send_limit
+
+    def set_encoding(self, encoding):
+        # The new encoding is used after the response to this request
+        self.next_encoding = encoding
+
+    def is_congested(self):
+        return self.send_limit and self.send_queue_size >= self.send_limit
+
+    def _encode(self, data):
         try:
-            jmsg = json_dumps(data)
-            self.send_buffer += jmsg + b"\x03"
+            if self.encoding == "msgpack":
+                msg = msgpack_dumps(data)
+                return struct.pack('>I', len(msg)) + msg
+            return json_dumps(data) + b"\x03"
         except (TypeError, ValueError) as e:
-            msg = ("json encoding error: %s" % (str(e),))
+            msg = ("%s encoding error: %s" % (self.encoding, str(e)))
             logging.exception(msg)
             self.printer.invoke_shutdown(msg)
+            return None
+
+    def send(self, data):
+        jmsg = self._encode(data)
+        if jmsg is None:
             return
+        self.send_queue.append(jmsg)
+        self.send_queue_size += len(jmsg)
         if not self.is_blocking:
             self._do_send()
 
+    def send_update(self, data):
+        # Send a bulk data message (that may be discarded if the client
+        # falls behind)
+        if self.is_congested():
+            self.server.dropped_updates += 1
+            return
+        if self.encoding == "msgpack":
+            params = data.get('params')
+            if type(params) == dict and 'data' in params:
+                packed = pack_float_rows(params['data'])
+                if packed is not None:
+                    data = dict(data)
+                    data['params'] = params = dict(params)
+                    params['data'] = packed
+        self.send(data)
+
+    def send_status(self, data):
+        # Send a subscription status update - while the client is behind
+        # the updates are merged and sent once the queue has drained
+        pending = self.pending_status
+        if pending is None:
+            if not self.is_congested():
+                self.send(data)
+                return
+            pending = self.pending_status = dict(data)
+            pending['params'] = {'status': {}}
+        else:
+            self.server.coalesced_updates += 1
+        params = data['params']
+        pending['params']['eventtime'] = params['eventtime']
+        pstatus = pending['params']['status']
+        for obj_name, obj_status in params['status'].items():
+            pstatus.setdefault(obj_name, {}).update(obj_status)
+
     def _do_send(self, eventtime=None):
         if self.fd_handle is None:
             return
+        send_queue = self.send_queue
         try:
-            sent = self.sock.send(self.send_buffer)
+            if len(send_queue) > 1 and hasattr(self.sock, 'sendmsg'):
+                chunks = [send_queue[i] for i in range(
+                    min(len(send_queue), SENDMSG_MAX_CHUNKS))]
+                sent = self.sock.sendmsg(chunks)
+            elif send_queue:
+                sent = self.sock.send(send_queue[0])
+            else:
+                sent = 0
         except socket.error as e:
             if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
                 logging.info("webhooks: socket write error %d" % (self.uid,))
                 self.close()
                 return
             sent = 0
-        if sent < len(self.send_buffer):
+        if sent:
+            # Release sent chunks (without copying a partially sent chunk)
+            self.send_queue_size -= sent
+            while sent:
+                chunk_len = len(send_queue[0])
+                if sent < chunk_len:
+                    send_queue[0] = memoryview(send_queue[0])[sent:]
+                    break
+                send_queue.popleft()
+                sent -= chunk_len
+            self.blocking_count = 5
+        if self.pending_status is not None and not self.is_congested():
+            pending = self.pending_status
+            self.pending_status = None
+            jmsg = self._encode(pending)
+            if jmsg is not None:
+                send_queue.append(jmsg)
+                self.send_queue_size += len(jmsg)
+        if send_queue:
             if not self.is_blocking:
                 self.reactor.set_fd_wake(self.fd_handle, False, True)
                 self.is_blocking = True
@@ -328,7 +471,6 @@ class ClientConnection:
         elif self.is_blocking:
             self.reactor.set_fd_wake(self.fd_handle, True, False)
             self.is_blocking = False
-        self.send_buffer = self.send_buffer[sent:]
 
 class WebHooks:
     def __init__(self, printer):
@@ -381,6 +523,18 @@ class WebHooks:
         client_info = web_request.get_dict('client_info', None)
         if client_info is not None:
             web_request.get_client_connection().set_client_info(client_info)
+        send_limit = web_request.get_int('send_buffer_limit', None)
+        if send_limit is not None:
+            if send_limit < 0:
+                raise web_request.error("Invalid send_buffer_limit")
+            web_request.get_client_connection().set_send_limit(send_limit)
+        encoding = web_request.get_str('encoding', None)
+        if encoding is not None:
+            if encoding not in ["json", "msgpack"]:
+                raise web_request.error("Unknown encoding '%s'" % (encoding,))
+            if encoding == "msgpack" and msgpack_dumps is None:
+                raise web_request.error("Encoding 'msgpack' not available")
+            web_request.get_client_connection().set_encoding(encoding)
         state_message, state = self.printer.get_state_message()
         src_path = os.path.dirname(__file__)
         klipper_path = os.path.normpath(os.path.join(src_path, ".."))
@@ -444,6 +598,66 @@ class WebHooks:
                 "No active connections for method '%s'" % (method))
         self._remote_methods[method] = valid_conns
 
+# Run a client's G-Code commands in order, acknowledging each command
+class GCodeStream:
+    def __init__(self, printer, cconn):
+        self.printer = printer
+        self.gcode = printer.lookup_object("gcode")
+        self.cconn = cconn
+        self.commands = collections.deque()
+        self.output = []
+        self.is_running = False
+    def get_pending(self):
+        return len(self.commands)
+    def add_commands(self, commands):
+        self.commands.extend(commands)
+        if not self.is_running:
+            self.is_running = True
+            reactor = self.printer.get_reactor()
+            reactor.register_callback(self._process_commands)
+    def _send_ack(self, cmd_id, template, error=None):
+        params = {'id': cmd_id, 'output': self.output}
+        if error is not None:
+            params['error'] = error
+        self.output = []
+        tmp = dict(template)
+        tmp['params'] = params
+        self.cconn.send(tmp)
+    def _handle_output(self, msg):
+        self.output.append(msg)
+    def _run_command(self, cmd_id, script):
+        # Only capture output while this stream's script holds the mutex
+        with self.gcode.get_mutex():
+            self.gcode.register_output_handler(self._handle_output)
+            try:
+                self.gcode.run_script_from_command(script)
+            except self.printer.command_error as e:
+                return str(e)
+            except Exception as e:
+                msg = "Internal Error on G-Code stream command %s" % (cmd_id,)
+                logging.exception(msg)
+                self.printer.invoke_shutdown(msg)
+                return str(e)
+            finally:
+                self.gcode.remove_output_handler(self._handle_output)
+        return None
+    def _process_commands(self, eventtime):
+        try:
+            while self.commands and not self.cconn.is_closed():
+                cmd_id, script, template = self.commands.popleft()
+                error = self._run_command(cmd_id, script)
+                self._send_ack(cmd_id, template, error)
+                if error is not None:
+                    # Don't run commands that depend on a failed command
+                    while self.commands:
+                        cmd_id, script, template = self.commands.popleft()
+                        self._send_ack(cmd_id, template,
+                                       "Skipped due to earlier error")
+            self.commands.clear()
+        finally:
+            self.output = []
+            self.is_running = False
+
 class GCodeHelper:
     def __init__(self, printer):
         self.printer = printer
@@ -451,11 +665,13 @@ class GCodeHelper:
         # Output subscription tracking
         self.is_output_registered = False
         self.clients = {}
+        self.streams = {}
         # Register webhooks
         wh = printer.lookup_object('webhooks')
         wh.register_endpoint("gcode/help", self._handle_help)
         wh.register_endpoint("gcode/session", self._handle_session)
         wh.register_endpoint("gcode/script", self._handle_script)
+        wh.register_endpoint("gcode/stream", self._handle_stream)
         wh.register_endpoint("gcode/restart", self._handle_restart)
         wh.register_endpoint("gcode/firmware_restart",
                              self._handle_firmware_restart)
@@ -465,6 +681,24 @@ class GCodeHelper:
         web_request.send(self.gcode.get_command_help())
     def _handle_script(self, web_request):
         self.gcode.run_script(web_request.get_str('script'))
+    def _handle_stream(self, web_request):
+        commands = web_request.get('commands', types=(list,))
+        template = web_request.get_dict('response_template', {})
+        cmds = []
+        for cmd in commands:
+            if (type(cmd) != dict or 'id' not in cmd
+                or type(cmd.get('script')) != str):
+                raise web_request.error("Invalid argument")
+            cmds.append((cmd['id'], cmd['script'], template))
+        cconn = web_request.get_client_connection()
+        stream = self.streams.get(cconn)
+        if stream is None:
+            stream = self.streams[cconn] = GCodeStream(self.printer, cconn)
+            cconn.register_close_callback(self._remove_stream)
+        stream.add_commands(cmds)
+        web_request.send({'pending': stream.get_pending()})
+    def _remove_stream(self, cconn):
+        self.streams.pop(cconn, None)
     def _handle_session(self, web_request):
         gcode = web_request.get_str('command')
         outputs = []
@@ -497,54 +731,95 @@ class GCodeHelper:
             self.is_output_registered = True
 
 SUBSCRIPTION_REFRESH_TIME = .25
+MIN_SUBSCRIPTION_INTERVAL = .010
 
-class QueryStatusHelper:
-    def __init__(self, printer):
+# Subscriptions sharing an update interval (and a query timer)
+class QueryStatusGroup:
+    def __init__(self, printer, interval, remove_cb):
         self.printer = printer
+        self.interval = interval
+        self.remove_cb = remove_cb
         self.clients = {}
         self.pending_queries = []
         self.query_timer = None
+        self.query_count = 0
         self.last_query = {}
-        # Register webhooks
-        webhooks = printer.lookup_object('webhooks')
-        webhooks.register_endpoint("objects/list", self._handle_list)
-        webhooks.register_endpoint("objects/query", self._handle_query)
-        webhooks.register_endpoint("objects/subscribe", self._handle_subscribe)
-    def _handle_list(self, web_request):
-        objects = [n for n, o in self.printer.lookup_objects()
-                   if hasattr(o, 'get_status')]
-        web_request.send({'objects': objects})
+        self.last_versions = {}
+    def _register_timer(self, waketime):
+        reactor = self.printer.get_reactor()
+        self.query_timer = reactor.register_timer(self._do_query, waketime)
+    def add_query(self, subscription, send_func):
+        self.pending_queries.append((None, subscription, send_func, {}, True))
+        reactor = self.printer.get_reactor()
+        if self.query_timer is None:
+            self._register_timer(reactor.NOW)
+        elif self.interval > SUBSCRIPTION_REFRESH_TIME:
+            # Don't delay the response to a query by a long interval
+            reactor.update_timer(self.query_timer, reactor.NOW)
+    def add_client(self, cconn, subscription, template, query_count):
+        # Send the full status on the next update if this group has
+        # been updated since the initial query was answered
+        is_full = query_count != self.query_count
+        self.clients[cconn] = (cconn, subscription, cconn.send_status,
+                               template, is_full)
+        if self.query_timer is None:
+            reactor = self.printer.get_reactor()
+            self._register_timer(reactor.monotonic() + self.interval)
+    def remove_client(self, cconn):
+        self.clients.pop(cconn, None)
+    def _query_object(self, obj_name, eventtime, last_query, last_versions,
+                      versions, unchanged):
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}
+        # Objects may provide a counter that changes with their status
+        get_status_version = getattr(po, 'get_status_version', None)
+        if get_status_version is not None:
+            version = versions[obj_name] = get_status_version()
+            if (obj_name in last_query
+                and last_versions.get(obj_name) == version):
+                unchanged[obj_name] = True
+                return last_query[obj_name]
+        return po.get_status(eventtime)
     def _do_query(self, eventtime):
+        self.query_count += 1
         last_query = self.last_query
         query = self.last_query = {}
+        last_versions = self.last_versions
+        versions = self.last_versions = {}
+        unchanged = {}
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
         # Generate get_status() info for each client
-        for cconn, subscription, send_func, template in msglist:
+        for cconn, subscription, send_func, template, is_full in msglist:
             is_query = cconn is None
-            if not is_query and cconn.is_closed():
-                del self.clients[cconn]
-                continue
+            if not is_query:
+                if cconn.is_closed():
+                    del self.clients[cconn]
+                    continue
+                if is_full:
+                    self.clients[cconn] = (cconn, subscription, send_func,
+                                           template, False)
             # Query each requested printer object
             cquery = {}
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
-                    else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                    res = query[obj_name] = self._query_object(
+                        obj_name, eventtime, last_query, last_versions,
+                        versions, unchanged)
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
+                elif obj_name in unchanged and not is_full:
+                    continue
                 lres = last_query.get(obj_name, {})
                 cres = {}
                 for ri in req_items:
                     rd = res.get(ri, None)
-                    if is_query or rd != lres.get(ri):
+                    if is_full or rd != lres.get(ri):
                         cres[ri] = rd
                 if cres or is_query:
                     cquery[obj_name] = cres
@@ -558,8 +833,42 @@ class QueryStatusHelper:
             reactor = self.printer.get_reactor()
             reactor.unregister_timer(self.query_timer)
             self.query_timer = None
+            self.last_query = {}
+            self.last_versions = {}
+            if not self.clients and not self.pending_queries:
+                self.remove_cb(self)
             return reactor.NEVER
-        return eventtime + SUBSCRIPTION_REFRESH_TIME
+        return eventtime + self.interval
+
+class QueryStatusHelper:
+    def __init__(self, printer):
+        self.printer = printer
+        self.groups = {}
+        # Register webhooks
+        webhooks = printer.lookup_object('webhooks')
+        webhooks.register_endpoint("objects/list", self._handle_list)
+        webhooks.register_endpoint("objects/query", self._handle_query)
+        webhooks.register_endpoint("objects/subscribe", self._handle_subscribe)
+    def _handle_list(self, web_request):
+        objects = [n for n, o in self.printer.lookup_objects()
+                   if hasattr(o, 'get_status')]
+        web_request.send({'objects': objects})
+    def _get_group(self, interval):
+        group = self.groups.get(interval)
+        if group is None:
+            group = QueryStatusGroup(self.printer, interval,
+                                     self._remove_group)
+            self.groups[interval] = group
+        return group
+    def _remove_group(self, group):
+        if self.groups.get(group.interval) is group:
+            del self.groups[group.interval]
+    def _get_interval(self, web_request, value):
+        if (type(value) not in (int, float)
+            or value < MIN_SUBSCRIPTION_INTERVAL):
+            raise web_request.error("Invalid interval")
+        # Round so that similar intervals share a group
+        return round(float(value), 3)
     def _handle_query(self, web_request, is_subscribe=False):
         objects = web_request.get_dict('objects')
         # Validate subscription format
@@ -570,23 +879,55 @@ class QueryStatusHelper:
                 for ri in v:
                     if type(ri) != str:
                         raise web_request.error("Invalid argument")
+        # Group objects by update interval
+        interval = SUBSCRIPTION_REFRESH_TIME
+        obj_intervals = {}
+        if is_subscribe:
+            interval = self._get_interval(web_request, web_request.get(
+                'interval', SUBSCRIPTION_REFRESH_TIME))
+            obj_intervals = web_request.get_dict('intervals', {})
+            for k, v in obj_intervals.items():
+                if k not in objects:
+                    raise web_request.error("Invalid argument")
+                obj_intervals[k] = self._get_interval(web_request, v)
+        subscriptions = {interval: {}} if not objects else {}
+        for k, v in objects.items():
+            i = obj_intervals.get(k, interval)
+            subscriptions.setdefault(i, {})[k] = v
         # Add to pending queries
         cconn = web_request.get_client_connection()
         template = web_request.get_dict('response_template', {})
-        if is_subscribe and cconn in self.clients:
-            del self.clients[cconn]
+        if is_subscribe:
+            for group in list(self.groups.values()):
+                group.remove_client(cconn)
         reactor = self.printer.get_reactor()
-        complete = reactor.completion()
-        self.pending_queries.append((None, objects, complete.complete, {}))
-        # Start timer if needed
-        if self.query_timer is None:
-            qt = reactor.register_timer(self._do_query, reactor.NOW)
-            self.query_timer = qt
+        queries = []
+        for i, subscription in subscriptions.items():
+            group = self._get_group(i)
+            complete = reactor.completion()
+            group.add_query(subscription, (lambda msg, c=complete, g=group:
+                                           c.complete((msg, g.query_count))))
+            queries.append((group, subscription, complete))
         # Wait for data to be queried
-        msg = complete.wait()
-        web_request.send(msg['params'])
-        if is_subscribe:
-            self.clients[cconn] = (cconn, objects, cconn.send, template)
+        status = {}
+        eventtime = 0.
+        query_counts = []
+        for group, subscription, complete in queries:
+            msg, query_count = complete.wait()
+            status.update(msg['params']['status'])
+            eventtime = max(eventtime, msg['params']['eventtime'])
+            query_counts.append(query_count)
+        web_request.send({'eventtime': eventtime, 'status': status})
+        if not is_subscribe:
+            return
+        # Only start updates after the client has the initial status
+        for (group, subscription, complete), query_count in zip(queries,
+                                                                query_counts):
+            cur_group = self._get_group(group.interval)
+            if cur_group is not group:
+                # Group was removed while waiting - send full status
+                query_count = None
+            cur_group.add_client(cconn, subscription, template, query_count)
     def _handle_subscribe(self, web_request):
         self._handle_query(web_request, is_subscribe=True)
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# Host motion pipeline benchmark (g-code to steps) using batch mode
+#
+# Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, json, math, resource, subprocess, tempfile
+
+KLIPPY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          '..', 'klippy')
+TEST_DIR = os.path.join(KLIPPY_DIR, '..', 'test', 'klippy')
+CONFIG_DIR = os.path.join(KLIPPY_DIR, '..', 'config')
+
+
+######################################################################
+# Benchmark jobs
+######################################################################
+
+# Pick and place: rapid XY travel with Z descents and short dwells
+def gen_pnp(count):
+    out = ["G28", "G90", "SET_VELOCITY_LIMIT ACCEL=3000"]
+    for i in range(count):
+        fx, fy = 10. + (i % 8) * 12., 10.
+        px, py = 40. + (i * 7) % 150, 60. + (i * 13) % 130
+        out += ["G0 X%.3f Y%.3f F30000" % (fx, fy),
+                "G0 Z2 F3000", "G4 P20", "G0 Z10 F3000",
+                "G0 X%.3f Y%.3f F30000" % (px, py),
+                "G0 Z2.5 F3000", "G4 P10", "G0 Z10 F3000"]
+    return out
+
+# Dense arcs: many small full circles (split into short segments)
+def gen_arcs(count):
+    out = ["G28", "G90", "G1 X100 Y100 Z5 F6000"]
+    for i in range(count):
+        r = 2. + (i % 5)
+        out += ["G1 X%.3f Y100 F6000" % (100. - r,),
+                "G2 X%.3f Y100 I%.3f J0 E0.5" % (100. - r, r),
+                "G3 X%.3f Y100 I%.3f J0 E0.5" % (100. - r, r)]
+    return out
+
+# Multi-axis: simultaneous X/Y/Z/E moves with direction reversals
+def gen_multi(count):
+    out = ["G28", "G90", "M83", "G1 Z5 F6000"]
+    for i in range(count):
+        a = i * 0.37
+        out.append("G1 X%.3f Y%.3f Z%.3f E%.4f F%d" % (
+            100. + 60. * math.sin(a), 100. + 60. * math.cos(a * 1.3),
+            5. + 2. * math.sin(a * 0.7), 0.05 + 0.02 * math.cos(a),
+            3000 + (i % 7) * 1000))
+    return out
+
+JOBS = {
+    'pnp': ("config/example-cartesian.cfg", "atmega2560.dict", gen_pnp, 400),
+    'arcs': ("test/gcode_arcs.cfg", "atmega2560.dict", gen_arcs, 200),
+    'multi': ("test/gcode_arcs.cfg", "atmega2560.dict", gen_multi, 5000),
+}
+JOB_ORDER = ['pnp', 'arcs', 'multi']
+
+def lookup_config(fname):
+    if fname.startswith("config/"):
+        return os.path.join(CONFIG_DIR, fname[7:])
+    if fname.startswith("test/"):
+        return os.path.join(TEST_DIR, fname[5:])
+    return fname
+
+
+######################################################################
+# Stage instrumentation
+######################################################################
+
+STAGES = ['parse', 'lookahead', 'trapq', 'itersolve', 'stepcompress',
+          'serial_encode']
+
+def get_maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Track exclusive time spent in each stage (nested stages are
+# subtracted from the stage that invoked them).  The growth of the
+# process peak rss while a stage runs is attributed the same way.
+class StageTimer:
+    def __init__(self):
+        self.stats = {s: [0., 0, 0] for s in STAGES}
+        self.stack = []
+        self.get_time = time.perf_counter
+    def enter(self, stage):
+        self.stack.append([stage, self.get_time(), 0., get_maxrss(), 0])
+    def leave(self):
+        stage, start_time, child_time, start_rss, child_rss = self.stack.pop()
+        elapsed = self.get_time() - start_time
+        rss_growth = get_maxrss() - start_rss
+        if self.stack:
+            self.stack[-1][2] += elapsed
+            self.stack[-1][4] += rss_growth
+        st = self.stats[stage]
+        st[0] += elapsed - child_time
+        st[1] += 1
+        st[2] += rss_growth - child_rss
+    def wrap(self, stage, func):
+        enter, leave = self.enter, self.leave
+        def wrapper(*args, **kwargs):
+            enter(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                leave()
+        return wrapper
+    def get_results(self):
+        return {s: {'time': round(t, 6), 'calls': c,
+                    'peak_rss_growth_kb': rss}
+                for s, (t, c, rss) in self.stats.items()}
+
+FFI_STAGES = {
+    'trapq_append': 'trapq', 'trapq_finalize_moves': 'trapq',
+    'trapq_set_position': 'trapq',
+    'steppersync_generate_steps': 'itersolve',
+    'steppersync_flush': 'stepcompress',
+    'serialqueue_send': 'serial_encode',
+}
+
+# Proxy around the chelper library that times selected C functions
+class FFILibProxy:
+    def __init__(self, lib, timer):
+        self._lib = lib
+        self._timer = timer
+    def __getattr__(self, name):
+        func = getattr(self._lib, name)
+        stage = FFI_STAGES.get(name)
+        if stage is not None:
+            func = self._timer.wrap(stage, func)
+        setattr(self, name, func)
+        return func
+
+def setup_instrumentation(timer, counters):
+    import chelper, gcode, toolhead, msgproto
+    chelper.get_ffi()
+    chelper.FFI_lib = FFILibProxy(chelper.FFI_lib, timer)
+    gd = gcode.GCodeDispatch
+    gd._process_commands = timer.wrap('parse', gd._process_commands)
+    th = toolhead.ToolHead
+    orig_move = th.move
+    def move(self, newpos, speed):
+        counters['moves'] += 1
+        orig_move(self, newpos, speed)
+    th.move = timer.wrap('lookahead', move)
+    th._process_lookahead = timer.wrap('lookahead', th._process_lookahead)
+    mf = msgproto.MessageFormat
+    mf.encode = timer.wrap('serial_encode', mf.encode)
+
+
+######################################################################
+# Output file analysis
+######################################################################
+
+def count_steps(dict_fname, out_fname):
+    import msgproto
+    mp = msgproto.MessageParser()
+    f = open(dict_fname, 'rb')
+    mp.process_identify(f.read(), decompress=False)
+    f.close()
+    f = open(out_fname, 'rb')
+    data = bytearray(f.read())
+    f.close()
+    steps = pos = 0
+    while 1:
+        l = mp.check_packet(data[pos:pos+msgproto.MESSAGE_MAX])
+        if l <= 0:
+            break
+        msg = data[pos:pos+l]
+        pos += l
+        mpos = msgproto.MESSAGE_HEADER_SIZE
+        while mpos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            msgid, param_pos = mp.msgid_parser.parse(msg, mpos)
+            mid = mp.messages_by_id.get(msgid, mp.unknown)
+            params, mpos = mid.parse(msg, mpos)
+            if mid.name == 'queue_step':
+                steps += params['count']
+    return steps
+
+
+######################################################################
+# Job execution
+######################################################################
+
+# Run a single job inside this process (invoked via a subprocess)
+def run_job(jobname, config_fname, dict_fname, count, tempdir):
+    sys.path.insert(0, KLIPPY_DIR)
+    import reactor, klippy
+    gen = JOBS[jobname][2]
+    gcode_fname = os.path.join(tempdir, "%s.gcode" % (jobname,))
+    out_fname = os.path.join(tempdir, "%s.serial" % (jobname,))
+    lines = gen(count)
+    f = open(gcode_fname, 'w')
+    f.write("\n".join(lines) + "\n")
+    f.close()
+    timer = StageTimer()
+    counters = {'moves': 0}
+    setup_instrumentation(timer, counters)
+    debuginput = open(gcode_fname, 'rb')
+    start_args = {'config_file': config_fname, 'apiserver': None,
+                  'start_reason': 'startup', 'debuginput': gcode_fname,
+                  'gcode_fd': debuginput.fileno(), 'debugoutput': out_fname,
+                  'dictionary': dict_fname}
+    start_time = time.perf_counter()
+    main_reactor = reactor.Reactor()
+    printer = klippy.Printer(main_reactor, None, start_args)
+    res = printer.run()
+    wall_time = time.perf_counter() - start_time
+    main_reactor.finalize()
+    debuginput.close()
+    steps = count_steps(dict_fname, out_fname)
+    def rate(v):
+        return round(v / wall_time, 1)
+    return {
+        'result': res, 'config': config_fname,
+        'wall_time': round(wall_time, 6), 'gcode_lines': len(lines),
+        'moves': counters['moves'], 'steps': steps,
+        'gcode_lines_per_sec': rate(len(lines)),
+        'moves_per_sec': rate(counters['moves']),
+        'steps_per_sec': rate(steps),
+        'peak_rss_kb': get_maxrss(),
+        'stages': timer.get_results(),
+    }
+
+def launch_job(jobname, options, tempdir):
+    config_fname, dict_name, gen, count = JOBS[jobname]
+    config_fname = lookup_config(options.config or config_fname)
+    dict_fname = options.dictionary
+    if dict_fname is None:
+        dict_fname = os.path.join(options.dictdir, dict_name)
+    count = int(count * options.scale)
+    res_fname = os.path.join(tempdir, "%s.json" % (jobname,))
+    args = [sys.executable, os.path.realpath(__file__), "--run-job",
+            jobname, config_fname, dict_fname, str(count), tempdir, res_fname]
+    stderr = None
+    if options.verbose:
+        args.append("-v")
+    else:
+        stderr = open(os.devnull, 'w')
+    ret = subprocess.call(args, stderr=stderr)
+    if stderr is not None:
+        stderr.close()
+    if ret:
+        return {'result': 'error_exit'}
+    f = open(res_fname, 'r')
+    res = json.load(f)
+    f.close()
+    return res
+
+def get_git_version():
+    try:
+        out = subprocess.check_output(
+            ["git", "-C", KLIPPY_DIR, "describe", "--always", "--tags",
+             "--long", "--dirty"], stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "?"
+
+# Show per-job rate changes between two result files
+def compare(old_fname, res):
+    f = open(old_fname, 'r')
+    old = json.load(f)
+    f.close()
+    out = ["Comparing %s against %s" % (res['version'], old['version'])]
+    for jobname, job in res['jobs'].items():
+        ojob = old['jobs'].get(jobname)
+        if ojob is None or 'wall_time' not in ojob or 'wall_time' not in job:
+            continue
+        for key in ['gcode_lines_per_sec', 'moves_per_sec', 'steps_per_sec']:
+            if not ojob[key]:
+                continue
+            out.append("  %s %s: %.1f -> %.1f (%+.1f%%)" % (
+                jobname, key, ojob[key], job[key],
+                100. * (job[key] - ojob[key]) / ojob[key]))
+        for stage in STAGES:
+            otime = ojob['stages'][stage]['time']
+            ntime = job['stages'][stage]['time']
+            out.append("  %s %s time: %.3fs -> %.3fs" % (
+                jobname, stage, otime, ntime))
+    sys.stderr.write("\n".join(out) + "\n")
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] [jobs]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictdir", dest="dictdir", default=".",
+                    help="directory for dictionary files")
+    opts.add_option("-c", "--config", dest="config",
+                    help="printer config to use for all jobs")
+    opts.add_option("-D", "--dictionary", dest="dictionary",
+                    help="dictionary file to use for all jobs")
+    opts.add_option("-s", "--scale", dest="scale", type="float", default=1.,
+                    help="scale the size of each job")
+    opts.add_option("-o", "--output", dest="output",
+                    help="write json results to file (default is stdout)")
+    opts.add_option("--compare", dest="compare",
+                    help="json results of a previous run to compare against")
+    opts.add_option("-v", action="store_true", dest="verbose",
+                    help="show klippy log output")
+    opts.add_option("--run-job", action="store_true", dest="run_job",
+                    help=optparse.SUPPRESS_HELP)
+    options, args = opts.parse_args()
+    if options.run_job:
+        jobname, config_fname, dict_fname, count, tempdir, res_fname = args
+        if not options.verbose:
+            import logging
+            logging.getLogger().setLevel(logging.WARNING)
+        res = run_job(jobname, config_fname, dict_fname, int(count), tempdir)
+        f = open(res_fname, 'w')
+        json.dump(res, f)
+        f.close()
+        return
+    jobs = args or JOB_ORDER
+    for jobname in jobs:
+        if jobname not in JOBS:
+            opts.error("Unknown job '%s'" % (jobname,))
+    res = {'version': get_git_version(), 'python': sys.version.split()[0],
+           'timestamp': time.time(), 'jobs': {}}
+    with tempfile.TemporaryDirectory(prefix="bench_klippy_") as tempdir:
+        for jobname in jobs:
+            sys.stderr.write("Running job %s\n" % (jobname,))
+            res['jobs'][jobname] = jres = launch_job(jobname, options,
+                                                     tempdir)
+            if 'wall_time' not in jres:
+                sys.stderr.write("Job %s FAILED\n" % (jobname,))
+    data = json.dumps(res, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data + "\n")
+        f.close()
+    else:
+        sys.stdout.write(data + "\n")
+    if options.compare:
+        compare(options.compare, res)
+
+if __name__ == '__main__':
+    main()
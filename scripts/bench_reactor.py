@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# Micro-benchmarks of the host reactor
+#
+# Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, json, random, socket, threading, struct
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'klippy'))
+import reactor
+
+# Many periodic timers (sensor polls, led effects, status updates)
+def bench_timers(r, count, duration):
+    calls = [0]
+    late = [0.]
+    def make_timer(period):
+        def timer_cb(eventtime):
+            calls[0] += 1
+            late[0] += eventtime - tinfo[0].waketime_req
+            tinfo[0].waketime_req = eventtime + period
+            return tinfo[0].waketime_req
+        tinfo = []
+        return timer_cb, tinfo
+    start = r.monotonic()
+    for i in range(count):
+        period = random.uniform(.001, .050)
+        cb, tinfo = make_timer(period)
+        t = r.register_timer(cb, start + random.uniform(0., period))
+        t.waketime_req = t.waketime
+        tinfo.append(t)
+    return calls, late, []
+
+# Greenlets sleeping with reactor.pause() (register/unregister churn)
+# while many other timers are registered
+PAUSE_GREENLETS = 20
+
+def bench_pause(r, count, duration):
+    calls = [0]
+    late = [0.]
+    def sleeper(eventtime):
+        period = random.uniform(.001, .005)
+        waketime = eventtime + random.uniform(0., period)
+        while 1:
+            eventtime = r.pause(waketime)
+            calls[0] += 1
+            late[0] += eventtime - waketime
+            waketime = eventtime + period
+    def idle_cb(eventtime):
+        return eventtime + 1.
+    for i in range(count):
+        r.register_timer(idle_cb, r.monotonic() + random.uniform(0., 1.))
+    for i in range(PAUSE_GREENLETS):
+        r.register_callback(sleeper)
+    return calls, late, []
+
+# Timers rescheduled by other callbacks (completions, update_timer)
+def bench_update(r, count, duration):
+    calls = [0]
+    late = [0.]
+    timers = []
+    def idle_cb(eventtime):
+        calls[0] += 1
+        return r.NEVER
+    def kick_cb(eventtime):
+        for t in random.sample(timers, min(len(timers), 10)):
+            r.update_timer(t, eventtime + random.uniform(0., .010))
+        return eventtime + .001
+    for i in range(count):
+        timers.append(r.register_timer(idle_cb, r.NEVER))
+    r.register_timer(kick_cb, r.NOW)
+    return calls, late, []
+
+# Wakeups from file descriptors (a thread writes to each fd in turn)
+FD_WAKE_RATE = 2000.
+
+def bench_fds(r, count, duration):
+    calls = [0]
+    late = [0.]
+    socks = [socket.socketpair() for i in range(count)]
+    def make_reader(sock):
+        def read_cb(eventtime):
+            data = sock.recv(4096)
+            for i in range(0, len(data), 8):
+                sent_time = struct.unpack_from('<d', data, i)[0]
+                calls[0] += 1
+                late[0] += eventtime - sent_time
+        return read_cb
+    for rsock, wsock in socks:
+        rsock.setblocking(False)
+        r.register_fd(rsock.fileno(), make_reader(rsock))
+    def writer():
+        monotonic = r.monotonic
+        end_time = monotonic() + duration
+        next_time = monotonic()
+        i = 0
+        while next_time < end_time:
+            delay = next_time - monotonic()
+            if delay > 0.:
+                time.sleep(delay)
+            socks[i % count][1].send(struct.pack('<d', monotonic()))
+            i += 1
+            next_time += 1. / FD_WAKE_RATE
+    wthread = threading.Thread(target=writer)
+    r.register_callback((lambda e: wthread.start()))
+    return calls, late, [wthread]
+
+# Completions signaled from other threads (serial response handling)
+ASYNC_MAX_OUTSTANDING = 10000
+
+def bench_async(r, count, duration):
+    calls = [0]
+    late = [0.]
+    class BenchCompletion:
+        def complete(self, sent_time):
+            calls[0] += 1
+            late[0] += r.monotonic() - sent_time
+    completion = BenchCompletion()
+    sent = [0] * count
+    def producer(index):
+        monotonic = r.monotonic
+        end_time = monotonic() + duration
+        while monotonic() < end_time:
+            for i in range(64):
+                r.async_complete(completion, monotonic())
+            sent[index] += 64
+            if sum(sent) - calls[0] > ASYNC_MAX_OUTSTANDING:
+                time.sleep(.0005)
+    threads = [threading.Thread(target=producer, args=(i,))
+               for i in range(count)]
+    for pthread in threads:
+        r.register_callback((lambda e, t=pthread: t.start()))
+    return calls, late, threads
+
+BENCHMARKS = {'timers': (bench_timers, [10, 100, 500]),
+              'pause': (bench_pause, [10, 100, 500]),
+              'update': (bench_update, [10, 100, 500]),
+              'fds': (bench_fds, [1, 10, 100]),
+              'async': (bench_async, [1, 2, 4])}
+
+def run_bench(name, count, duration, reactor_name=None, with_stats=False):
+    r = reactor.lookup_reactor(reactor_name)()
+    if with_stats:
+        r.enable_stats()
+    calls, late, threads = BENCHMARKS[name][0](r, count, duration)
+    def end_cb(eventtime):
+        r.end()
+        return r.NEVER
+    r.register_timer(end_cb, r.monotonic() + duration)
+    # Only account cpu time of the reactor thread
+    start_cpu = time.thread_time()
+    start_process_cpu = time.process_time()
+    start_time = time.perf_counter()
+    r.run()
+    wall_time = time.perf_counter() - start_time
+    cpu_time = time.thread_time() - start_cpu
+    process_cpu_time = time.process_time() - start_process_cpu
+    for t in threads:
+        t.join()
+    r.finalize()
+    ncalls = max(calls[0], 1)
+    return {'benchmark': name, 'count': count, 'callbacks': calls[0],
+            'reactor': r.__class__.__name__, 'reactor_stats': with_stats,
+            'wall_time': round(wall_time, 3), 'cpu_time': round(cpu_time, 3),
+            'cpu_us_per_callback': round(cpu_time * 1000000. / ncalls, 2),
+            'process_cpu_us_per_callback': round(
+                process_cpu_time * 1000000. / ncalls, 2),
+            'avg_late_us': round(late[0] * 1000000. / ncalls, 1)}
+
+# Check that a timer rescheduling itself with reactor.NOW does not
+# starve other timers that are due
+def verify_busy_timer(reactor_name, duration=.500, period=.010):
+    r = reactor.lookup_reactor(reactor_name)()
+    calls = {'busy': 0, 'periodic': 0}
+    def busy_cb(eventtime):
+        calls['busy'] += 1
+        if eventtime > start + 2. * duration:
+            # Other timers starved - don't wait for end_cb
+            r.end()
+        return r.NOW
+    def periodic_cb(eventtime):
+        calls['periodic'] += 1
+        return eventtime + period
+    def end_cb(eventtime):
+        r.end()
+        return r.NEVER
+    start = r.monotonic()
+    r.register_timer(busy_cb, r.NOW)
+    r.register_timer(periodic_cb, start + period)
+    r.register_timer(end_cb, start + duration)
+    r.run()
+    r.finalize()
+    expected = int(duration / period) - 1
+    return {'check': 'busy_timer', 'reactor': r.__class__.__name__,
+            'busy_calls': calls['busy'], 'periodic_calls': calls['periodic'],
+            'expected_periodic_calls': expected,
+            'ok': calls['busy'] > 0 and calls['periodic'] >= expected * .8}
+
+# Check that timers set aside during a pass still run while a later
+# timer in that pass is paused
+def verify_pause_timer(reactor_name, duration=.500, period=.010):
+    r = reactor.lookup_reactor(reactor_name)()
+    calls = {'busy': 0, 'periodic': 0}
+    def busy_cb(eventtime):
+        calls['busy'] += 1
+        if eventtime > start + 2. * duration:
+            r.end()
+        return r.NOW
+    def periodic_cb(eventtime):
+        calls['periodic'] += 1
+        return eventtime + period
+    def pause_cb(eventtime):
+        calls['busy'] = calls['periodic'] = 0
+        r.pause(eventtime + duration)
+        calls['paused_busy'] = calls['busy']
+        calls['paused_periodic'] = calls['periodic']
+        r.end()
+        return r.NEVER
+    start = r.monotonic()
+    r.register_timer(busy_cb, r.NOW)
+    r.register_timer(periodic_cb, start + period)
+    r.register_timer(pause_cb, start + 2. * period)
+    r.run()
+    r.finalize()
+    paused_busy = calls.get('paused_busy', 0)
+    paused_periodic = calls.get('paused_periodic', 0)
+    expected = int(duration / period) - 1
+    return {'check': 'pause_timer', 'reactor': r.__class__.__name__,
+            'paused_busy_calls': paused_busy,
+            'paused_periodic_calls': paused_periodic,
+            'expected_periodic_calls': expected,
+            'ok': paused_busy > 0 and paused_periodic >= expected * .8}
+
+def run_verify(reactors):
+    res = [check(rname) for rname in reactors
+           for check in (verify_busy_timer, verify_pause_timer)]
+    for r in res:
+        if not r['ok']:
+            sys.stderr.write("Check %s failed on %s\n"
+                             % (r['check'], r['reactor']))
+    return res
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-b", "--benchmark", dest="benchmarks", action="append",
+                    help="benchmark to run (%s)" % (
+                        ", ".join(sorted(BENCHMARKS)),))
+    opts.add_option("-n", "--count", dest="counts", action="append",
+                    type="int", help="number of timers, fds, or threads")
+    opts.add_option("-t", "--time", dest="duration", type="float",
+                    default=2., help="seconds to run each benchmark")
+    opts.add_option("-r", "--reactor", dest="reactors", action="append",
+                    help="reactor implementation (%s)" % (
+                        ", ".join(sorted(reactor.REACTORS)),))
+    opts.add_option("-s", "--stats", action="store_true",
+                    help="enable reactor callback instrumentation")
+    opts.add_option("--verify", action="store_true",
+                    help="check timer scheduling instead of benchmarking")
+    opts.add_option("-o", "--output", dest="output",
+                    help="write json results to file (default is stdout)")
+    options, args = opts.parse_args()
+    if len(args) != 0:
+        opts.error("Incorrect number of arguments")
+    benchmarks = options.benchmarks or sorted(BENCHMARKS)
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            opts.error("Unknown benchmark '%s'" % (name,))
+    reactors = options.reactors or [None]
+    for name in reactors:
+        if name is not None and name not in reactor.REACTORS:
+            opts.error("Unknown reactor '%s'" % (name,))
+    random.seed(0)
+    if options.verify:
+        res = run_verify(options.reactors or sorted(reactor.REACTORS))
+    else:
+        res = [run_bench(name, count, options.duration, rname, options.stats)
+               for name in benchmarks for rname in reactors
+               for count in (options.counts or BENCHMARKS[name][1])]
+    data = json.dumps(res, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data + "\n")
+        f.close()
+    else:
+        sys.stdout.write(data + "\n")
+    if options.verify and not all([r['ok'] for r in res]):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
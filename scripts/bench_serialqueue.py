@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# Benchmark of mcu response processing in the host serial thread
+#
+# Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, threading, time, json, random, zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'klippy'))
+import reactor, serialhdl, msgproto
+
+# Build a message block as it would be sent by the mcu
+def build_block(seq, cmd):
+    msglen = msgproto.MESSAGE_MIN + len(cmd)
+    out = [msglen, (seq & msgproto.MESSAGE_SEQ_MASK) | msgproto.MESSAGE_DEST]
+    out += cmd
+    out += msgproto.crc16_ccitt(out)
+    out.append(msgproto.MESSAGE_SYNC)
+    return bytes(bytearray(out))
+
+# Simulate a high rate sensor streaming "identify_response" messages
+def gen_stream(count, data_len):
+    mp = msgproto.MessageParser()
+    fmt = mp.messages_by_name['identify_response']
+    data = bytes(bytearray(range(data_len)))
+    # The host starts with a receive sequence of 1 - keep using it so
+    # that every block is accepted as a data message
+    return b"".join([build_block(1, fmt.encode([i & 0xffff, data]))
+                     for i in range(count)])
+
+# Responses decoded by serialhdl.FastDecoder (plus signed test formats)
+VERIFY_DICT = {
+    'responses': {
+        'sensor_bulk_data oid=%c sequence=%hu data=%*s': 80,
+        'i2c_read_response oid=%c response=%*s': 81,
+        'trsync_state oid=%c can_trigger=%c trigger_reason=%c clock=%u': -7,
+        'test_signed oid=%c a=%i b=%hi c=%u d=%.*s': 83,
+    },
+    'commands': {}, 'output': {},
+}
+
+def gen_value(t):
+    if t.is_dynamic_string:
+        return bytes(bytearray(random.randrange(256)
+                               for i in range(random.randrange(24))))
+    bits = {2: 8, 3: 16}.get(t.max_length, 32)
+    if t.signed:
+        return random.randrange(-(1 << (bits - 1)), 1 << (bits - 1))
+    return random.randrange(1 << bits)
+
+# Check the C decoder against the reference msgproto parser
+def run_verify(count):
+    mp = msgproto.MessageParser()
+    mp.process_identify(json.dumps(VERIFY_DICT).encode(), decompress=False)
+    fd = serialhdl.FastDecoder(mp, [m.split()[0]
+                                    for m in VERIFY_DICT['responses']])
+    formats = [mp.messages_by_name[n] for n in fd.get_names()]
+    responses = fd.ffi_main.new('struct pull_queue_message[%d]'
+                                % (serialhdl.PULL_BATCH_SIZE,))
+    checked = 0
+    while checked < count:
+        expected = []
+        for i in range(serialhdl.PULL_BATCH_SIZE):
+            fmt = random.choice(formats)
+            block = build_block(1, fmt.encode(
+                [gen_value(t) for t in fmt.param_types]))
+            responses[i].msg[0:len(block)] = block
+            responses[i].len = len(block)
+            responses[i].notify_id = 0
+            expected.append(mp.parse(block))
+        decoded = fd.decode(responses, serialhdl.PULL_BATCH_SIZE)
+        for i, params in enumerate(expected):
+            if decoded[i].format < 0:
+                raise Exception("Message not decoded: %s" % (params,))
+            got = fd.get_params(decoded[i])
+            if got != params:
+                raise Exception("Mismatch: %s != %s" % (got, params))
+        checked += serialhdl.PULL_BATCH_SIZE
+    return {'verified_messages': checked, 'formats': fd.get_names()}
+
+def run_bench(count, data_len, fast_decode):
+    stream = gen_stream(count, data_len)
+    mcu_sock, host_sock = socket.socketpair()
+    main_reactor = reactor.Reactor()
+    sr = serialhdl.SerialReader(main_reactor, mcu_name="bench")
+    if fast_decode:
+        sr.fast_decoder = serialhdl.FastDecoder(sr.msgparser,
+                                                ['identify_response'])
+    done = threading.Event()
+    received = [0]
+    def handle_response(params):
+        received[0] += 1
+        if received[0] >= count:
+            done.set()
+    sr.register_response(handle_response, 'identify_response')
+    sr.serial_dev = host_sock
+    sr.serialqueue = sr.ffi_main.gc(
+        sr.ffi_lib.serialqueue_alloc(host_sock.fileno(), b'u', 0,
+                                     sr.sq_name),
+        sr.ffi_lib.serialqueue_free)
+    sr.background_thread = threading.Thread(target=sr._bg_thread)
+    sr.background_thread.start()
+    def writer():
+        mcu_sock.sendall(stream)
+    wthread = threading.Thread(target=writer)
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+    wthread.start()
+    done.wait(60.)
+    wall_time = time.perf_counter() - start_time
+    cpu_time = time.process_time() - start_cpu
+    wthread.join()
+    sr.disconnect()
+    mcu_sock.close()
+    main_reactor.finalize()
+    return {'messages': received[0], 'data_len': data_len,
+            'fast_decode': fast_decode,
+            'wall_time': round(wall_time, 6), 'cpu_time': round(cpu_time, 6),
+            'messages_per_sec': round(received[0] / wall_time, 1),
+            'messages_per_cpu_sec': round(received[0] / cpu_time, 1)}
+
+# Simulate an mcu answering identify requests with a fixed round trip time
+def identify_responder(sock, identify_data, rtt):
+    mp = msgproto.MessageParser()
+    fmt = mp.messages_by_name['identify_response']
+    buf = b""
+    while 1:
+        data = sock.recv(4096)
+        if not data:
+            return
+        buf += data
+        while buf:
+            msglen = mp.check_packet(bytearray(buf))
+            if not msglen:
+                break
+            if msglen < 0:
+                buf = buf[1:]
+                continue
+            block, buf = bytearray(buf[:msglen]), buf[msglen:]
+            if msglen == msgproto.MESSAGE_MIN:
+                continue
+            params = mp.parse(block)
+            if params['#name'] != 'identify':
+                continue
+            time.sleep(rtt)
+            offset = params['offset']
+            chunk = identify_data[offset:offset+params['count']]
+            seq = block[msgproto.MESSAGE_POS_SEQ] + 1
+            sock.sendall(build_block(seq, [])
+                         + build_block(seq, fmt.encode([offset, chunk])))
+
+def run_identify(dict_fname, rtt, cache_fname):
+    f = open(dict_fname, 'rb')
+    identify_data = zlib.compress(f.read())
+    f.close()
+    mcu_sock, host_sock = socket.socketpair()
+    rthread = threading.Thread(target=identify_responder,
+                               args=(mcu_sock, identify_data, rtt))
+    rthread.start()
+    main_reactor = reactor.Reactor()
+    sr = serialhdl.SerialReader(main_reactor, mcu_name="bench")
+    if cache_fname is not None:
+        sr.set_identify_cache(cache_fname)
+    result = {}
+    def connect(eventtime):
+        start_time = time.perf_counter()
+        result['connected'] = sr._start_session(host_sock)
+        result['connect_time'] = round(time.perf_counter() - start_time, 6)
+        main_reactor.end()
+    main_reactor.register_callback(connect)
+    main_reactor.run()
+    sr.disconnect()
+    mcu_sock.close()
+    rthread.join()
+    main_reactor.finalize()
+    result.update({'identify_bytes': len(identify_data),
+                   'rtt': rtt, 'cache': cache_fname is not None})
+    return result
+
+# Measure connect time with an empty and with a populated identify cache
+def run_identify_bench(dict_fname, rtt):
+    cache_fname = "/tmp/bench_identify_%d.dict" % (os.getpid(),)
+    res = {'no_cache': run_identify(dict_fname, rtt, None),
+           'cache_miss': run_identify(dict_fname, rtt, cache_fname),
+           'cache_hit': run_identify(dict_fname, rtt, cache_fname)}
+    os.remove(cache_fname)
+    return res
+
+# Check that a session kept over a warm restart works with a new reactor
+def run_restart_check(dict_fname):
+    f = open(dict_fname, 'rb')
+    identify_data = zlib.compress(f.read())
+    f.close()
+    mcu_sock, host_sock = socket.socketpair()
+    rthread = threading.Thread(target=identify_responder,
+                               args=(mcu_sock, identify_data, 0.))
+    rthread.start()
+    # Connect using the first host instance
+    old_reactor = reactor.Reactor()
+    sr = serialhdl.SerialReader(old_reactor, mcu_name="bench")
+    def connect(eventtime):
+        sr._start_session(host_sock)
+        old_reactor.end()
+    old_reactor.register_callback(connect)
+    old_reactor.run()
+    # A completion still pending when the old instance exits
+    sr.pending_notifications[1 << 30] = old_reactor.completion()
+    old_reactor.finalize()
+    # Move the session to the next host instance
+    new_reactor = reactor.Reactor()
+    sr.set_reactor(new_reactor)
+    unused_sr = serialhdl.SerialReader(new_reactor, mcu_name="bench")
+    responses = []
+    unused_sr.register_response(responses.append, 'identify_response')
+    sr.resume_session(unused_sr)
+    result = {
+        'stale_completions': len(sr.pending_notifications),
+        'output_handler': sr.handlers['#output', None] == sr.handle_output,
+        'unknown_handler': sr.handlers['#unknown', None] == sr.handle_unknown}
+    def query(eventtime):
+        cmd = sr.get_msgparser().create_command(
+            "identify offset=0 count=%d" % (serialhdl.IDENTIFY_CHUNK,))
+        params = sr.raw_send_wait_ack(cmd, 0, 0, sr.get_default_command_queue())
+        result['acked'] = params is not None
+        new_reactor.pause(new_reactor.monotonic() + .100)
+        new_reactor.end()
+    new_reactor.register_callback(query)
+    new_reactor.run()
+    sr.disconnect()
+    mcu_sock.close()
+    rthread.join()
+    new_reactor.finalize()
+    result['responses'] = len(responses)
+    result['ok'] = (not result['stale_completions'] and result['acked']
+                    and result['output_handler'] and result['unknown_handler']
+                    and result['responses'] == 1)
+    return result
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", dest="count", type="int", default=200000,
+                    help="number of messages to send")
+    opts.add_option("-l", "--length", dest="data_len", type="int", default=48,
+                    help="payload bytes in each message")
+    opts.add_option("-p", "--python", action="store_true",
+                    help="decode with the python msgproto parser only")
+    opts.add_option("--verify", action="store_true",
+                    help="check the C decoder against the msgproto parser")
+    opts.add_option("--identify", dest="identify",
+                    help="measure connect time using the given data dictionary")
+    opts.add_option("--rtt", dest="rtt", type="float", default=0.002,
+                    help="simulated identify round trip time (seconds)")
+    opts.add_option("--restart", dest="restart",
+                    help="check a session kept over a warm restart using"
+                    " the given data dictionary")
+    opts.add_option("-o", "--output", dest="output",
+                    help="write json results to file (default is stdout)")
+    options, args = opts.parse_args()
+    if len(args) != 0:
+        opts.error("Incorrect number of arguments")
+    if options.identify:
+        res = run_identify_bench(options.identify, options.rtt)
+    elif options.restart:
+        res = run_restart_check(options.restart)
+    elif options.verify:
+        res = run_verify(options.count)
+    else:
+        res = run_bench(options.count, options.data_len, not options.python)
+    data = json.dumps(res, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data + "\n")
+        f.close()
+    else:
+        sys.stdout.write(data + "\n")
+    if options.restart and not res['ok']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
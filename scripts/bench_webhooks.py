@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# Benchmark of the webhooks objects/subscribe status polling
+#
+# Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, json, socket, threading, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'klippy'))
+import reactor, webhooks
+
+FIELDS = 8
+
+# Printer object with status that only changes when update() is called
+class StatusObject:
+    def __init__(self, index):
+        self.index = index
+        self.counter = 0
+        self.status = self._build_status()
+    def _build_status(self):
+        status = {'field%d' % (i,): float(self.index + i)
+                  for i in range(FIELDS - 2)}
+        status['name'] = 'object%d' % (self.index,)
+        status['counter'] = self.counter
+        return status
+    def update(self):
+        self.counter += 1
+        self.status = self._build_status()
+    def get_status(self, eventtime):
+        return dict(self.status)
+
+class VersionedStatusObject(StatusObject):
+    def get_status_version(self):
+        return self.counter
+
+class BenchPrinter:
+    def __init__(self, objects):
+        self.reactor = reactor.Reactor()
+        self.objects = objects
+    def get_reactor(self):
+        return self.reactor
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def lookup_objects(self, module=None):
+        return list(self.objects.items())
+    def register_endpoint(self, path, callback):
+        pass
+
+class BenchClient:
+    def __init__(self):
+        self.messages = 0
+    def is_closed(self):
+        return False
+    def send(self, data):
+        self.messages += 1
+
+def run_bench(obj_count, client_count, cycles, change_ratio, versioned):
+    objclass = VersionedStatusObject if versioned else StatusObject
+    objects = {'object%d' % (i,): objclass(i) for i in range(obj_count)}
+    printer = BenchPrinter(objects)
+    printer.objects['webhooks'] = printer
+    helper = webhooks.QueryStatusHelper(printer)
+    del printer.objects['webhooks']
+    group = helper._get_group(webhooks.SUBSCRIPTION_REFRESH_TIME)
+    clients = [BenchClient() for i in range(client_count)]
+    for client in clients:
+        subscription = {name: None for name in objects}
+        group.clients[client] = (client, subscription, client.send, {}, False)
+    objlist = list(objects.values())
+    change_count = int(obj_count * change_ratio + .5)
+    eventtime = 0.
+    group._do_query(eventtime)
+    start_cpu = time.process_time()
+    for cycle in range(cycles):
+        for i in range(change_count):
+            objlist[(cycle * change_count + i) % obj_count].update()
+        eventtime += webhooks.SUBSCRIPTION_REFRESH_TIME
+        group._do_query(eventtime)
+    cpu_time = time.process_time() - start_cpu
+    printer.reactor.finalize()
+    return {'objects': obj_count, 'clients': client_count,
+            'cycles': cycles, 'changed_per_cycle': change_count,
+            'versioned': versioned, 'cpu_time': round(cpu_time, 6),
+            'usec_per_cycle': round(cpu_time * 1000000. / cycles, 1),
+            'messages': sum([c.messages for c in clients])}
+
+# Printer stand-in for running the webhooks api server
+class ServerPrinter:
+    command_error = Exception
+    def __init__(self, address):
+        self.reactor = reactor.Reactor()
+        self.start_args = {'apiserver': address}
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return self.start_args
+    def register_event_handler(self, event, callback):
+        pass
+    def set_rollover_info(self, name, info, log=True):
+        pass
+    def invoke_shutdown(self, msg):
+        raise Exception(msg)
+
+def bench_request_client(sock, count, batch_size, result):
+    # Simulate a driver querying several endpoints in each burst
+    methods = ['bench/position', 'bench/vacuum', 'bench/feeder']
+    def encode(i):
+        return {'id': i, 'method': methods[i % len(methods)],
+                'params': {'index': i}}
+    def read_response():
+        data = b''
+        while not data.endswith(b'\x03'):
+            data += sock.recv(65536)
+    start_time = time.perf_counter()
+    if batch_size:
+        for i in range(0, count, batch_size):
+            req = [encode(j) for j in range(i, min(i + batch_size, count))]
+            sock.sendall(json.dumps(req).encode() + b'\x03')
+            read_response()
+    else:
+        for i in range(count):
+            sock.sendall(json.dumps(encode(i)).encode() + b'\x03')
+            read_response()
+    result['wall_time'] = time.perf_counter() - start_time
+
+def run_request_bench(address, count, batch_size):
+    printer = ServerPrinter(address)
+    wh = webhooks.WebHooks(printer)
+    def handle_query(web_request):
+        web_request.send({'index': web_request.get_int('index')})
+    for method in ['bench/position', 'bench/vacuum', 'bench/feeder']:
+        wh.register_endpoint(method, handle_query)
+    if address.startswith('tcp://'):
+        sock = socket.create_connection(wh.sconn.sock.getsockname()[:2])
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    result = {}
+    def client_thread():
+        try:
+            bench_request_client(sock, count, batch_size, result)
+        finally:
+            printer.reactor.register_async_callback(
+                (lambda e: printer.reactor.end()))
+    thread = threading.Thread(target=client_thread)
+    start_cpu = time.process_time()
+    thread.start()
+    printer.reactor.run()
+    cpu_time = time.process_time() - start_cpu
+    thread.join()
+    sock.close()
+    wh.sconn._handle_disconnect()
+    printer.reactor.finalize()
+    if not address.startswith('tcp://'):
+        os.remove(address)
+    wall_time = result['wall_time']
+    return {'address': address.split(':')[0], 'requests': count,
+            'batch_size': batch_size, 'wall_time': round(wall_time, 6),
+            'requests_per_sec': round(count / wall_time, 1),
+            'usec_cpu_per_request': round(cpu_time * 1000000. / count, 1)}
+
+def run_request_benches(count):
+    res = []
+    for address in ["/tmp/bench_webhooks_%d" % (os.getpid(),),
+                    "tcp://127.0.0.1:7120"]:
+        for batch_size in [0, 3, 30]:
+            res.append(run_request_bench(address, count, batch_size))
+    return res
+
+# G-Code handler stand-in for checking the gcode/stream endpoint.  The
+# script "OUT <msg>" responds with msg, "WAIT" pauses and "FAIL" raises
+# an error.
+class VerifyGCode:
+    def __init__(self, printer):
+        self.printer = printer
+        self.mutex = printer.reactor.mutex()
+        self.output_callbacks = []
+    def register_output_handler(self, cb):
+        self.output_callbacks.append(cb)
+    def remove_output_handler(self, cb):
+        self.output_callbacks.remove(cb)
+    def get_mutex(self):
+        return self.mutex
+    def run_script_from_command(self, script):
+        for line in script.split('\n'):
+            if line.startswith('OUT '):
+                for cb in self.output_callbacks:
+                    cb(line[4:])
+            elif line == 'WAIT':
+                reactor = self.printer.reactor
+                reactor.pause(reactor.monotonic() + .050)
+            elif line == 'FAIL':
+                raise self.printer.command_error("Failed")
+    def run_script(self, script):
+        with self.mutex:
+            self.run_script_from_command(script)
+
+class VerifyPrinter(ServerPrinter):
+    def __init__(self, address):
+        ServerPrinter.__init__(self, address)
+        self.objects = {}
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+
+def verify_client(sock_a, sock_b, result):
+    def request(sock, req):
+        sock.sendall(json.dumps(req).encode() + b'\x03')
+    def read_messages(sock, count):
+        data = b''
+        while data.count(b'\x03') < count:
+            data += sock.recv(65536)
+        return [json.loads(m) for m in data.split(b'\x03') if m]
+    # A script from another client holds the mutex while a stream starts
+    request(sock_b, {'id': 1, 'method': 'gcode/script',
+                     'params': {'script': 'WAIT\nOUT other'}})
+    time.sleep(.010)
+    template = {'method': 'ack'}
+    request(sock_a, {'id': 2, 'method': 'gcode/stream', 'params': {
+        'response_template': template, 'commands': [
+            {'id': 'a', 'script': 'OUT a'}, {'id': 'b', 'script': 'FAIL'},
+            {'id': 'c', 'script': 'OUT c'}]}})
+    msgs = read_messages(sock_a, 4)
+    read_messages(sock_b, 1)
+    result['acks'] = {m['params']['id']: (m['params']['output'],
+                                          m['params'].get('error'))
+                      for m in msgs if m.get('method') == 'ack'}
+
+# Check the gcode/stream acknowledgements and stream cleanup
+def verify_gcode_stream():
+    address = "/tmp/bench_webhooks_%d" % (os.getpid(),)
+    printer = VerifyPrinter(address)
+    wh = printer.objects['webhooks'] = webhooks.WebHooks(printer)
+    printer.objects['gcode'] = VerifyGCode(printer)
+    helper = webhooks.GCodeHelper(printer)
+    socks = []
+    for i in range(2):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        socks.append(sock)
+    result = {}
+    def client_thread():
+        try:
+            verify_client(socks[0], socks[1], result)
+            socks[0].close()
+            time.sleep(.100)
+        finally:
+            printer.reactor.register_async_callback(
+                (lambda e: printer.reactor.end()))
+    thread = threading.Thread(target=client_thread)
+    thread.start()
+    printer.reactor.run()
+    thread.join()
+    socks[1].close()
+    open_streams = len(helper.streams)
+    wh.sconn._handle_disconnect()
+    printer.reactor.finalize()
+    os.remove(address)
+    acks = result.get('acks', {})
+    expected = {'a': (['a'], None), 'b': ([], 'Failed'),
+                'c': ([], 'Skipped due to earlier error')}
+    return {'check': 'gcode_stream',
+            'acks': {k: list(v) for k, v in acks.items()},
+            'open_streams': open_streams,
+            'ok': acks == expected and not open_streams}
+
+# Bulk sensor batches in the format sent by the api server endpoints
+def gen_adxl345_batch(index, rate=3200, interval=.100):
+    count = int(rate * interval)
+    start = 1000. + index * interval
+    return {'data': [(round(start + i / float(rate), 6),
+                      round(random.uniform(-20000., 20000.), 6),
+                      round(random.uniform(-20000., 20000.), 6),
+                      round(random.uniform(-20000., 20000.), 6))
+                     for i in range(count)],
+            'errors': 0, 'overflows': 0}
+
+def gen_load_cell_batch(index, rate=2000, interval=.100):
+    count = int(rate * interval)
+    start = 1000. + index * interval
+    tare_counts = 123456
+    data = []
+    for i in range(count):
+        counts = tare_counts + random.randrange(-300000, 300000)
+        grams = (counts - tare_counts) * 0.000761234
+        data.append([round(start + i / float(rate), 6), grams, counts,
+                     tare_counts])
+    return {'data': data, 'errors': 0, 'overflows': 0}
+
+BULK_STREAMS = {'adxl345/dump_adxl345': gen_adxl345_batch,
+                'load_cell/dump_force': gen_load_cell_batch}
+
+# Socket stand-in that accepts and counts all data
+class CountingSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes = 0
+    def fileno(self):
+        return self.sock.fileno()
+    def send(self, data):
+        self.bytes += len(data)
+        return len(data)
+    def sendmsg(self, chunks):
+        sent = sum([len(c) for c in chunks])
+        self.bytes += sent
+        return sent
+    def close(self):
+        self.sock.close()
+
+def run_bulk_bench(stream, encoding, count):
+    printer = ServerPrinter(None)
+    server = webhooks.ServerSocket(None, printer)
+    sock_a, sock_b = socket.socketpair()
+    cconn = webhooks.ClientConnection(server, sock_a)
+    cconn.sock = csock = CountingSocket(sock_a)
+    cconn.encoding = encoding
+    batches = [BULK_STREAMS[stream](i) for i in range(count)]
+    samples = sum([len(b['data']) for b in batches])
+    start_cpu = time.process_time()
+    for batch in batches:
+        cconn.send_update({'params': batch})
+    cpu_time = time.process_time() - start_cpu
+    cconn.close()
+    sock_b.close()
+    printer.reactor.finalize()
+    return {'stream': stream, 'encoding': encoding, 'batches': count,
+            'samples': samples, 'bytes': csock.bytes,
+            'bytes_per_sample': round(csock.bytes / float(samples), 2),
+            'cpu_time': round(cpu_time, 6),
+            'usec_per_sample': round(cpu_time * 1000000. / samples, 3)}
+
+def run_bulk_benches(count):
+    encodings = ['json']
+    if webhooks.msgpack_dumps is not None:
+        encodings.append('msgpack')
+    return [run_bulk_bench(stream, encoding, count)
+            for stream in sorted(BULK_STREAMS) for encoding in encodings]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--objects", dest="objects", type="int",
+                    default=150, help="number of subscribed printer objects")
+    opts.add_option("-c", "--clients", dest="clients", type="int", default=4,
+                    help="number of subscribed clients")
+    opts.add_option("-t", "--cycles", dest="cycles", type="int", default=2000,
+                    help="number of status polling cycles")
+    opts.add_option("-r", "--change-ratio", dest="change_ratio",
+                    type="float", default=.05,
+                    help="fraction of objects changing each cycle")
+    opts.add_option("--requests", dest="requests", type="int", default=0,
+                    help="measure request throughput over the api sockets")
+    opts.add_option("--bulk", dest="bulk", type="int", default=0,
+                    help="measure encoding of the given number of bulk"
+                    " sensor batches")
+    opts.add_option("--verify", action="store_true",
+                    help="check the gcode/stream endpoint instead of"
+                    " benchmarking")
+    opts.add_option("-o", "--output", dest="output",
+                    help="write json results to file (default is stdout)")
+    options, args = opts.parse_args()
+    if len(args) != 0:
+        opts.error("Incorrect number of arguments")
+    if options.verify:
+        res = [verify_gcode_stream()]
+        if not res[0]['ok']:
+            sys.stderr.write("Check %s failed\n" % (res[0]['check'],))
+    elif options.requests:
+        res = run_request_benches(options.requests)
+    elif options.bulk:
+        res = run_bulk_benches(options.bulk)
+    else:
+        res = [run_bench(options.objects, options.clients, options.cycles,
+                         options.change_ratio, versioned)
+               for versioned in [False, True]]
+    data = json.dumps(res, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(data + "\n")
+        f.close()
+    else:
+        sys.stdout.write(data + "\n")
+    if options.verify and not all([r['ok'] for r in res]):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
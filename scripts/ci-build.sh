@@ -78,6 +78,10 @@ start_test klippy "Test invoke klippy (Python3)"
 $PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy (Python3)"
 
+start_test klippy "Test invoke klippy with epoll reactor"
+$PYTHON scripts/test_klippy.py -d ${DICTDIR} -r epoll test/klippy/commands.test test/klippy/macros.test test/klippy/linuxtest.test
+finish_test klippy "Test invoke klippy with epoll reactor"
+
 # start_test klippy "Test invoke klippy (Python2)"
 # $PYTHON2 scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 # finish_test klippy "Test invoke klippy (Python2)"
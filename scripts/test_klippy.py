@@ -18,12 +18,14 @@ class error(Exception):
     pass
 
 class TestCase:
-    def __init__(self, fname, dictdir, tempdir, verbose, keepfiles):
+    def __init__(self, fname, dictdir, tempdir, verbose, keepfiles,
+                 reactor=None):
         self.fname = fname
         self.dictdir = dictdir
         self.tempdir = tempdir
         self.verbose = verbose
         self.keepfiles = keepfiles
+        self.reactor = reactor
     def relpath(self, fname, rel='test'):
         if rel == 'dict':
             reldir = self.dictdir
@@ -96,6 +98,8 @@ class TestCase:
             args += ['-d', df]
         if not self.verbose:
             args += ['-l', TEMP_LOG_FILE]
+        if self.reactor is not None:
+            args += ['--reactor', self.reactor]
         res = subprocess.call(args)
         is_fail = (should_fail and not res) or (not should_fail and res)
         if is_fail:
@@ -148,6 +152,8 @@ def main():
                     help="do not remove temporary files")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="show all output from tests")
+    opts.add_option("-r", "--reactor", dest="reactor",
+                    help="reactor implementation to run klippy with")
     options, args = opts.parse_args()
     if len(args) < 1:
         opts.error("Incorrect number of arguments")
@@ -156,7 +162,7 @@ def main():
     # Run each test
     for fname in args:
         tc = TestCase(fname, options.dictdir, options.tempdir, options.verbose,
-                      options.keepfiles)
+                      options.keepfiles, options.reactor)
         res = tc.run()
         if res != 'success':
             sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (fname, res))
@@ -4,11 +4,19 @@
 //
 // This file may be distributed under the terms of the GNU GPLv3 license.
 
+#include "autoconf.h" // CONFIG_WANT_ADC_BULK
+#include "adccmds.h" // analog_in_bulk_note_sample
 #include "basecmd.h" // oid_alloc
 #include "board/gpio.h" // struct gpio_adc
 #include "board/irq.h" // irq_disable
+#include "board/misc.h" // timer_read_time
 #include "command.h" // DECL_COMMAND
 #include "sched.h" // DECL_TASK
+#include "trsync.h" // trsync_do_trigger
+
+enum {
+    AH_AWAIT_HOMING = 1<<0, AH_CAN_TRIGGER = 1<<1, AH_TRIGGER_BELOW = 1<<2,
+};
 
 struct analog_in {
     struct timer timer;
@@ -17,10 +25,82 @@ struct analog_in {
     struct gpio_adc pin;
     uint8_t invalid_count, range_check_count;
     uint8_t state, sample_count;
+    // homing
+    struct trsync *ts;
+    uint32_t home_clock, home_rest_time;
+    uint16_t trigger_value, home_value;
+    uint8_t home_flags, trigger_reason, extra_pending;
+    // bulk sampling
+    struct analog_in_bulk *bulk;
+    uint32_t bulk_rest_time;
 };
 
 static struct task_wake analog_wake;
 
+// Check if a sample should trigger a homing event
+static void
+check_home(struct analog_in *a, uint16_t value)
+{
+    uint8_t home_flags = a->home_flags;
+    uint32_t time = timer_read_time();
+    if ((home_flags & AH_AWAIT_HOMING)
+        && timer_is_before(time, a->home_clock))
+        return;
+    home_flags &= ~AH_AWAIT_HOMING;
+    if (home_flags & AH_TRIGGER_BELOW ? value < a->trigger_value
+        : value > a->trigger_value) {
+        home_flags = 0;
+        a->home_clock = time;
+        a->home_value = value;
+        trsync_do_trigger(a->ts, a->trigger_reason);
+    }
+    a->home_flags = home_flags;
+}
+
+// Return the interval of extra samples taken between report sample sets
+static uint32_t
+extra_rest_time(struct analog_in *a)
+{
+    uint32_t rest_time = 0;
+    if (a->home_flags & AH_CAN_TRIGGER)
+        rest_time = a->home_rest_time;
+    if (a->bulk && (!rest_time || a->bulk_rest_time < rest_time))
+        rest_time = a->bulk_rest_time;
+    return rest_time;
+}
+
+// Schedule the next sample (interleaving extra samples between reports)
+static uint_fast8_t
+analog_in_reschedule(struct analog_in *a)
+{
+    uint32_t waketime = a->next_begin_time;
+    uint32_t rest_time = extra_rest_time(a);
+    if (rest_time) {
+        uint32_t extra_time = a->timer.waketime + rest_time;
+        if (timer_is_before(extra_time, waketime)) {
+            waketime = extra_time;
+            a->extra_pending = 1;
+        }
+    }
+    a->timer.waketime = waketime;
+    return SF_RESCHEDULE;
+}
+
+// Start taking extra samples at the given time (must be called with
+// irqs disabled)
+static void
+analog_in_kick(struct analog_in *a, uint32_t waketime)
+{
+    if (a->state < a->sample_count || a->extra_pending
+        || !timer_is_before(waketime, a->timer.waketime))
+        // Extra samples will be scheduled when the current sample completes
+        return;
+    sched_del_timer(&a->timer);
+    a->timer.waketime = waketime;
+    a->extra_pending = 1;
+    sched_add_timer(&a->timer);
+}
+
 static uint_fast8_t
 analog_in_event(struct timer *timer)
 {
@@ -31,6 +111,15 @@ analog_in_event(struct timer *timer)
         return SF_RESCHEDULE;
     }
     uint16_t value = gpio_adc_read(a->pin);
+    if (a->home_flags & AH_CAN_TRIGGER)
+        check_home(a, value);
+    if (CONFIG_WANT_ADC_BULK && a->bulk)
+        analog_in_bulk_note_sample(a->bulk, timer_read_time(), value);
+    if (a->extra_pending) {
+        // Sample was only taken for a homing check or bulk report
+        a->extra_pending = 0;
+        return analog_in_reschedule(a);
+    }
     uint8_t state = a->state;
     if (state >= a->sample_count) {
         state = 0;
@@ -54,8 +143,7 @@ analog_in_event(struct timer *timer)
     }
     sched_wake_task(&analog_wake);
     a->next_begin_time += a->rest_time;
-    a->timer.waketime = a->next_begin_time;
-    return SF_RESCHEDULE;
+    return analog_in_reschedule(a);
 }
 
 void
@@ -76,6 +164,7 @@ command_query_analog_in(uint32_t *args)
     struct analog_in *a = oid_lookup(args[0], command_config_analog_in);
     sched_del_timer(&a->timer);
     gpio_adc_cancel_sample(a->pin);
+    a->home_flags = a->extra_pending = 0;
     a->next_begin_time = args[1];
     a->timer.waketime = a->next_begin_time;
     a->sample_time = args[2];
@@ -93,6 +182,62 @@ DECL_COMMAND(command_query_analog_in,
              "query_analog_in oid=%c clock=%u sample_ticks=%u sample_count=%c"
              " rest_ticks=%u min_value=%hu max_value=%hu range_check_count=%c");
 
+void
+command_analog_in_setup_home(uint32_t *args)
+{
+    struct analog_in *a = oid_lookup(args[0], command_config_analog_in);
+    irq_disable();
+    a->home_flags = 0;
+    if (!args[1]) {
+        irq_enable();
+        return;
+    }
+    if (!a->sample_count)
+        shutdown("Can not home on an idle analog input");
+    a->home_clock = args[1];
+    a->home_rest_time = args[2];
+    a->trigger_value = args[3];
+    a->ts = trsync_oid_lookup(args[5]);
+    a->trigger_reason = args[6];
+    a->home_flags = (AH_AWAIT_HOMING | AH_CAN_TRIGGER
+                     | (args[4] ? AH_TRIGGER_BELOW : 0));
+    analog_in_kick(a, a->home_clock);
+    irq_enable();
+}
+DECL_COMMAND(command_analog_in_setup_home,
+             "analog_in_setup_home oid=%c clock=%u rest_ticks=%u"
+             " trigger_value=%hu trigger_below=%c trsync_oid=%c"
+             " trigger_reason=%c");
+
+void
+command_query_analog_in_home_state(uint32_t *args)
+{
+    struct analog_in *a = oid_lookup(args[0], command_config_analog_in);
+    sendf("analog_in_home_state oid=%c homing=%c trigger_clock=%u value=%hu"
+          , args[0], !!(a->home_flags & AH_CAN_TRIGGER), a->home_clock
+          , a->home_value);
+}
+DECL_COMMAND(command_query_analog_in_home_state,
+             "query_analog_in_home_state oid=%c");
+
+// Start (or stop when ab is NULL) bulk sampling of an analog input
+void
+analog_in_setup_bulk(uint8_t oid, struct analog_in_bulk *ab
+                     , uint32_t rest_time)
+{
+    struct analog_in *a = oid_lookup(oid, command_config_analog_in);
+    irq_disable();
+    a->bulk = NULL;
+    if (ab) {
+        if (!a->sample_count)
+            shutdown("Can not stream an idle analog input");
+        a->bulk = ab;
+        a->bulk_rest_time = rest_time;
+        analog_in_kick(a, timer_read_time() + rest_time);
+    }
+    irq_enable();
+}
+
 void
 analog_in_task(void)
 {
@@ -125,6 +270,8 @@ analog_in_shutdown(void)
     struct analog_in *a;
     foreach_oid(i, a, command_config_analog_in) {
         gpio_adc_cancel_sample(a->pin);
+        a->home_flags = a->extra_pending = 0;
+        a->bulk = NULL;
         if (a->sample_count) {
             a->state = a->sample_count + 1;
             a->next_begin_time += a->rest_time;
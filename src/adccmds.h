@@ -0,0 +1,12 @@
+#ifndef __ADCCMDS_H
+#define __ADCCMDS_H
+
+#include <stdint.h> // uint32_t
+
+struct analog_in_bulk;
+void analog_in_setup_bulk(uint8_t oid, struct analog_in_bulk *ab
+                          , uint32_t rest_time);
+void analog_in_bulk_note_sample(struct analog_in_bulk *ab, uint32_t time
+                                , uint16_t value);
+
+#endif // adccmds.h
@@ -0,0 +1,126 @@
+// Support for streaming micro-controller ADC samples in bulk
+//
+// Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include "adccmds.h" // analog_in_setup_bulk
+#include "basecmd.h" // oid_alloc
+#include "board/irq.h" // irq_disable
+#include "board/misc.h" // timer_read_time
+#include "command.h" // DECL_COMMAND
+#include "sched.h" // DECL_TASK
+#include "sensor_bulk.h" // sensor_bulk_report
+
+#define BYTES_PER_SAMPLE 6
+#define PENDING_SAMPLES 4
+
+struct analog_in_bulk {
+    struct sensor_bulk sb;
+    uint8_t analog_oid, pending_count;
+    uint16_t pending_values[PENDING_SAMPLES];
+    uint32_t pending_times[PENDING_SAMPLES];
+};
+
+static struct task_wake analog_in_bulk_wake;
+
+// Store a sample taken by the analog_in timer (called from irq context)
+void
+analog_in_bulk_note_sample(struct analog_in_bulk *ab, uint32_t time
+                           , uint16_t value)
+{
+    uint8_t count = ab->pending_count;
+    if (count >= PENDING_SAMPLES) {
+        ab->sb.possible_overflows++;
+        return;
+    }
+    ab->pending_values[count] = value;
+    ab->pending_times[count] = time;
+    ab->pending_count = count + 1;
+    sched_wake_task(&analog_in_bulk_wake);
+}
+
+void
+command_config_analog_in_bulk(uint32_t *args)
+{
+    struct analog_in_bulk *ab = oid_alloc(
+        args[0], command_config_analog_in_bulk, sizeof(*ab));
+    ab->analog_oid = args[1];
+}
+DECL_COMMAND(command_config_analog_in_bulk,
+             "config_analog_in_bulk oid=%c analog_in_oid=%c");
+
+// start/stop streaming samples
+void
+command_query_analog_in_bulk(uint32_t *args)
+{
+    struct analog_in_bulk *ab = oid_lookup(
+        args[0], command_config_analog_in_bulk);
+    analog_in_setup_bulk(ab->analog_oid, NULL, 0);
+    if (!args[1])
+        // End measurements
+        return;
+    // Start new measurements
+    sensor_bulk_reset(&ab->sb);
+    ab->pending_count = 0;
+    analog_in_setup_bulk(ab->analog_oid, ab, args[1]);
+}
+DECL_COMMAND(command_query_analog_in_bulk,
+             "query_analog_in_bulk oid=%c rest_ticks=%u");
+
+void
+command_query_analog_in_bulk_status(uint32_t *args)
+{
+    struct analog_in_bulk *ab = oid_lookup(
+        args[0], command_config_analog_in_bulk);
+    irq_disable();
+    uint32_t time = timer_read_time();
+    uint8_t pending_count = ab->pending_count;
+    irq_enable();
+    sensor_bulk_status(&ab->sb, args[0], time, 0
+                       , pending_count * BYTES_PER_SAMPLE);
+}
+DECL_COMMAND(command_query_analog_in_bulk_status,
+             "query_analog_in_bulk_status oid=%c");
+
+// Move samples from the pending list to the bulk report buffer
+static void
+analog_in_bulk_flush(struct analog_in_bulk *ab, uint8_t oid)
+{
+    uint16_t values[PENDING_SAMPLES];
+    uint32_t times[PENDING_SAMPLES];
+    irq_disable();
+    uint8_t count = ab->pending_count, i;
+    for (i = 0; i < count; i++) {
+        values[i] = ab->pending_values[i];
+        times[i] = ab->pending_times[i];
+    }
+    ab->pending_count = 0;
+    irq_enable();
+    for (i = 0; i < count; i++) {
+        uint8_t *d = &ab->sb.data[ab->sb.data_count];
+        d[0] = times[i];
+        d[1] = times[i] >> 8;
+        d[2] = times[i] >> 16;
+        d[3] = times[i] >> 24;
+        d[4] = values[i];
+        d[5] = values[i] >> 8;
+        ab->sb.data_count += BYTES_PER_SAMPLE;
+        if (ab->sb.data_count + BYTES_PER_SAMPLE > ARRAY_SIZE(ab->sb.data))
+            sensor_bulk_report(&ab->sb, oid);
+    }
+}
+
+void
+analog_in_bulk_task(void)
+{
+    if (!sched_check_wake(&analog_in_bulk_wake))
+        return;
+    uint8_t oid;
+    struct analog_in_bulk *ab;
+    foreach_oid(oid, ab, command_config_analog_in_bulk) {
+        if (ab->pending_count)
+            analog_in_bulk_flush(ab, oid);
+    }
+}
+DECL_TASK(analog_in_bulk_task);
@@ -0,0 +1,128 @@
+// Support for streaming pressure data from the wf100dp chip
+//
+// Copyright (C) 2025  Maja Stanislawska <maja@makershop.ie>
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include "basecmd.h" // oid_alloc
+#include "board/irq.h" // irq_disable
+#include "board/misc.h" // timer_read_time
+#include "command.h" // DECL_COMMAND
+#include "i2ccmds.h" // i2cdev_oid_lookup
+#include "sched.h" // DECL_TASK
+#include "sensor_bulk.h" // sensor_bulk_report
+
+enum {
+    WF_PENDING = 1<<0,
+};
+
+struct wf100dp {
+    struct timer timer;
+    uint32_t rest_ticks;
+    struct i2cdev_s *i2c;
+    uint8_t flags;
+    struct sensor_bulk sb;
+};
+
+static struct task_wake wf100dp_wake;
+
+// Event handler that wakes wf100dp_task() periodically
+static uint_fast8_t
+wf100dp_event(struct timer *timer)
+{
+    struct wf100dp *wf = container_of(timer, struct wf100dp, timer);
+    if (wf->flags & WF_PENDING)
+        wf->sb.possible_overflows++;
+    wf->flags |= WF_PENDING;
+    sched_wake_task(&wf100dp_wake);
+    wf->timer.waketime += wf->rest_ticks;
+    return SF_RESCHEDULE;
+}
+
+void
+command_config_wf100dp(uint32_t *args)
+{
+    struct wf100dp *wf = oid_alloc(args[0], command_config_wf100dp
+                                   , sizeof(*wf));
+    wf->timer.func = wf100dp_event;
+    wf->i2c = i2cdev_oid_lookup(args[1]);
+}
+DECL_COMMAND(command_config_wf100dp, "config_wf100dp oid=%c i2c_oid=%c");
+
+// Chip registers
+#define REG_DATA_PRESSURE 0x06
+
+#define BYTES_PER_SAMPLE 7
+
+// Read the pressure registers along with the time of the read
+static void
+wf100dp_query(struct wf100dp *wf, uint8_t oid)
+{
+    irq_disable();
+    wf->flags &= ~WF_PENDING;
+    irq_enable();
+
+    uint8_t *d = &wf->sb.data[wf->sb.data_count];
+    uint32_t time = timer_read_time();
+    uint8_t reg = REG_DATA_PRESSURE;
+    int ret = i2c_dev_read(wf->i2c, sizeof(reg), &reg, 3, &d[4]);
+    i2c_shutdown_on_err(ret);
+    d[0] = time;
+    d[1] = time >> 8;
+    d[2] = time >> 16;
+    d[3] = time >> 24;
+    wf->sb.data_count += BYTES_PER_SAMPLE;
+
+    // Flush local buffer if needed
+    if (wf->sb.data_count + BYTES_PER_SAMPLE > ARRAY_SIZE(wf->sb.data))
+        sensor_bulk_report(&wf->sb, oid);
+}
+
+// start/stop capturing pressure data
+void
+command_query_wf100dp(uint32_t *args)
+{
+    struct wf100dp *wf = oid_lookup(args[0], command_config_wf100dp);
+
+    sched_del_timer(&wf->timer);
+    wf->flags = 0;
+    if (!args[1])
+        // End measurements
+        return;
+
+    // Start new measurements query
+    wf->rest_ticks = args[1];
+    sensor_bulk_reset(&wf->sb);
+    irq_disable();
+    wf->timer.waketime = timer_read_time() + wf->rest_ticks;
+    sched_add_timer(&wf->timer);
+    irq_enable();
+}
+DECL_COMMAND(command_query_wf100dp, "query_wf100dp oid=%c rest_ticks=%u");
+
+void
+command_query_wf100dp_status(uint32_t *args)
+{
+    struct wf100dp *wf = oid_lookup(args[0], command_config_wf100dp);
+    irq_disable();
+    uint32_t time = timer_read_time();
+    uint8_t pending = wf->flags & WF_PENDING;
+    irq_enable();
+    sensor_bulk_status(&wf->sb, args[0], time, 0
+                       , pending ? BYTES_PER_SAMPLE : 0);
+}
+DECL_COMMAND(command_query_wf100dp_status, "query_wf100dp_status oid=%c");
+
+void
+wf100dp_task(void)
+{
+    if (!sched_check_wake(&wf100dp_wake))
+        return;
+    uint8_t oid;
+    struct wf100dp *wf;
+    foreach_oid(oid, wf, command_config_wf100dp) {
+        if (wf->flags & WF_PENDING)
+            wf100dp_query(wf, oid);
+    }
+}
+DECL_TASK(wf100dp_task);